@@ -0,0 +1,815 @@
+#!/usr/bin/env python3
+"""
+Benchmark and verification tools for Automatic Image Sync
+Run against a folder of images, e.g. one created with test_generator.py,
+or time a whole run on a generated corpus with 'pipeline'
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import hashlib
+import tempfile
+import argparse
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from PIL import Image, ImageEnhance
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import content_digest
+from config import ALGORITHM_SETTINGS
+from file_walker import walk_files
+from placement import MODES as PLACEMENT_MODES, PlacementEngine
+import hash_kernel
+from catalog import ImageCatalog, PROCESSED, HAS_DIGEST, HAS_HASHES
+from image_processor import ImageProcessor, ImageSynchronizer
+from similarity_index import HammingIndex, radius_for_threshold
+
+
+def collect_files(folder: Path, suffixes=None):
+    """Collect image files below a folder"""
+    files = []
+    for file_path in sorted(folder.rglob("*")):
+        if file_path.is_file() and ImageProcessor.is_image_file(file_path):
+            if suffixes is None or file_path.suffix.lower() in suffixes:
+                files.append(file_path)
+    return files
+
+
+def check_parity(folder: Path, hash_size: int) -> int:
+    """Compare the multi-hash kernel against imagehash, bit for bit"""
+    files = collect_files(folder)
+    mismatches = 0
+
+    for file_path in files:
+        with Image.open(file_path) as img:
+            kernel = hash_kernel.compute_hashes(img, hash_size)
+        with Image.open(file_path) as img:
+            reference = hash_kernel.reference_hashes(img, hash_size)
+
+        for hash_type in hash_kernel.HASH_TYPES:
+            if kernel[hash_type] != reference[hash_type]:
+                mismatches += 1
+                print(f"❌ {file_path}: {hash_type} differs")
+
+    print(f"Checked {len(files)} images at hash size {hash_size}: {mismatches} mismatches")
+    return mismatches
+
+
+def bench_hashing(folder: Path, hash_size: int):
+    """Time the multi-hash kernel against four separate imagehash calls"""
+    files = collect_files(folder)
+    if not files:
+        print("No images found")
+        return
+
+    timings = {}
+    for name, func in (("imagehash", hash_kernel.reference_hashes), ("kernel", hash_kernel.compute_hashes)):
+        start = time.perf_counter()
+        for file_path in files:
+            with Image.open(file_path) as img:
+                func(img, hash_size)
+        timings[name] = time.perf_counter() - start
+
+    for name, elapsed in timings.items():
+        print(f"{name:>10}: {elapsed:.3f}s  ({len(files) / elapsed:.1f} images/s)")
+    print(f"   speedup: {timings['imagehash'] / timings['kernel']:.2f}x")
+
+
+def hamming_bits(hash1: bytes, hash2: bytes) -> int:
+    """Number of differing bits between two packed hashes"""
+    xor = np.bitwise_xor(np.frombuffer(hash1, np.uint8), np.frombuffer(hash2, np.uint8))
+    return int(np.unpackbits(xor).sum())
+
+
+def bench_reduced_decode(folder: Path, hash_size: int):
+    """Time full vs reduced-resolution JPEG decoding and measure the hash drift"""
+    files = collect_files(folder, suffixes={'.jpg', '.jpeg'})
+    if not files:
+        print("No JPEG images found")
+        return
+
+    timings = {False: 0.0, True: 0.0}
+    drift = {hash_type: [] for hash_type in hash_kernel.HASH_TYPES}
+
+    for file_path in files:
+        hashes = {}
+        for reduced in (False, True):
+            start = time.perf_counter()
+            with Image.open(file_path) as img:
+                hashes[reduced] = hash_kernel.compute_hashes(img, hash_size, reduced_decode=reduced)
+            timings[reduced] += time.perf_counter() - start
+
+        for hash_type in hash_kernel.HASH_TYPES:
+            drift[hash_type].append(hamming_bits(hashes[False][hash_type], hashes[True][hash_type]))
+
+    print(f"{len(files)} JPEG images, hash size {hash_size}, draft size {hash_kernel.draft_size(hash_size)}")
+    print(f"  full decode:    {timings[False]:.3f}s  ({len(files) / timings[False]:.1f} images/s)")
+    print(f"  reduced decode: {timings[True]:.3f}s  ({len(files) / timings[True]:.1f} images/s)")
+    print(f"  speedup:        {timings[False] / timings[True]:.2f}x")
+    print(f"  hash drift in bits out of {hash_size * hash_size} (mean / max / images changed):")
+    for hash_type, bits in drift.items():
+        changed = sum(1 for b in bits if b)
+        print(f"    {hash_type}: {np.mean(bits):.2f} / {max(bits)} / {changed}")
+
+
+DIHEDRAL = (Image.FLIP_LEFT_RIGHT, Image.FLIP_TOP_BOTTOM, Image.ROTATE_90, Image.ROTATE_180,
+            Image.ROTATE_270, Image.TRANSPOSE, Image.TRANSVERSE)
+
+
+def bench_transforms(folder: Path, hash_size: int, threshold: float):
+    """Cost of canonical-orientation hashing, and what it finds among rotated and re-encoded copies
+
+    Every image is compared with its seven rotations and mirrors and with a
+    resized, re-encoded copy, all made in memory and hashed like files.
+    """
+    files = collect_files(folder)
+    if not files:
+        print("No images found")
+        return
+
+    def encoded(image: Image.Image, quality: int = 90) -> Image.Image:
+        buffer = io.BytesIO()
+        image.convert('RGB').save(buffer, 'JPEG', quality=quality)
+        buffer.seek(0)
+        return Image.open(buffer)
+
+    def similar(a, b) -> bool:
+        return ImageProcessor.are_images_similar({t: v.hex() for t, v in a.items()},
+                                                 {t: v.hex() for t, v in b.items()}, threshold)
+
+    timings = {False: 0.0, True: 0.0}
+    rotated = {False: 0, True: 0}
+    reencoded = {False: 0, True: 0}
+    for file_path in files:
+        with Image.open(file_path) as img:
+            img.load()
+            original = img.convert('RGB')
+        width, height = original.size
+        copies = [original.transpose(method) for method in DIHEDRAL]
+        smaller = original.resize((max(1, width * 15 // 16), max(1, height * 15 // 16)), Image.LANCZOS)
+        for canonical in (False, True):
+            for _ in range(2):  # the second pass is timed, with the file in the page cache
+                start = time.perf_counter()
+                with Image.open(file_path) as img:
+                    hashes = hash_kernel.compute_hashes(img, hash_size, True, canonical)
+                elapsed = time.perf_counter() - start
+            timings[canonical] += elapsed
+            rotated[canonical] += sum(
+                similar(hashes, hash_kernel.compute_hashes(encoded(copy), hash_size, True, canonical))
+                for copy in copies)
+            reencoded[canonical] += similar(
+                hashes, hash_kernel.compute_hashes(encoded(smaller, 80), hash_size, True, canonical))
+
+    print(f"{len(files)} images, hash size {hash_size}, threshold {threshold}")
+    print(f"  plain hashing:     {timings[False]:.3f}s  ({len(files) / timings[False]:.1f} images/s)")
+    print(f"  canonical hashing: {timings[True]:.3f}s  ({len(files) / timings[True]:.1f} images/s, "
+          f"{(timings[True] / timings[False] - 1) * 100:+.1f}%)")
+    for canonical in (False, True):
+        label = "canonical" if canonical else "plain"
+        print(f"  {label:>9}: rotated/mirrored copies found {rotated[canonical]}/{len(files) * len(DIHEDRAL)}, "
+              f"re-encoded copies found {reencoded[canonical]}/{len(files)}")
+
+
+def legacy_md5(file_path: Path, algorithm=None, reader=None) -> bytes:
+    """The original get_file_hash: MD5 with 4 KiB reads"""
+    hash_md5 = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(4096), b""):
+            hash_md5.update(chunk)
+    return hash_md5.digest()
+
+
+def drop_page_cache(file_path: Path) -> bool:
+    """Ask the kernel to evict a file from the page cache (clean pages only)"""
+    if not hasattr(os, 'posix_fadvise'):
+        return False
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+    return True
+
+
+def bench_digest(folder: Path, repeat: int):
+    """Throughput (MB/s) of each digest algorithm and reader, page-cache hot and cold"""
+    files = [f for f in sorted(folder.rglob("*")) if f.is_file()]
+    total_bytes = sum(f.stat().st_size for f in files)
+    if not total_bytes:
+        print("No files found")
+        return
+    print(f"{len(files)} files, {total_bytes / 2 ** 20:.1f} MiB")
+
+    variants = [("md5 (4 KiB reads)", legacy_md5, None, None)]
+    for algorithm in content_digest.available_algorithms():
+        for reader in content_digest.READERS:
+            if reader == 'file_digest' and not hasattr(hashlib, 'file_digest'):
+                continue
+            variants.append((f"{algorithm} ({reader})", content_digest.digest_file, algorithm, reader))
+
+    for label, func, algorithm, reader in variants:
+        results = {}
+        for state in ("hot", "cold"):
+            elapsed = 0.0
+            for _ in range(repeat):
+                for file_path in files:
+                    if state == "cold":
+                        if not drop_page_cache(file_path):
+                            elapsed = None  # the page cache cannot be dropped here
+                            break
+                    else:
+                        func(file_path, algorithm, reader)
+                    start = time.perf_counter()
+                    func(file_path, algorithm, reader)
+                    elapsed += time.perf_counter() - start
+                if elapsed is None:
+                    break
+            results[state] = f"{total_bytes * repeat / elapsed / 2 ** 20:8.0f} MB/s" if elapsed else f"{'n/a':>13}"
+        print(f"  {label:<24} hot {results['hot']}   cold {results['cold']}")
+
+
+def legacy_walk(folder: Path):
+    """The original collect_images walk: rglob, is_file() and a stat per image"""
+    found = []
+    for file_path in folder.rglob("*"):
+        if file_path.is_file() and ImageProcessor.is_image_file(file_path):
+            found.append((str(file_path), file_path.stat()))
+    return found
+
+
+def bench_walk(folder: Path, workers_list):
+    """Time the rglob walk against the scandir walker at several thread counts"""
+    variants = [("rglob + is_file", lambda: legacy_walk(folder))]
+    for workers in workers_list:
+        variants.append((f"scandir x{workers}",
+                         lambda w=workers: list(walk_files(folder, ImageProcessor.SUPPORTED_FORMATS, w))))
+
+    for label, func in variants:
+        start = time.perf_counter()
+        found = func()
+        elapsed = time.perf_counter() - start
+        print(f"  {label:<16} {elapsed:7.2f}s  {len(found):>9,} images  {len(found) / elapsed:10.0f} files/s")
+
+
+def legacy_place(files, folder: Path):
+    """The original move loop: a stat per candidate name and shutil.move per file"""
+    folder.mkdir(parents=True, exist_ok=True)
+    for file_path in files:
+        dest_path = folder / file_path.name
+        counter = 1
+        while dest_path.exists():
+            dest_path = folder / f"{file_path.stem}_{counter}{file_path.suffix}"
+            counter += 1
+        shutil.move(str(file_path), str(dest_path))
+
+
+def bench_placement(work_dir: Path, count: int, folders: int, workers: int):
+    """Time the sequential move loop against the placement engine on empty files"""
+    def make_files(root: Path):
+        root.mkdir(parents=True)
+        files = []
+        for i in range(count):
+            file_path = root / f"IMG_{i % (count // 4 or 1):06d}_{i // (count // 4 or 1)}.jpg"
+            file_path.touch()
+            files.append(file_path)
+        return files
+
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp:
+        tmp = Path(tmp)
+        files = make_files(tmp / "legacy_in")
+        start = time.perf_counter()
+        for k in range(folders):
+            legacy_place(files[k::folders], tmp / "legacy_out" / f"group_{k}")
+        legacy = time.perf_counter() - start
+
+        files = make_files(tmp / "engine_in")
+        start = time.perf_counter()
+        engine = PlacementEngine(workers)
+        for k in range(folders):
+            folder = tmp / "engine_out" / f"group_{k}"
+            for file_path in files[k::folders]:
+                engine.add(file_path, folder)
+        errors = engine.run()
+        elapsed = time.perf_counter() - start
+
+    print(f"{count:,} files into {folders} folders")
+    print(f"  shutil.move loop:  {legacy:7.2f}s  ({count / legacy:8.0f} files/s)")
+    print(f"  placement engine:  {elapsed:7.2f}s  ({count / elapsed:8.0f} files/s, {len(errors)} errors)")
+
+
+class LegacyImageData:
+    """The per-file object layout ImageData used before the catalog, for comparison"""
+
+    def __init__(self, file_path: Path):
+        self.file_path = file_path
+        self.file_hash = ""
+        self.image_hashes = {}
+        self.context = ""
+        self.processed = False
+
+
+def synthetic_path(i: int) -> Path:
+    """A realistic camera-dump path for row i"""
+    return Path(f"/srv/photos/{2000 + i % 25}/{i % 12 + 1:02d}/event_{i % 997:03d}/IMG_{i:08d}.JPG")
+
+
+def measure(build):
+    """Memory retained (bytes) and time (s) of building a structure"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return current, elapsed
+
+
+def bench_memory(rows_list, hash_size: int):
+    """Compare memory of per-file ImageData objects against the columnar catalog"""
+    hash_hex = hash_size * hash_size // 4
+    rng = np.random.default_rng(0)
+
+    for rows in rows_list:
+        digests = rng.integers(0, 256, (rows, 16), dtype=np.uint8)
+        words = (hash_size * hash_size + 63) // 64
+        hashes = rng.integers(0, 2 ** 63, (rows, words), dtype=np.uint64)
+
+        def build_legacy():
+            images = []
+            for i in range(rows):
+                img = LegacyImageData(synthetic_path(i))
+                img.file_hash = digests[i].tobytes().hex()
+                img.image_hashes = {
+                    hash_type: hashes[i].astype('>u8').tobytes().hex()[:hash_hex]
+                    for hash_type in hash_kernel.HASH_TYPES
+                }
+                img.context = ImageProcessor.extract_image_context(img.file_path)
+                img.processed = True
+                images.append(img)
+            return images
+
+        def build_catalog():
+            catalog = ImageCatalog(hash_size, capacity=rows)
+            for i in range(rows):
+                catalog.add(synthetic_path(i))
+            catalog.digests[:rows] = digests
+            for block in catalog.hashes.values():
+                block[:rows] = hashes
+            catalog.flags[:rows] = PROCESSED | HAS_DIGEST | HAS_HASHES
+            return catalog
+
+        catalog_bytes, catalog_time = measure(build_catalog)
+        legacy_bytes, legacy_time = measure(build_legacy)
+
+        print(f"{rows:>9,} rows")
+        print(f"  ImageData objects: {legacy_bytes / 2 ** 20:9.1f} MiB  ({legacy_bytes / rows:6.0f} B/row, built in {legacy_time:.1f}s)")
+        print(f"  ImageCatalog:      {catalog_bytes / 2 ** 20:9.1f} MiB  ({catalog_bytes / rows:6.0f} B/row, built in {catalog_time:.1f}s)")
+        print(f"  reduction:         {legacy_bytes / catalog_bytes:9.1f}x")
+
+
+def synthetic_hash_vectors(rows: int, words: int, duplicate_ratio: float = 0.2, max_flips: int = 16, seed: int = 0):
+    """Random hash vectors where a share of rows are bit-flipped copies of earlier rows"""
+    rng = np.random.default_rng(seed)
+    vectors = rng.integers(0, 2 ** 64, (rows, words), dtype=np.uint64)
+    copies = np.flatnonzero(rng.random(rows) < duplicate_ratio)
+    copies = copies[copies > 0]
+    sources = (rng.random(len(copies)) * copies).astype(np.int64)
+    vectors[copies] = vectors[sources]
+    for _ in range(max_flips):
+        flip = rng.random(len(copies)) < 0.5
+        bit = rng.integers(0, words * 64, len(copies))
+        mask = np.left_shift(np.uint64(1), (bit % 64).astype(np.uint64))
+        vectors[copies[flip], bit[flip] // 64] ^= mask[flip]
+    return vectors
+
+
+def bench_index(rows_list, threshold: float, hash_size: int, verify_up_to: int, recall: float):
+    """Time the near-neighbour index self-join and check it against the all-pairs scan"""
+    words = 4 * ((hash_size * hash_size + 63) // 64)
+    radius = radius_for_threshold(threshold, words * 64)
+    print(f"threshold {threshold}: radius {radius} of {words * 64} bits")
+
+    for rows in rows_list:
+        vectors = synthetic_hash_vectors(rows, words)
+        index = HammingIndex(vectors, radius)
+        start = time.perf_counter()
+        first, second = index.pairs()
+        elapsed = time.perf_counter() - start
+        mode = "index" if index.use_index else "scan"
+        print(f"{rows:>9,} hashes: {elapsed:8.2f}s  {rows / elapsed:10.0f} hashes/s  "
+              f"{len(first):>8} pairs  {index.comparisons:>12,} comparisons ({mode})")
+
+        if rows <= verify_up_to and index.use_index:
+            scan = HammingIndex(vectors, radius)
+            scan.use_index = False
+            start = time.perf_counter()
+            scan_first, scan_second = scan.pairs()
+            elapsed = time.perf_counter() - start
+            same = np.array_equal(first, scan_first) and np.array_equal(second, scan_second)
+            print(f"{'':>9}  all-pairs scan: {elapsed:8.2f}s  same pairs: {'yes' if same else 'NO'}")
+
+        # The weighted cascade from config.ALGORITHM_SETTINGS on the same hashes
+        cascade = ImageProcessor.similarity_cascade(threshold, hash_bits=hash_size * hash_size)
+        weighted = HammingIndex(vectors, cascade.candidate_radius, cascade=cascade, recall=recall)
+        start = time.perf_counter()
+        weighted_first, weighted_second = weighted.pairs()
+        elapsed = time.perf_counter() - start
+        settled = ", ".join(f"{hash_type} {count:,}" for hash_type, count in cascade.stage_counts().items())
+        mode = {'substrings': f"index, {len(weighted.substrings)} substrings",
+                'sampled': f"index, {len(weighted.sampled)} sampled-bit tables"}.get(weighted.mode, "scan")
+        print(f"{'':>9}  weighted cascade: {elapsed:8.2f}s  {len(weighted_first):>8} pairs  settled by {settled} ({mode})")
+
+        if rows <= verify_up_to and weighted.mode == 'sampled':
+            scan = HammingIndex(vectors, cascade.candidate_radius, cascade=cascade)
+            start = time.perf_counter()
+            scan_first, scan_second = scan.pairs()
+            elapsed = time.perf_counter() - start
+            found = len(np.intersect1d(weighted_first * rows + weighted_second, scan_first * rows + scan_second))
+            print(f"{'':>9}  weighted scan: {elapsed:8.2f}s  {len(scan_first):>8} pairs, "
+                  f"{found / max(1, len(scan_first)):.4f} of them found by the index")
+
+
+PIPELINE_FORMAT = 1
+# Results of the default 'pipeline' run, compared against unless --baseline says otherwise
+PIPELINE_BASELINE = Path(__file__).with_name("pipeline_baseline.json")
+PIPELINE_STAGES = ('scan', 'digest', 'hash', 'compare', 'group', 'place')
+CORPUS_IMAGE_SIZE = (320, 240)
+FILES_PER_FOLDER = 1000
+
+
+def corpus_image(seed: int, index: int) -> Image.Image:
+    """A smooth random picture, always the same for the same seed and index"""
+    rng = np.random.default_rng([seed, index])
+    small = rng.integers(0, 256, (6, 8, 3), dtype=np.uint8)
+    return Image.fromarray(small).resize(CORPUS_IMAGE_SIZE, Image.BICUBIC)
+
+
+def build_corpus(root: Path, images: int, near_ratio: float, exact_ratio: float, seed: int) -> dict:
+    """Create (or reuse) a deterministic two-folder corpus and return its manifest
+
+    folder1 holds distinct pictures. Of the files in folder2, near_ratio are
+    brightened, shrunk and re-encoded copies of folder1 pictures, exact_ratio
+    are byte-identical copies and the rest are new pictures. Files are spread
+    over subfolders of FILES_PER_FOLDER. A corpus whose manifest matches is reused.
+    """
+    settings = {"images": images, "near_duplicate_ratio": near_ratio, "exact_duplicate_ratio": exact_ratio,
+                "seed": seed, "image_size": list(CORPUS_IMAGE_SIZE)}
+    manifest_path = root / "corpus.json"
+    if manifest_path.exists():
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("settings") == settings:
+            return manifest
+    shutil.rmtree(root, ignore_errors=True)
+
+    originals = images - images // 2
+    second = images // 2
+    near = round(second * near_ratio)
+    exact = min(round(second * exact_ratio), second - near)
+    # Which folder1 picture each copy in folder2 is made from
+    sources = np.random.default_rng([seed, images]).permutation(max(originals, near + exact))[:near + exact] % originals
+
+    def path(folder: str, i: int) -> Path:
+        return root / folder / f"{i // FILES_PER_FOLDER:03d}" / f"img_{i:06d}.jpg"
+
+    def make_original(i: int):
+        corpus_image(seed, i).save(path("folder1", i), quality=90)
+
+    def make_second(j: int):
+        destination = path("folder2", j)
+        if j < near:
+            rng = np.random.default_rng([seed, images, j])
+            image = ImageEnhance.Brightness(corpus_image(seed, int(sources[j]))).enhance(1 + rng.uniform(-0.08, 0.08))
+            width, height = CORPUS_IMAGE_SIZE
+            image.resize((width * 15 // 16, height * 15 // 16), Image.LANCZOS).save(destination, quality=80)
+        elif j < near + exact:
+            shutil.copyfile(path("folder1", int(sources[j])), destination)
+        else:
+            corpus_image(seed, originals + j).save(destination, quality=90)
+
+    for folder, count in (("folder1", originals), ("folder2", second)):
+        for k in range(0, count, FILES_PER_FOLDER):
+            path(folder, k).parent.mkdir(parents=True, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 4) as executor:
+        list(executor.map(make_original, range(originals)))
+        list(executor.map(make_second, range(second)))
+
+    total_bytes = sum(f.stat().st_size for f in root.rglob("*.jpg"))
+    manifest = {"settings": settings, "near_duplicates": near, "exact_duplicates": exact, "bytes": total_bytes}
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def peak_rss_mb():
+    """Largest resident set so far of this process and of its finished worker processes"""
+    if resource is None:
+        return None
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere
+    scale = 1 if sys.platform == 'darwin' else 1024
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return round(peak * scale / 2 ** 20, 1)
+
+
+def run_pipeline(corpus: Path, workers, executor, threshold, mode: str, cold: bool) -> dict:
+    """Run every ImageSynchronizer stage over a corpus on its own and time it
+
+    The stages are the ones organize_images chains (where scanning and hashing
+    overlap): scan, exact-duplicate digests, decode + hash of the remaining
+    representatives, comparison, grouping, then planning and placing into a
+    scratch output folder. No hash cache or checkpoint is used. With cold, the
+    page cache is dropped before the stages that read files.
+    """
+    synchronizer = ImageSynchronizer(max_workers=workers, executor=executor, placement_mode=mode,
+                                     threshold=threshold)
+    stages = {}
+
+    def record(stage: str, start: float, count: int, data_bytes=None, **extra):
+        elapsed = time.perf_counter() - start
+        stages[stage] = {
+            "seconds": round(elapsed, 4),
+            "images_per_s": round(count / elapsed, 1) if elapsed else None,
+            "mb_per_s": round(data_bytes / elapsed / 2 ** 20, 1) if elapsed and data_bytes is not None else None,
+            "peak_rss_mb": peak_rss_mb(),
+            **extra,
+        }
+
+    def drop_caches(images):
+        if cold:
+            for img in images:
+                drop_page_cache(img.file_path)
+
+    images1, images2 = [], []
+    start = time.perf_counter()
+    for _ in synchronizer.scan_folders([corpus / "folder1", corpus / "folder2"], [images1, images2]):
+        pass
+    images1.sort(key=lambda img: img.file_path)
+    images2.sort(key=lambda img: img.file_path)
+    all_images = images1 + images2
+    record('scan', start, len(all_images))
+
+    drop_caches(all_images)
+    start = time.perf_counter()
+    exact = synchronizer.detect_exact_duplicates(all_images)
+    record('digest', start, len(all_images), exact["bytes_read"],
+           files_read=exact["partial_hashed"] + exact["full_hashed"])
+
+    representatives, duplicates = synchronizer.split_representatives(all_images)
+    drop_caches(representatives)
+    start = time.perf_counter()
+    synchronizer.process_images_parallel(representatives, digest=False)
+    synchronizer.share_representative_hashes(duplicates)
+    decoded_bytes = int(synchronizer.metrics.counter('bytes_read', 'hash'))
+    record('hash', start, len(representatives), decoded_bytes)
+
+    start = time.perf_counter()
+    first, second = synchronizer.similar_pairs(all_images)
+    record('compare', start, len(all_images), pairs=len(first),
+           comparisons=sum(synchronizer.comparison_stats.values()))
+
+    start = time.perf_counter()
+    groups = synchronizer.group_similar(all_images, first, second)
+    record('group', start, len(all_images), groups=len(groups))
+
+    output = corpus / "output"
+    shutil.rmtree(output, ignore_errors=True)
+    try:
+        start = time.perf_counter()
+        plan = synchronizer.plan_placement(all_images, groups, output)
+        placed = synchronizer.apply_plan(plan, corpus / "plan.journal")
+        placed_bytes = int(sum(synchronizer.catalog.sizes[img.row] for img in all_images))
+        record('place', start, len(plan), placed_bytes, errors=placed.get("errors", 0))
+    finally:
+        shutil.rmtree(output, ignore_errors=True)
+        try:
+            os.unlink(corpus / "plan.journal")
+        except FileNotFoundError:
+            pass
+
+    return {"stages": stages, "total_seconds": round(sum(s["seconds"] for s in stages.values()), 4)}
+
+
+def compare_to_baseline(results: dict, baseline: dict, tolerance: float, rss_tolerance: float):
+    """Regressions of a pipeline result against a baseline, as messages
+
+    A stage regresses when its images/s drop by more than the tolerance (the
+    baseline's "tolerances" map can set one per stage) or its peak RSS grows by
+    more than rss_tolerance. Runs are matched by corpus size; a corpus built
+    with other settings is reported rather than compared. So is a baseline
+    measured with other hash settings (digest algorithm among them), since
+    those change what the digest and hash stages do.
+    """
+    if baseline.get("hash_version") != results["hash_version"]:
+        return [f"baseline measured with other hash settings ({baseline.get('hash_version')}, "
+                f"here {results['hash_version']}); measure a baseline with these settings"]
+    machine = baseline.get("machine")
+    if machine and machine != results.get("machine"):
+        print(f"  (baseline measured on another machine: {machine['cpus']} CPUs, {machine['platform']}; "
+              f"expect differences beyond the tolerance)")
+    tolerances = baseline.get("tolerances", {})
+    by_size = {run["corpus"]["settings"]["images"]: run for run in baseline.get("runs", [])}
+    problems = []
+    for run in results["runs"]:
+        images = run["corpus"]["settings"]["images"]
+        reference = by_size.get(images)
+        if reference is None:
+            print(f"  (no baseline for {images:,} images)")
+            continue
+        if reference["corpus"]["settings"] != run["corpus"]["settings"]:
+            problems.append(f"{images:,} images: corpus settings differ from the baseline's")
+            continue
+        for stage, current in run["stages"].items():
+            before = reference["stages"].get(stage)
+            if before is None:
+                continue
+            allowed = tolerances.get(stage, tolerance)
+            if current["images_per_s"] and before["images_per_s"] and \
+                    current["images_per_s"] < before["images_per_s"] * (1 - allowed):
+                change = current["images_per_s"] / before["images_per_s"] - 1
+                problems.append(f"{images:,} images, {stage}: {current['images_per_s']:.0f} images/s, baseline "
+                                f"{before['images_per_s']:.0f} ({change:+.0%}, tolerance -{allowed:.0%})")
+            if current["peak_rss_mb"] and before["peak_rss_mb"] and \
+                    current["peak_rss_mb"] > before["peak_rss_mb"] * (1 + rss_tolerance):
+                problems.append(f"{images:,} images, {stage}: peak RSS {current['peak_rss_mb']:.0f} MB, baseline "
+                                f"{before['peak_rss_mb']:.0f} MB (tolerance +{rss_tolerance:.0%})")
+    return problems
+
+
+def bench_pipeline(args) -> int:
+    """Time every stage on corpora of each size, write JSON and check a baseline; returns the exit code"""
+    results = {"format": PIPELINE_FORMAT, "hash_version": ImageProcessor.hash_version(), "runs": [],
+               "machine": {"cpus": os.cpu_count(), "platform": platform.platform(),
+                           "python": platform.python_version()}}
+    if args.cold and not hasattr(os, 'posix_fadvise'):
+        print("The page cache cannot be dropped here; --cold runs are page-cache hot")
+        args.cold = False
+    for images in args.images:
+        corpus = Path(args.corpus_dir) / f"images_{images}"
+        start = time.perf_counter()
+        manifest = build_corpus(corpus, images, args.near_duplicates, args.exact_duplicates, args.seed)
+        print(f"{images:,} images ({manifest['bytes'] / 2 ** 20:.0f} MiB, {manifest['near_duplicates']} near and "
+              f"{manifest['exact_duplicates']} exact duplicates) ready in {time.perf_counter() - start:.1f}s")
+
+        run = run_pipeline(corpus, args.workers, args.executor, args.threshold, args.mode, args.cold)
+        for _ in range(args.repeat - 1):
+            # Keep each stage's fastest run; the slower ones measured something else too
+            again = run_pipeline(corpus, args.workers, args.executor, args.threshold, args.mode, args.cold)
+            for stage, timing in again["stages"].items():
+                if timing["seconds"] < run["stages"][stage]["seconds"]:
+                    run["stages"][stage] = timing
+            run["total_seconds"] = round(sum(s["seconds"] for s in run["stages"].values()), 4)
+        run["corpus"] = manifest
+        results["runs"].append(run)
+        for stage, timing in run["stages"].items():
+            throughput = f"{timing['mb_per_s']:8.1f} MB/s" if timing["mb_per_s"] is not None else " " * 13
+            rss = f"{timing['peak_rss_mb']:7.0f} MB" if timing["peak_rss_mb"] is not None else ""
+            print(f"  {stage:<8} {timing['seconds']:9.3f}s  {timing['images_per_s'] or 0:10.0f} images/s  "
+                  f"{throughput}  peak RSS {rss}")
+        print(f"  {'total':<8} {run['total_seconds']:9.3f}s")
+
+    results["settings"] = {"workers": args.workers, "executor": args.executor, "threshold": args.threshold,
+                           "mode": args.mode, "cold": args.cold, "repeat": args.repeat}
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.json}")
+
+    if not args.baseline:
+        return 0
+    if not os.path.exists(args.baseline) and args.baseline == str(PIPELINE_BASELINE):
+        print(f"No baseline at {args.baseline}")
+        return 0
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    problems = compare_to_baseline(results, baseline, args.tolerance, args.rss_tolerance)
+    for problem in problems:
+        print(f"❌ {problem}")
+    if not problems:
+        print(f"✅ Within tolerance of {args.baseline}")
+    return 1 if problems else 0
+
+
+def main():
+    """Main benchmark entry point"""
+    parser = argparse.ArgumentParser(description='Automatic Image Sync - Benchmarks')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parity = subparsers.add_parser('parity', help='Check kernel hashes are bit-identical to imagehash')
+    parity.add_argument('folder', help='Folder of images')
+    parity.add_argument('--hash-size', type=int, default=ImageProcessor.HASH_SIZE)
+
+    hashing = subparsers.add_parser('hash', help='Time the multi-hash kernel against imagehash')
+    hashing.add_argument('folder', help='Folder of images')
+    hashing.add_argument('--hash-size', type=int, default=ImageProcessor.HASH_SIZE)
+
+    decode = subparsers.add_parser('decode', help='Time reduced-resolution JPEG decoding and hash drift')
+    decode.add_argument('folder', help='Folder of images')
+    decode.add_argument('--hash-size', type=int, default=ImageProcessor.HASH_SIZE)
+
+    transforms = subparsers.add_parser('transforms', help='Cost and recall of rotation-aware (canonical) hashing')
+    transforms.add_argument('folder', help='Folder of images')
+    transforms.add_argument('--hash-size', type=int, default=ImageProcessor.HASH_SIZE)
+    transforms.add_argument('--threshold', type=float, default=0.85)
+
+    digest = subparsers.add_parser('digest', help='Throughput of content digest algorithms')
+    digest.add_argument('folder', help='Folder of files')
+    digest.add_argument('--repeat', type=int, default=3)
+
+    walk = subparsers.add_parser('walk', help='Time the directory walker against rglob')
+    walk.add_argument('folder', help='Folder tree to walk')
+    walk.add_argument('--workers', type=int, nargs='+', default=[1, 8, 32])
+
+    place = subparsers.add_parser('place', help='Time the placement engine against the move loop')
+    place.add_argument('--dir', default=tempfile.gettempdir(), help='Scratch folder on the filesystem to test')
+    place.add_argument('--files', type=int, default=200_000)
+    place.add_argument('--folders', type=int, default=1000)
+    place.add_argument('--workers', type=int, default=8)
+
+    memory = subparsers.add_parser('memory', help='Compare ImageData objects against the columnar catalog')
+    memory.add_argument('--rows', type=int, nargs='+', default=[100_000, 1_000_000])
+    memory.add_argument('--hash-size', type=int, default=ImageProcessor.HASH_SIZE)
+
+    index = subparsers.add_parser('index', help='Time the near-neighbour index on synthetic hashes')
+    index.add_argument('--rows', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    index.add_argument('--threshold', type=float, default=0.95)
+    index.add_argument('--hash-size', type=int, default=ImageProcessor.HASH_SIZE)
+    index.add_argument('--verify-up-to', type=int, default=100_000,
+                       help='Compare against the all-pairs scan up to this many hashes')
+    index.add_argument('--recall', type=float, default=ALGORITHM_SETTINGS.get('INDEX_RECALL', 1.0),
+                       help='INDEX_RECALL for the weighted cascade (1.0 compares every pair)')
+
+    pipeline = subparsers.add_parser('pipeline', help='Time every stage of a run on a generated corpus, as JSON')
+    pipeline.add_argument('--images', type=int, nargs='+', default=[1_000, 10_000, 100_000],
+                          help='Corpus sizes (default: 1000 10000 100000)')
+    pipeline.add_argument('--near-duplicates', type=float, default=0.2,
+                          help='Share of the second folder that are edited copies of the first')
+    pipeline.add_argument('--exact-duplicates', type=float, default=0.05,
+                          help='Share of the second folder that are byte-identical copies')
+    pipeline.add_argument('--seed', type=int, default=0)
+    pipeline.add_argument('--corpus-dir', default=os.path.join(tempfile.gettempdir(), 'automatic_image_sync_corpus'),
+                          help='Where corpora are generated and kept for later runs')
+    pipeline.add_argument('--workers', type=int, default=None)
+    pipeline.add_argument('--executor', choices=ImageSynchronizer.EXECUTORS, default=None)
+    pipeline.add_argument('--threshold', type=float, default=None)
+    pipeline.add_argument('--mode', choices=[m for m in PLACEMENT_MODES if m != 'move'], default='copy',
+                          help='Placement mode for the place stage (the corpus is kept)')
+    pipeline.add_argument('--cold', action='store_true',
+                          help='Drop the page cache before the digest and hash stages')
+    pipeline.add_argument('--repeat', type=int, default=3,
+                          help='Runs per corpus; each stage keeps its fastest (default: 3)')
+    pipeline.add_argument('--json', default=None, help='Write the results to this file')
+    pipeline.add_argument('--baseline', default=str(PIPELINE_BASELINE),
+                          help="Results file to compare against (default: the committed pipeline_baseline.json; "
+                               "'' to skip)")
+    pipeline.add_argument('--tolerance', type=float, default=0.2,
+                          help='Allowed drop in images/s per stage (baseline "tolerances" may override per stage)')
+    pipeline.add_argument('--rss-tolerance', type=float, default=0.25, help='Allowed growth in peak RSS')
+
+    args = parser.parse_args()
+    if args.command == 'pipeline':
+        sys.exit(bench_pipeline(args))
+    if args.command == 'memory':
+        bench_memory(args.rows, args.hash_size)
+        return
+    if args.command == 'place':
+        bench_placement(Path(args.dir), args.files, args.folders, args.workers)
+        return
+    if args.command == 'index':
+        bench_index(args.rows, args.threshold, args.hash_size, args.verify_up_to, args.recall)
+        return
+
+    folder = Path(args.folder)
+
+    if args.command == 'parity':
+        for hash_size in sorted({8, args.hash_size}):
+            if check_parity(folder, hash_size):
+                sys.exit(1)
+    elif args.command == 'hash':
+        bench_hashing(folder, args.hash_size)
+    elif args.command == 'decode':
+        bench_reduced_decode(folder, args.hash_size)
+    elif args.command == 'transforms':
+        bench_transforms(folder, args.hash_size, args.threshold)
+    elif args.command == 'digest':
+        bench_digest(folder, args.repeat)
+    elif args.command == 'walk':
+        bench_walk(folder, args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""
+Columnar image catalog for Automatic Image Sync
+Keeps per-file paths, digests and perceptual hashes in NumPy arrays instead of Python objects
+"""
+
+import os
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from content_digest import DIGEST_SIZE
+
+
+HASH_TYPES = ('ahash', 'phash', 'dhash', 'whash')
+
+# Row flags
+PROCESSED = 1
+HAS_DIGEST = 2
+HAS_HASHES = 4
+HAS_STAT = 8
+
+
+class ImageCatalog:
+    """Growable table of image records backed by NumPy arrays
+
+    Each hash type is a (rows, words) uint64 block holding the hash bits MSB-first,
+    digests are a (rows, 16) uint8 column, directories are interned in a table and
+    file names are stored in one encoded blob with an offsets column.
+    """
+
+    def __init__(self, hash_size: int = 16, capacity: int = 1024):
+        self.hash_size = hash_size
+        self.hash_bytes = (hash_size * hash_size + 7) // 8
+        self.hash_words = (self.hash_bytes + 7) // 8
+        self._size = 0
+        self._lock = threading.RLock()
+
+        capacity = max(1, capacity)
+        self.dir_ids = np.zeros(capacity, dtype=np.int32)
+        self.name_offsets = np.zeros(capacity + 1, dtype=np.int64)
+        self.flags = np.zeros(capacity, dtype=np.uint8)
+        self.sizes = np.zeros(capacity, dtype=np.int64)
+        self.mtimes = np.zeros(capacity, dtype=np.int64)
+        self.inodes = np.zeros(capacity, dtype=np.uint64)
+        self.devices = np.zeros(capacity, dtype=np.uint64)
+        self.digests = np.zeros((capacity, DIGEST_SIZE), dtype=np.uint8)
+        self.hashes = {
+            hash_type: np.zeros((capacity, self.hash_words), dtype=np.uint64)
+            for hash_type in HASH_TYPES
+        }
+
+        self._dirs: List[str] = []
+        self._dir_index: Dict[str, int] = {}
+        self._names = bytearray()
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def capacity(self) -> int:
+        return len(self.flags)
+
+    def _grow(self, capacity: int):
+        """Resize every column to a new capacity"""
+        def resized(array, rows):
+            grown = np.zeros((rows,) + array.shape[1:], dtype=array.dtype)
+            grown[:len(array)] = array
+            return grown
+
+        self.dir_ids = resized(self.dir_ids, capacity)
+        self.name_offsets = resized(self.name_offsets, capacity + 1)
+        self.flags = resized(self.flags, capacity)
+        self.sizes = resized(self.sizes, capacity)
+        self.mtimes = resized(self.mtimes, capacity)
+        self.inodes = resized(self.inodes, capacity)
+        self.devices = resized(self.devices, capacity)
+        self.digests = resized(self.digests, capacity)
+        self.hashes = {hash_type: resized(block, capacity) for hash_type, block in self.hashes.items()}
+
+    def intern_dir(self, directory: str) -> int:
+        """Get the id of a directory, adding it to the table if new"""
+        dir_id = self._dir_index.get(directory)
+        if dir_id is None:
+            dir_id = len(self._dirs)
+            self._dirs.append(directory)
+            self._dir_index[directory] = dir_id
+        return dir_id
+
+    def add(self, file_path: Path, st: Optional[os.stat_result] = None) -> int:
+        """Append a file and return its row index"""
+        directory, name = os.path.split(os.fspath(file_path))
+        encoded = os.fsencode(name)
+        with self._lock:
+            row = self._size
+            if row >= self.capacity:
+                self._grow(self.capacity * 2)
+            self.dir_ids[row] = self.intern_dir(directory)
+            self._names += encoded
+            self.name_offsets[row + 1] = len(self._names)
+            if st is not None:
+                self.set_stat(row, st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev)
+            self._size = row + 1
+        return row
+
+    def path(self, row: int) -> Path:
+        """Reconstruct the path of a row"""
+        start, end = self.name_offsets[row], self.name_offsets[row + 1]
+        name = os.fsdecode(bytes(self._names[start:end]))
+        return Path(self._dirs[self.dir_ids[row]], name)
+
+    def set_stat(self, row: int, size: int, mtime_ns: int, inode: int, device: int):
+        """Record the stat fields later stages need (size buckets, cache keys)"""
+        with self._lock:
+            self.sizes[row] = size
+            self.mtimes[row] = mtime_ns
+            self.inodes[row] = inode
+            self.devices[row] = device
+            self.flags[row] |= HAS_STAT
+
+    def stat_key(self, row: int) -> Optional[Tuple[int, int, int, int]]:
+        """(device, inode, size, mtime_ns) of a row, as used by the hash cache"""
+        if not self.flags[row] & HAS_STAT:
+            return None
+        return (int(self.devices[row]), int(self.inodes[row]), int(self.sizes[row]), int(self.mtimes[row]))
+
+    def device_of(self, row: int) -> Optional[int]:
+        """Device id of a row's file, if the scan recorded it"""
+        if not self.flags[row] & HAS_STAT:
+            return None
+        return int(self.devices[row])
+
+    def has_flag(self, row: int, flag: int) -> bool:
+        return bool(self.flags[row] & flag)
+
+    def set_flag(self, row: int, flag: int, value: bool = True):
+        with self._lock:
+            if value:
+                self.flags[row] |= flag
+            else:
+                self.flags[row] &= ~np.uint8(flag)
+
+    def digest(self, row: int) -> bytes:
+        """Raw content digest of a row (empty if unknown)"""
+        if not self.flags[row] & HAS_DIGEST:
+            return b""
+        return self.digests[row].tobytes()
+
+    def set_digest(self, row: int, digest: bytes):
+        with self._lock:
+            if digest:
+                self.digests[row] = np.frombuffer(digest[:DIGEST_SIZE].ljust(DIGEST_SIZE, b"\0"), dtype=np.uint8)
+            self.set_flag(row, HAS_DIGEST, bool(digest))
+
+    def pack_words(self, packed_hash: bytes) -> np.ndarray:
+        """Convert an MSB-first packed hash into uint64 words"""
+        padded = packed_hash.ljust(self.hash_words * 8, b"\0")
+        return np.frombuffer(padded, dtype='>u8').astype(np.uint64)
+
+    def unpack_words(self, words: np.ndarray) -> bytes:
+        """Convert uint64 words back into an MSB-first packed hash"""
+        return words.astype('>u8').tobytes()[:self.hash_bytes]
+
+    def hash_bytes_of(self, row: int) -> Dict[str, bytes]:
+        """Packed perceptual hashes of a row (empty if the image could not be hashed)"""
+        if not self.flags[row] & HAS_HASHES:
+            return {}
+        return {hash_type: self.unpack_words(block[row]) for hash_type, block in self.hashes.items()}
+
+    def set_hash_bytes(self, row: int, hashes: Dict[str, bytes]):
+        with self._lock:
+            if hashes:
+                for hash_type, block in self.hashes.items():
+                    block[row] = self.pack_words(hashes[hash_type])
+            self.set_flag(row, HAS_HASHES, bool(hashes))
+
+    def memory_bytes(self) -> int:
+        """Approximate memory held by the catalog"""
+        arrays = [self.dir_ids, self.name_offsets, self.flags, self.sizes, self.mtimes, self.inodes,
+                  self.devices, self.digests] + list(self.hashes.values())
+        return (sum(array.nbytes for array in arrays) + len(self._names)
+                + sum(len(d) + 49 for d in self._dirs))
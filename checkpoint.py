@@ -0,0 +1,158 @@
+"""
+Run checkpoints for Automatic Image Sync
+Append-only logs of hashed files and comparison progress, so interrupted runs can resume
+"""
+
+import hashlib
+import os
+import struct
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from hash_cache import default_cache_path
+
+
+MAGIC = b"AISCKPT1"
+
+# Record: kind (1 byte) and payload length, then the payload
+RECORD_HEADER = struct.Struct("<cI")
+HASHED = b"H"
+COMPARED = b"C"
+
+# Hashed file: dev, ino, size, mtime_ns, catalog flags, digest, hash bytes length,
+# skip reason length; followed by the hash bytes, the reason and the path
+HASHED_FIELDS = struct.Struct("<QQqqB16sHH")
+# Comparison unit: comparison key, unit number; followed by int64 first and second rows
+COMPARED_FIELDS = struct.Struct("<16sI")
+
+
+def default_checkpoint_dir() -> Path:
+    """Checkpoints live next to the hash cache"""
+    return default_cache_path().parent / "checkpoints"
+
+
+def run_key(*parts) -> str:
+    """Name for the checkpoint of a run with these inputs and settings"""
+    return hashlib.blake2b(repr(parts).encode("utf-8", "surrogateescape"), digest_size=16).hexdigest()
+
+
+def comparison_key(vectors: np.ndarray, valid: np.ndarray, radius: int, settings: str = "") -> bytes:
+    """Identify a comparison by exactly what it compares, and how"""
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(np.ascontiguousarray(vectors).tobytes())
+    hasher.update(np.ascontiguousarray(valid).tobytes())
+    hasher.update(f"{radius};{settings}".encode())
+    return hasher.digest()
+
+
+class RunCheckpoint:
+    """Append-only checkpoint of one run's hashing and comparison progress
+
+    hashed maps a path to (stat key, catalog flags, digest, hash bytes, skip reason)
+    for every file hashed so far; compared maps a comparison key to the pairs found
+    by each finished HammingIndex.pairs unit. Records are only ever appended
+    (a later record for the same path wins) and fsynced every sync_interval
+    seconds, so writing a checkpoint costs the size of what changed. A record cut
+    off by a crash is dropped when the file is read back.
+    """
+
+    def __init__(self, path, resume: bool = False, sync_interval: float = 30.0):
+        self.path = Path(path)
+        self.sync_interval = sync_interval
+        self.hashed: Dict[str, Tuple[Tuple[int, int, int, int], int, bytes, bytes, str]] = {}
+        self.compared: Dict[bytes, Dict[int, Tuple[np.ndarray, np.ndarray]]] = {}
+        self.restored = 0
+        self._lock = threading.Lock()
+        self._last_sync = time.monotonic()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if resume and self.path.exists():
+            self._replay()
+            self._file = open(self.path, "ab")
+        else:
+            self._file = open(self.path, "wb")
+            self._file.write(MAGIC)
+            self.sync()
+
+    def _replay(self):
+        with open(self.path, "rb") as f:
+            data = f.read()
+        if not data.startswith(MAGIC):
+            raise ValueError(f"Not a checkpoint file: {self.path}")
+        view = memoryview(data)
+        offset = len(MAGIC)
+        while offset + RECORD_HEADER.size <= len(data):
+            kind, length = RECORD_HEADER.unpack_from(data, offset)
+            end = offset + RECORD_HEADER.size + length
+            if end > len(data):
+                break
+            payload = view[offset + RECORD_HEADER.size:end]
+            if kind == HASHED:
+                self._read_hashed(payload)
+            elif kind == COMPARED:
+                self._read_compared(payload)
+            offset = end
+        if offset < len(data):
+            os.truncate(self.path, offset)
+
+    def _read_hashed(self, payload: memoryview):
+        dev, ino, size, mtime_ns, flags, digest, hash_length, reason_length = HASHED_FIELDS.unpack_from(payload)
+        start = HASHED_FIELDS.size
+        hash_bytes = bytes(payload[start:start + hash_length])
+        start += hash_length
+        reason = bytes(payload[start:start + reason_length]).decode("utf-8", "replace")
+        path = os.fsdecode(bytes(payload[start + reason_length:]))
+        self.hashed[path] = ((dev, ino, size, mtime_ns), flags, digest, hash_bytes, reason)
+
+    def _read_compared(self, payload: memoryview):
+        key, unit = COMPARED_FIELDS.unpack_from(payload)
+        rows = np.frombuffer(payload[COMPARED_FIELDS.size:], dtype="<i8").astype(np.int64)
+        half = len(rows) // 2
+        self.compared.setdefault(key, {})[unit] = (rows[:half], rows[half:])
+
+    def _append(self, kind: bytes, payload: bytes):
+        with self._lock:
+            self._file.write(RECORD_HEADER.pack(kind, len(payload)))
+            self._file.write(payload)
+            if time.monotonic() - self._last_sync >= self.sync_interval:
+                self._sync_locked()
+
+    def add_hashed(self, path: str, key: Tuple[int, int, int, int], flags: int, digest: bytes,
+                   hash_bytes: bytes, reason: str = ""):
+        """Record what is known about a file"""
+        encoded_reason = reason.encode("utf-8")
+        self._append(HASHED, HASHED_FIELDS.pack(*key, flags, digest, len(hash_bytes), len(encoded_reason))
+                     + hash_bytes + encoded_reason + os.fsencode(path))
+
+    def add_compared(self, comparison: bytes, unit: int, first: np.ndarray, second: np.ndarray):
+        """Record the pairs found by one finished comparison unit"""
+        rows = np.concatenate([first, second]).astype("<i8")
+        self._append(COMPARED, COMPARED_FIELDS.pack(comparison, unit) + rows.tobytes())
+
+    def _sync_locked(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._last_sync = time.monotonic()
+
+    def sync(self):
+        """Write buffered records to disk"""
+        with self._lock:
+            self._sync_locked()
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._sync_locked()
+                self._file.close()
+
+    def discard(self):
+        """Close and delete the checkpoint once the run no longer needs it"""
+        self.close()
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
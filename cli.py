@@ -6,8 +6,13 @@ For systems where GUI is not available
 
 import sys
 import argparse
+import multiprocessing
 from pathlib import Path
 from image_processor import ImageSynchronizer
+from config import PERFORMANCE
+from folder_watch import WatchSession
+from placement import MODES as PLACEMENT_MODES
+from placement_plan import PlacementPlan, journal_path_for
 
 
 def progress_callback(value, message=""):
@@ -23,23 +28,37 @@ def status_callback(message):
     print(f"\n📍 {message}")
 
 
-def main():
-    """Main command-line interface"""
-    parser = argparse.ArgumentParser(description='Automatic Image Synchronizer - Command Line')
+SUBCOMMANDS = ('plan', 'apply', 'watch')
+
+
+def add_sync_options(parser):
+    """Options shared by the one-step command and 'plan'"""
     parser.add_argument('folder1', help='First image folder path')
     parser.add_argument('folder2', help='Second image folder path')
     parser.add_argument('output', help='Output folder path')
-    parser.add_argument('--threshold', type=float, default=0.85,
-                       help='Similarity threshold (0.0-1.0, default: 0.85)')
+    parser.add_argument('--threshold', type=float, default=None,
+                       help='Similarity threshold (0.0-1.0, default: from config.py, normally 0.85); '
+                            'higher thresholds compare faster')
+    parser.add_argument('--workers', type=int, default=None,
+                       help='Number of hashing workers (default: CPU count)')
+    parser.add_argument('--executor', choices=ImageSynchronizer.EXECUTORS, default=None,
+                       help="Hashing executor: 'thread' or 'process' (default: from config.py)")
+    parser.add_argument('--exact-only', action='store_true',
+                       help='Only group byte-identical files (skips perceptual hashing)')
+    parser.add_argument('--mode', choices=PLACEMENT_MODES, default=None,
+                       help="How files reach the output folder (default: from config.py, normally 'move')")
+    parser.add_argument('--link-duplicates', action='store_true', default=None,
+                       help='Keep one copy of each set of exact duplicates and hard-link the others to it')
+    parser.add_argument('--resume', action='store_true',
+                       help='Continue an interrupted run without redoing checkpointed hashing and comparisons')
+    parser.add_argument('--metrics', default=None, metavar='FILE',
+                       help='Write per-stage counters and latency histograms to FILE as JSON at the end')
     parser.add_argument('--verbose', '-v', action='store_true',
                        help='Enable verbose output')
-    
-    args = parser.parse_args()
-    
-    print("🖼️  Automatic Image Sync - Command Line")
-    print("=" * 50)
-    
-    # Validate paths
+
+
+def create_synchronizer(args):
+    """Validate the folders, print the settings and create the synchronizer"""
     folder1 = Path(args.folder1)
     folder2 = Path(args.folder2)
     output = Path(args.output)
@@ -59,50 +78,255 @@ def main():
     print(f"📁 Folder 1: {folder1.absolute()}")
     print(f"📁 Folder 2: {folder2.absolute()}")
     print(f"📁 Output: {output.absolute()}")
-    print(f"🎯 Similarity threshold: {args.threshold}")
-    print()
+    if args.threshold is not None and not 0.0 <= args.threshold <= 1.0:
+        print("❌ Error: Similarity threshold must be between 0.0 and 1.0")
+        sys.exit(1)
     
-    # Create synchronizer
     synchronizer = ImageSynchronizer(
         progress_callback=progress_callback,
-        status_callback=status_callback
+        status_callback=status_callback,
+        max_workers=args.workers,
+        executor=args.executor,
+        exact_only=args.exact_only,
+        placement_mode=args.mode,
+        link_duplicates=args.link_duplicates,
+        resume=args.resume,
+        threshold=args.threshold
     )
+    if args.exact_only:
+        print("🎯 Exact duplicates only")
+    else:
+        print(f"🎯 Similarity threshold: {synchronizer.threshold}")
+    print(f"⚙️  Workers: {synchronizer.max_workers} ({synchronizer.executor} pool)")
+    links = ", exact duplicates hard-linked" if synchronizer.link_duplicates else ""
+    print(f"📦 Placement: {synchronizer.placement_mode}{links}")
+    print()
+    return synchronizer, folder1, folder2, output
+
+
+def save_metrics(synchronizer, path):
+    """Write the run's metrics as JSON if a path was given"""
+    if not path:
+        return
+    try:
+        synchronizer.metrics.save(path)
+        print(f"\n📈 Metrics written to {path}")
+    except OSError as e:
+        print(f"\n⚠️  Could not write metrics to {path}: {e}")
+
+
+def print_results(stats, synchronizer, verbose=False):
+    """Print the statistics of a completed run"""
+    print("\n" + "=" * 50)
+    print("✅ SYNCHRONIZATION COMPLETED SUCCESSFULLY!")
+    print("=" * 50)
+    
+    if "error" in stats:
+        print(f"❌ Error: {stats.get('message', 'Unknown error')}")
+        sys.exit(1)
+    
+    if "cancelled" in stats:
+        print("⚠️  Synchronization was cancelled")
+        sys.exit(0)
+    
+    # Display results
+    print(f"\n📊 Results Summary:")
+    print(f"  • Similar image groups created: {stats.get('similar_groups', 0)}")
+    verb = "moved" if synchronizer.placement_mode == 'move' else "placed"
+    print(f"  • Unique images {verb}: {stats.get('unique_images', 0)}")
+    print(f"  • Total images processed: {stats.get('total_processed', 0)}")
+    print(f"  • Errors encountered: {stats.get('errors', 0)}")
+    if stats.get('library_matches', 0) > 0:
+        print(f"  • Matched to images already in the output folder: {stats['library_matches']}")
+    if stats.get('skipped', 0) > 0:
+        print(f"  • Oversized images not hashed: {stats['skipped']}")
+        if verbose:
+            for path, reason in synchronizer.skipped:
+                print(f"      {path}: {reason}")
+    
+    print(f"\n📁 Output structure:")
+    print(f"  • Similar images: folders named 'similar_[context]'")
+    print(f"  • Unique images: 'unique_images' folder")
+    
+    if stats.get('errors', 0) > 0:
+        print(f"\n⚠️  {stats['errors']} errors occurred during processing")
+    
+    print(f"\n🎉 Image organization completed successfully!")
+
+
+def plan_command(argv):
+    """'plan': scan, hash and group, then save the operations without touching any file"""
+    parser = argparse.ArgumentParser(prog='cli.py plan',
+                                     description='Decide where every image goes and save it as a plan')
+    add_sync_options(parser)
+    parser.add_argument('plan', help='Plan file to write')
+    args = parser.parse_args(argv)
+    
+    print("🖼️  Automatic Image Sync - Plan")
+    print("=" * 50)
+    synchronizer, folder1, folder2, output = create_synchronizer(args)
+    
+    try:
+        plan = synchronizer.plan_images(folder1, folder2, output)
+    except KeyboardInterrupt:
+        print("\n\n⚠️  Operation cancelled by user; add --resume to continue later")
+        save_metrics(synchronizer, args.metrics)
+        sys.exit(0)
+    save_metrics(synchronizer, args.metrics)
+    if isinstance(plan, dict):
+        print(f"\n❌ {plan.get('message', 'Planning was cancelled')}")
+        sys.exit(1 if "error" in plan else 0)
+    
+    plan.save(args.plan)
+    linked = sum(1 for operation in plan.operations if operation[3] is not None)
+    print(f"\n\n📝 Plan written to {args.plan}")
+    print(f"  • Files to place ({plan.mode}): {len(plan)}")
+    print(f"  • Similar image groups: {plan.similar_groups}")
+    print(f"  • Unique images: {sum(plan.unique)}")
+    if linked:
+        print(f"  • Exact duplicates to hard-link: {linked}")
+    if args.verbose:
+        for source, destination, _, _ in plan.operations:
+            print(f"      {source} -> {destination}")
+    print(f"\nRun 'python cli.py apply {args.plan}' to carry it out")
+
+
+def apply_command(argv):
+    """'apply': carry out a saved plan, resuming or rolling back with its journal"""
+    parser = argparse.ArgumentParser(prog='cli.py apply', description='Carry out a saved plan')
+    parser.add_argument('plan', help='Plan file written by "cli.py plan"')
+    parser.add_argument('--journal', default=None,
+                       help='Operation journal (default: the plan path + ".journal")')
+    parser.add_argument('--rollback', action='store_true',
+                       help='Undo the operations recorded in the journal instead')
+    parser.add_argument('--metrics', default=None, metavar='FILE',
+                       help='Write per-stage counters and latency histograms to FILE as JSON at the end')
+    args = parser.parse_args(argv)
+    
+    plan = PlacementPlan.load(args.plan)
+    journal = args.journal or journal_path_for(args.plan)
+    synchronizer = ImageSynchronizer(progress_callback=progress_callback, status_callback=status_callback,
+                                     placement_mode=plan.mode)
+    
+    try:
+        if args.rollback:
+            if not Path(journal).exists():
+                print(f"❌ Error: No journal at {journal}; nothing to roll back")
+                sys.exit(1)
+            stats = synchronizer.rollback_plan(plan, journal)
+            print(f"\n\n↩️  Rolled back {stats['rolled_back']} operations, {stats['errors']} errors")
+            sys.exit(1 if stats['errors'] else 0)
+        if Path(journal).exists():
+            print(f"📒 Resuming from {journal}")
+        stats = synchronizer.apply_plan(plan, journal)
+    except KeyboardInterrupt:
+        synchronizer.stop()
+        print(f"\n\n⚠️  Interrupted; run the same command again to resume")
+        save_metrics(synchronizer, args.metrics)
+        sys.exit(0)
+    save_metrics(synchronizer, args.metrics)
+    print_results(stats, synchronizer)
+
+
+def watch_command(argv):
+    """'watch': place new images from the source folders as they arrive, until interrupted"""
+    parser = argparse.ArgumentParser(prog='cli.py watch',
+                                     description='Keep the output folder in sync as images arrive')
+    parser.add_argument('folder1', help='First image folder path')
+    parser.add_argument('folder2', help='Second image folder path')
+    parser.add_argument('output', help='Output folder path')
+    parser.add_argument('--threshold', type=float, default=None,
+                       help='Similarity threshold (0.0-1.0, default: from config.py, normally 0.85)')
+    parser.add_argument('--workers', type=int, default=None,
+                       help='Number of hashing workers (default: CPU count)')
+    parser.add_argument('--executor', choices=ImageSynchronizer.EXECUTORS, default=None,
+                       help="Hashing executor: 'thread' or 'process' (default: from config.py)")
+    parser.add_argument('--mode', choices=PLACEMENT_MODES, default=None,
+                       help="How files reach the output folder (default: from config.py, normally 'move')")
+    parser.add_argument('--poll', action='store_true',
+                       help='List the folders periodically instead of using file system events')
+    parser.add_argument('--catch-up', action='store_true',
+                       help='Also place the images already in the source folders')
+    parser.add_argument('--metrics', default=None, metavar='FILE',
+                       help='Write per-stage counters and latency histograms to FILE as JSON on exit')
+    parser.add_argument('--metrics-port', type=int, default=PERFORMANCE.get('METRICS_PORT'), metavar='PORT',
+                       help='Serve Prometheus metrics at http://127.0.0.1:PORT/metrics while watching '
+                            '(default: from config.py, normally off)')
+    args = parser.parse_args(argv)
+    args.exact_only = False
+    args.link_duplicates = False
+    args.resume = False
+    
+    print("🖼️  Automatic Image Sync - Watch")
+    print("=" * 50)
+    synchronizer, folder1, folder2, output = create_synchronizer(args)
+    for folder in (folder1, folder2):
+        if folder.resolve() in output.resolve().parents:
+            print("❌ Error: Output folder must not be inside an input folder")
+            sys.exit(1)
+    
+    server = None
+    if args.metrics_port:
+        try:
+            server = synchronizer.metrics.serve(args.metrics_port)
+            print(f"📈 Metrics at http://127.0.0.1:{server.server_address[1]}/metrics")
+        except OSError as e:
+            print(f"⚠️  Metrics server disabled: {e}")
+    
+    session = WatchSession(synchronizer, [folder1, folder2], output, polling=args.poll, catch_up=args.catch_up)
+    try:
+        session.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if server is not None:
+            server.shutdown()
+    stats = session.stats
+    print(f"\n\n👋 Stopped watching")
+    print(f"  • Images placed: {stats['placed']} ({stats['grouped']} into groups, "
+          f"{stats['unique_images']} unique)")
+    print(f"  • New similar groups: {stats['new_groups']}")
+    if stats['placed']:
+        print(f"  • Latency: {stats['latency_total'] / stats['placed'] * 1000:.0f} ms average, "
+              f"{stats['latency_max'] * 1000:.0f} ms worst")
+    print(f"  • Errors encountered: {stats['errors']}")
+    save_metrics(synchronizer, args.metrics)
+
+
+def main():
+    """Main command-line interface"""
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        commands = {'plan': plan_command, 'apply': apply_command, 'watch': watch_command}
+        commands[sys.argv[1]](sys.argv[2:])
+        return
+    
+    parser = argparse.ArgumentParser(
+        description='Automatic Image Synchronizer - Command Line',
+        epilog="Also: 'cli.py plan ... PLAN_FILE' saves the operations for review, "
+               "'cli.py apply PLAN_FILE' carries them out, "
+               "'cli.py watch FOLDER1 FOLDER2 OUTPUT' places new images as they arrive.")
+    add_sync_options(parser)
+    
+    args = parser.parse_args()
+    
+    print("🖼️  Automatic Image Sync - Command Line")
+    print("=" * 50)
+    
+    # Validate paths and create synchronizer
+    synchronizer, folder1, folder2, output = create_synchronizer(args)
     
     try:
         # Run synchronization
         print("🚀 Starting image synchronization...")
         stats = synchronizer.organize_images(folder1, folder2, output)
-        
-        print("\n" + "=" * 50)
-        print("✅ SYNCHRONIZATION COMPLETED SUCCESSFULLY!")
-        print("=" * 50)
-        
-        if "error" in stats:
-            print(f"❌ Error: {stats.get('message', 'Unknown error')}")
-            sys.exit(1)
-        
-        if "cancelled" in stats:
-            print("⚠️  Synchronization was cancelled")
-            sys.exit(0)
-        
-        # Display results
-        print(f"\n📊 Results Summary:")
-        print(f"  • Similar image groups created: {stats.get('similar_groups', 0)}")
-        print(f"  • Unique images moved: {stats.get('unique_images', 0)}")
-        print(f"  • Total images processed: {stats.get('total_processed', 0)}")
-        print(f"  • Errors encountered: {stats.get('errors', 0)}")
-        
-        print(f"\n📁 Output structure:")
-        print(f"  • Similar images: folders named 'similar_[context]'")
-        print(f"  • Unique images: 'unique_images' folder")
-        
-        if stats.get('errors', 0) > 0:
-            print(f"\n⚠️  {stats['errors']} errors occurred during processing")
-        
-        print(f"\n🎉 Image organization completed successfully!")
+        save_metrics(synchronizer, args.metrics)
+        print_results(stats, synchronizer, args.verbose)
         
     except KeyboardInterrupt:
+        save_metrics(synchronizer, args.metrics)
         print("\n\n⚠️  Operation cancelled by user")
+        print("   Add --resume to continue hashing and comparison, or if files were being placed,")
+        print(f"   run 'python cli.py apply {output / ImageSynchronizer.STATE_FOLDER / 'plan.json.gz'}'")
         sys.exit(0)
     except Exception as e:
         print(f"\n\n❌ Error: {e}")
@@ -110,4 +334,5 @@ def main():
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     main()
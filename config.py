@@ -8,8 +8,24 @@ IMAGE_PROCESSING = {
     # Hash size for perceptual hashing (higher = more accurate but slower)
     'HASH_SIZE': 16,
     
-    # Maximum number of worker threads for parallel processing
-    'MAX_WORKERS': 4,
+    # Number of hashing workers (None = os.cpu_count())
+    'MAX_WORKERS': None,
+    
+    # Threads listing directories per source folder (I/O bound, helps most on network storage)
+    'SCAN_WORKERS': 8,
+    
+    # Threads moving files into the output folder (spread across destination folders)
+    'PLACEMENT_WORKERS': 8,
+    
+    # How files reach the output folder: 'move', 'copy', 'hardlink', 'reflink' (copy-on-write
+    # clone, copies where unsupported) or 'symlink'
+    'PLACEMENT_MODE': 'move',
+    
+    # Keep one physical copy of each set of exact duplicates and hard-link the others to it
+    'LINK_DUPLICATES': False,
+    
+    # Hashing executor: 'thread' or 'process' (process pool avoids the GIL)
+    'EXECUTOR': 'thread',
     
     # Default similarity threshold (0.0 - 1.0)
     'DEFAULT_SIMILARITY_THRESHOLD': 0.85,
@@ -17,8 +33,24 @@ IMAGE_PROCESSING = {
     # Supported image file extensions
     'SUPPORTED_FORMATS': {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.tif', '.gif', '.webp'},
     
+    # Decode JPEGs at reduced resolution (DCT scaling) when the hash size allows it
+    'REDUCED_DECODE': True,
+    
+    # Content digest for exact duplicates: 'blake2b', 'md5', 'xxh3' (needs xxhash) or 'auto'
+    'DIGEST_ALGORITHM': 'auto',
+    
     # Maximum file size to process (in MB, 0 = no limit)
     'MAX_FILE_SIZE_MB': 0,
+    
+    # Maximum decoded image size (megapixels, read from the header; 0 = no limit)
+    'MAX_IMAGE_MEGAPIXELS': 100,
+    
+    # Images over either limit: 'skip', 'reduce' (JPEGs decode at reduced scale,
+    # other formats use the lane) or 'lane' (full decode, few at a time)
+    'OVERSIZED_IMAGES': 'reduce',
+    
+    # Concurrent decodes in the oversized-image lane
+    'OVERSIZED_WORKERS': 1,
 }
 
 # GUI Settings
@@ -69,12 +101,42 @@ PERFORMANCE = {
     # Cache hash calculations to speed up repeated operations
     'ENABLE_HASH_CACHE': True,
     
-    # Maximum memory usage for image processing (MB)
+    # Location of the hash cache database (None = ~/.cache/automatic_image_sync/hash_cache.sqlite3)
+    'HASH_CACHE_PATH': None,
+    
+    # Checkpoint hashing and comparison progress so an interrupted run can be resumed
+    'ENABLE_CHECKPOINTS': True,
+    
+    # Folder for checkpoints (None = ~/.cache/automatic_image_sync/checkpoints)
+    'CHECKPOINT_DIR': None,
+    
+    # Seconds between checkpoint flushes to disk
+    'CHECKPOINT_INTERVAL': 30,
+    
+    # Watch mode: seconds a new file's size and mtime must stay unchanged before it is hashed
+    'WATCH_SETTLE_SECONDS': 0.25,
+    
+    # Watch mode: seconds an empty file must stay empty before it is handled (it may not be written yet)
+    'WATCH_EMPTY_SECONDS': 5,
+    
+    # Watch mode: seconds between folder listings where file events are unavailable
+    'WATCH_POLL_SECONDS': 1.0,
+    
+    # Watch mode: seconds between writes of newly placed images to the output library index
+    'WATCH_FLUSH_SECONDS': 10,
+    
+    # Watch mode: serve Prometheus metrics on this local port at /metrics (None = off)
+    'METRICS_PORT': None,
+    
+    # Maximum memory for images being decoded at once, estimated from image headers (MB)
     'MAX_MEMORY_MB': 1024,
     
-    # Batch size for processing large image collections
+    # Maximum number of images submitted to hashing workers at once
     'BATCH_SIZE': 100,
     
+    # Threads reading image headers ahead of submission to the hashing workers
+    'HEADER_WORKERS': 4,
+    
     # Enable memory optimization for large collections
     'MEMORY_OPTIMIZATION': True,
 }
@@ -92,10 +154,17 @@ ALGORITHM_SETTINGS = {
     # Minimum number of hash matches required for similarity
     'MIN_HASH_MATCHES': 2,
     
+    # Share of similar pairs that large comparisons must find when thresholds are too low for an exact
+    # index (around 0.9 and below). The default 1.0 compares every pair and finds them all. Below 1,
+    # candidates come from random bit samples instead, and pairs at the threshold are each missed
+    # with probability 1 - INDEX_RECALL, which can split a group.
+    'INDEX_RECALL': 1.0,
+    
     # Use exact file hash comparison first (much faster)
     'USE_EXACT_HASH_FIRST': True,
     
-    # Enable enhanced similarity detection for rotated/flipped images
+    # Enable enhanced similarity detection for rotated/flipped images (hashes each image in a
+    # canonical orientation; a few near-duplicates with no clear orientation may be missed)
     'DETECT_TRANSFORMATIONS': False,
 }
 
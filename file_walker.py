@@ -0,0 +1,110 @@
+"""
+Parallel directory walker for Automatic Image Sync
+Lists directory trees with os.scandir on a thread pool, yielding matching files with their stat data
+"""
+
+import os
+import queue
+import stat
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional, Set, Tuple
+
+
+# Files are handed over in batches so a directory with 500k entries streams
+# out while it is still being listed
+ENTRY_BATCH_SIZE = 1024
+RESULT_QUEUE_SIZE = 64
+
+
+def scan_directory(directory: str, suffixes: Set[str], on_subdir, on_batch, stop_event=None):
+    """List one directory: report subdirectories and batches of matching regular files
+
+    The suffix is checked on the entry name before anything else is done with
+    it. Symlinked directories are not followed, symlinked files are.
+    """
+    batch: List[Tuple[str, os.stat_result]] = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if stop_event is not None and stop_event.is_set():
+                    break
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        on_subdir(entry.path)
+                        continue
+                    if os.path.splitext(entry.name)[1].lower() not in suffixes:
+                        continue
+                    st = entry.stat()
+                    if not st.st_ino:
+                        # Windows scandir leaves inode and device empty; the hash cache needs them
+                        st = os.stat(entry.path)
+                except OSError:
+                    continue
+                if stat.S_ISREG(st.st_mode):
+                    batch.append((entry.path, st))
+                    if len(batch) >= ENTRY_BATCH_SIZE:
+                        on_batch(batch)
+                        batch = []
+    except OSError:
+        pass
+    if batch:
+        on_batch(batch)
+
+
+def walk_files(root, suffixes: Set[str], max_workers: int = 8,
+               stop_event: Optional[threading.Event] = None) -> Iterator[Tuple[str, os.stat_result]]:
+    """Yield (path, stat) for every regular file below root with one of the suffixes
+
+    Every subdirectory is listed as its own task on a thread pool, so wide and
+    deep trees on network storage are listed concurrently. Order is not stable.
+    """
+    root = os.fspath(root)
+    if not os.path.isdir(root):
+        return
+
+    results: queue.Queue = queue.Queue(maxsize=RESULT_QUEUE_SIZE)
+    done = object()
+    closed = threading.Event()
+    outstanding = 0
+    lock = threading.Lock()
+
+    def offer(item) -> bool:
+        while not closed.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="scan") as executor:
+        def submit(directory: str):
+            nonlocal outstanding
+            if closed.is_set():
+                return
+            with lock:
+                outstanding += 1
+            executor.submit(run, directory)
+
+        def run(directory: str):
+            nonlocal outstanding
+            try:
+                if not closed.is_set():
+                    scan_directory(directory, suffixes, submit, offer, stop_event)
+            finally:
+                with lock:
+                    outstanding -= 1
+                    finished = outstanding == 0
+                if finished:
+                    offer(done)
+
+        submit(root)
+        try:
+            while True:
+                item = results.get()
+                if item is done:
+                    break
+                yield from item
+        finally:
+            closed.set()
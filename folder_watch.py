@@ -0,0 +1,488 @@
+"""
+Folder watching for Automatic Image Sync
+Places images as they arrive in the source folders instead of re-running a whole batch
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from config import IMAGE_PROCESSING, PERFORMANCE
+from file_walker import walk_files
+from image_processor import ImageData, ImageProcessor, ImageSynchronizer, hash_files_packed
+from placement import PlacementEngine
+
+
+# inotify(7) event bits
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC if hasattr(os, 'O_CLOEXEC') else 0
+
+WATCH_MASK = IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVE_SELF | IN_ONLYDIR
+# struct inotify_event: wd, mask, cookie, name length; followed by the name
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def _libc():
+    """The C library, if it has inotify (Linux only)"""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    except OSError:
+        return None
+    return libc if hasattr(libc, "inotify_init1") else None
+
+
+class InotifyWatcher:
+    """Reports files created, written or moved into a set of folders (Linux inotify)
+
+    Every folder below the roots gets a watch; folders created later are watched
+    and listed as they appear. If the kernel event queue overflows, the roots are
+    listed again.
+    """
+
+    def __init__(self, roots: List[Path], suffixes: Set[str]):
+        libc = _libc()
+        if libc is None:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self._libc = libc
+        self.roots = [os.path.abspath(os.fspath(root)) for root in roots]
+        self.suffixes = suffixes
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._dirs: Dict[int, str] = {}
+        self._found: List[str] = []
+        try:
+            for root in self.roots:
+                self._watch_tree(root, report=False)
+        except OSError:
+            self.close()
+            raise
+
+    def _wanted(self, path: str) -> bool:
+        return os.path.splitext(path)[1].lower() in self.suffixes
+
+    def _watch(self, directory: str) -> bool:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                raise OSError(error, "Out of inotify watches (raise fs.inotify.max_user_watches)")
+            return False
+        self._dirs[wd] = directory
+        return True
+
+    def _watch_tree(self, root: str, report: bool):
+        # Watch a folder before listing it, so nothing created in between is missed
+        stack = [root]
+        while stack:
+            directory = stack.pop()
+            if not self._watch(directory):
+                continue
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif report and self._wanted(entry.name):
+                            self._found.append(entry.path)
+            except OSError:
+                pass
+
+    def poll(self, timeout: float) -> List[str]:
+        """Paths of files with events, waiting up to timeout seconds for the first"""
+        found, self._found = self._found, []
+        ready, _, _ = select.select([self.fd], [], [], 0 if found else timeout)
+        if not ready:
+            return found
+        while True:
+            try:
+                data = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset + EVENT_HEADER.size <= len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0")
+                offset += EVENT_HEADER.size + length
+                if mask & IN_Q_OVERFLOW:
+                    found.extend(self.rescan())
+                    continue
+                if mask & (IN_IGNORED | IN_MOVE_SELF):
+                    # The folder is gone or was renamed; its new location reports IN_MOVED_TO
+                    if wd in self._dirs and not mask & IN_IGNORED:
+                        self._libc.inotify_rm_watch(self.fd, wd)
+                    self._dirs.pop(wd, None)
+                    continue
+                directory = self._dirs.get(wd)
+                if directory is None or not name:
+                    continue
+                path = os.path.join(directory, os.fsdecode(name))
+                if mask & IN_ISDIR:
+                    self._watch_tree(path, report=True)
+                elif self._wanted(path):
+                    found.append(path)
+        found.extend(self._found)
+        self._found = []
+        return found
+
+    def rescan(self) -> List[str]:
+        """Every matching file below the roots"""
+        return [path for root in self.roots for path, _ in walk_files(root, self.suffixes)]
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PollingWatcher:
+    """Finds new and changed files by listing the folders every interval seconds"""
+
+    def __init__(self, roots: List[Path], suffixes: Set[str], interval: float = 1.0, scan_workers: int = 8):
+        self.roots = [os.path.abspath(os.fspath(root)) for root in roots]
+        self.suffixes = suffixes
+        self.interval = interval
+        self.scan_workers = scan_workers
+        self._snapshot = self._scan()
+        self._next_scan = time.monotonic() + interval
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        return {path: (st.st_size, st.st_mtime_ns)
+                for root in self.roots
+                for path, st in walk_files(root, self.suffixes, self.scan_workers)}
+
+    def poll(self, timeout: float) -> List[str]:
+        """Paths that are new or changed since the last listing, waiting up to timeout seconds"""
+        wait_time = self._next_scan - time.monotonic()
+        if wait_time > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(0.0, wait_time))
+        snapshot = self._scan()
+        self._next_scan = time.monotonic() + self.interval
+        changed = [path for path, signature in snapshot.items() if self._snapshot.get(path) != signature]
+        self._snapshot = snapshot
+        return changed
+
+    def rescan(self) -> List[str]:
+        return list(self._snapshot)
+
+    def close(self):
+        pass
+
+
+def open_watcher(roots: List[Path], suffixes: Set[str], polling: bool = False):
+    """An inotify watcher where available, else a polling one"""
+    if not polling:
+        try:
+            return InotifyWatcher(roots, suffixes)
+        except OSError as e:
+            if e.errno != errno.ENOSYS:
+                print(f"File events unavailable, polling instead: {e}")
+    return PollingWatcher(roots, suffixes, PERFORMANCE.get('WATCH_POLL_SECONDS', 1.0),
+                          IMAGE_PROCESSING.get('SCAN_WORKERS', 8))
+
+
+class Debouncer:
+    """Holds files back until their size and mtime have not changed for settle seconds
+
+    Empty files are held for at least empty_wait seconds after they were first
+    seen, since a writer may have created a file without writing to it yet.
+    """
+
+    def __init__(self, settle: float = 0.25, empty_wait: float = 5.0):
+        self.settle = settle
+        self.empty_wait = empty_wait
+        # path -> (size, mtime_ns) when last checked, time of that check, time first seen
+        self._pending: Dict[str, Tuple[Tuple[int, int], float, float]] = {}
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def offer(self, path: str, now: Optional[float] = None):
+        """Start (or restart) waiting for a file to settle"""
+        now = time.monotonic() if now is None else now
+        try:
+            st = os.stat(path)
+        except OSError:
+            self._pending.pop(path, None)
+            return
+        first_seen = self._pending[path][2] if path in self._pending else now
+        self._pending[path] = ((st.st_size, st.st_mtime_ns), now, first_seen)
+
+    def ready(self, now: Optional[float] = None) -> List[Tuple[str, os.stat_result, float]]:
+        """Files that stayed unchanged for settle seconds, with their stat and first-seen time"""
+        now = time.monotonic() if now is None else now
+        settled = []
+        for path, (signature, checked, first_seen) in list(self._pending.items()):
+            if now - checked < self.settle:
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                del self._pending[path]
+                continue
+            current = (st.st_size, st.st_mtime_ns)
+            if current == signature and (st.st_size > 0 or now - first_seen >= self.empty_wait):
+                del self._pending[path]
+                settled.append((path, st, first_seen))
+            else:
+                self._pending[path] = (current, now, first_seen)
+        return settled
+
+
+class WatchSession:
+    """Places images from two source folders into an output folder as they arrive
+
+    The hashing pool stays up for the whole session, and the hashes of every file
+    in the output folder (read from its library index, then kept up to date) are
+    held in memory, so a new file costs one decode and one cascaded popcount pass
+    over the library. Placement follows the batch rules: a file similar to one in
+    a similar_* folder joins that folder, a file similar to ones in unique_images
+    starts a new group with them, anything else goes to unique_images. New
+    entries reach the library index every PERFORMANCE['WATCH_FLUSH_SECONDS'].
+    Files already in the source folders are left alone unless catch_up is set.
+    Where placing keeps the source (every mode but move), a placed source is
+    not placed again while its size and mtime are unchanged.
+    """
+
+    def __init__(self, synchronizer: ImageSynchronizer, folders: List[Path], output_folder: Path,
+                 threshold: Optional[float] = None, polling: bool = False, catch_up: bool = False):
+        self.synchronizer = synchronizer
+        self.folders = [Path(folder) for folder in folders]
+        self.output_folder = Path(os.path.abspath(output_folder))
+        self.threshold = synchronizer.threshold if threshold is None else threshold
+        self.polling = polling
+        self.catch_up = catch_up
+        self.stats = {"placed": 0, "grouped": 0, "new_groups": 0, "unique_images": 0,
+                      "skipped": 0, "errors": 0, "latency_total": 0.0, "latency_max": 0.0}
+
+        self.library = synchronizer.open_library(self.output_folder)
+        self.unique_folder = self.output_folder / "unique_images"
+        self.engine = PlacementEngine(IMAGE_PROCESSING.get('PLACEMENT_WORKERS', 8), None, synchronizer.placement_mode)
+        self._load_library()
+        try:
+            with os.scandir(self.output_folder) as entries:
+                self._taken = {entry.name.casefold() for entry in entries}
+        except OSError:
+            self._taken = set()
+        # Library moves not yet saved, and when new entries were last written
+        self._dirty = False
+        self._last_flush = time.monotonic()
+        # Source path -> (size, mtime_ns) it was placed with, for sources that stay
+        self.placed_sources: Dict[str, Tuple[int, int]] = {}
+
+    def _load_library(self):
+        """Copy the library's vectors and paths into growable in-memory arrays"""
+        library = self.library
+        hash_words = library.hash_words
+        segments = library.segments if library.compatible else []
+        size = sum(segment["size"] for segment in segments)
+        capacity = max(1024, 2 * size)
+        self.vectors = np.zeros((capacity, hash_words), dtype=np.uint64)
+        self.valid = np.zeros(capacity, dtype=bool)
+        self.paths: List[str] = []
+        for segment in segments:
+            name = segment["name"]
+            start = len(self.paths)
+            self.vectors[start:start + segment["size"]] = library.vectors(name)
+            self.valid[start:start + segment["size"]] = np.load(library.directory / f"{name}.valid.npy")
+            self.paths.extend(library.path(entry) for entry in range(start, start + segment["size"]))
+        self.flushed = len(self.paths)
+        self.cascade = ImageProcessor.similarity_cascade(self.threshold)
+        # Segments this session writes get query tables for its threshold
+        self.library.cascade = self.cascade
+
+    def _append(self, vector: np.ndarray, valid: bool, path: str):
+        size = len(self.paths)
+        if size >= len(self.valid):
+            self.vectors = np.concatenate([self.vectors, np.zeros_like(self.vectors)])
+            self.valid = np.concatenate([self.valid, np.zeros_like(self.valid)])
+        self.vectors[size] = vector
+        self.valid[size] = valid
+        self.paths.append(path)
+
+    def matches(self, vector: np.ndarray) -> List[int]:
+        """Similar entries whose files are still in the output folder"""
+        size = len(self.paths)
+        if not size:
+            return []
+        _, hits = self.cascade.verify_block(vector[None, :], self.vectors[:size], self.valid[None, :size])
+        return [entry for entry in hits.tolist()
+                if os.path.lexists(self.output_folder / self.paths[entry])]
+
+    def _group_folder(self, name: str) -> Path:
+        safe_name = "".join(c for c in name if c.isalnum() or c in (' ', '-', '_')).strip()
+        folder, suffix = f"similar_{safe_name}", 1
+        while folder.casefold() in self._taken:
+            suffix += 1
+            folder = f"similar_{safe_name}_{suffix}"
+        self._taken.add(folder.casefold())
+        return self.output_folder / folder
+
+    def _relative(self, path: str) -> str:
+        return os.path.relpath(path, self.output_folder)
+
+    def place(self, img: ImageData, first_seen: float):
+        """Decide where a hashed image goes and put it there"""
+        synchronizer = self.synchronizer
+        vectors, valid = synchronizer.hash_vectors(np.array([img.row], dtype=np.int64))
+        entries = self.matches(vectors[0]) if valid[0] else []
+
+        folders = {entry: self.output_folder / Path(self.paths[entry]).parts[0] for entry in entries}
+        grouped = [entry for entry in entries if folders[entry] != self.unique_folder]
+        relocations: Dict[int, int] = {}
+        if grouped:
+            folder = folders[grouped[0]]
+        elif entries:
+            context = ImageProcessor.extract_image_context(Path(self.paths[entries[0]]))
+            folder = self._group_folder(context or img.context or "group")
+            self.stats["new_groups"] += 1
+        else:
+            folder = self.unique_folder
+        for entry in entries:
+            if folders[entry] == self.unique_folder:
+                index = self.engine.add(self.output_folder / self.paths[entry], folder, relocate=True)
+                relocations[index] = entry
+        index = self.engine.add(img.file_path, folder, synchronizer.catalog.device_of(img.row))
+
+        metrics = synchronizer.metrics
+        errors = self.engine.run(indices=list(relocations) + [index])
+        for op, error in errors.items():
+            print(f"Error placing {self.engine.operations[op][0]}: {error}")
+            self.stats["errors"] += 1
+        metrics.inc('errors', 'place', len(errors))
+        metrics.inc('files_placed', 'place', sum(self.engine.placed[op] for op in relocations))
+        for op, entry in relocations.items():
+            if self.engine.placed[op]:
+                old_path, new_path = self.paths[entry], self._relative(self.engine.operations[op][1])
+                self.paths[entry] = new_path
+                if entry < self.flushed:
+                    self.library.relocate(entry, old_path, new_path)
+                    self._dirty = True
+        if not self.engine.placed[index]:
+            return
+        if synchronizer.placement_mode != 'move':
+            catalog = synchronizer.catalog
+            self.placed_sources[os.fspath(img.file_path)] = (int(catalog.sizes[img.row]),
+                                                             int(catalog.mtimes[img.row]))
+
+        self._append(vectors[0], bool(valid[0]), self._relative(self.engine.operations[index][1]))
+        latency = time.monotonic() - first_seen
+        metrics.inc('files_placed', 'place')
+        metrics.observe('placement_latency_seconds', 'watch', latency)
+        self.stats["placed"] += 1
+        self.stats["grouped" if folder != self.unique_folder else "unique_images"] += 1
+        self.stats["latency_total"] += latency
+        self.stats["latency_max"] = max(self.stats["latency_max"], latency)
+        synchronizer.update_status(f"{img.file_path.name} -> {folder.name} ({latency * 1000:.0f} ms)")
+
+    def flush(self):
+        """Write new entries and moves to the library index"""
+        if len(self.paths) > self.flushed:
+            self.library.add(self.paths[self.flushed:], self.vectors[self.flushed:len(self.paths)],
+                             self.valid[self.flushed:len(self.paths)])
+            self.flushed = len(self.paths)
+        elif self._dirty:
+            self.library.save()
+        self._dirty = False
+        self._last_flush = time.monotonic()
+
+    def run(self):
+        """Watch until the synchronizer is stopped (or interrupted), then flush the library"""
+        synchronizer = self.synchronizer
+        metrics = synchronizer.metrics
+        stop = synchronizer.stop_processing
+        settle = PERFORMANCE.get('WATCH_SETTLE_SECONDS', 0.25)
+        flush_interval = PERFORMANCE.get('WATCH_FLUSH_SECONDS', 10)
+        debouncer = Debouncer(settle, PERFORMANCE.get('WATCH_EMPTY_SECONDS', 5))
+        retried: Set[str] = set()
+        in_flight: Dict[Future, Tuple[ImageData, float]] = {}
+
+        pool_type = ProcessPoolExecutor if synchronizer.executor == 'process' else ThreadPoolExecutor
+        pool = pool_type(max_workers=synchronizer.max_workers)
+        # Oversized images that still need a full decode get their own small lane, as in a batch run
+        lane = ThreadPoolExecutor(max_workers=IMAGE_PROCESSING.get('OVERSIZED_WORKERS', 1),
+                                  thread_name_prefix="oversized")
+        watcher = open_watcher(self.folders, ImageProcessor.SUPPORTED_FORMATS, self.polling)
+        try:
+            # Start the workers now rather than on the first file
+            wait([pool.submit(os.getpid) for _ in range(synchronizer.max_workers)])
+            kind = f"polling every {watcher.interval:g} s" if isinstance(watcher, PollingWatcher) else "inotify"
+            synchronizer.update_status(f"Watching {len(self.folders)} folders ({kind}); "
+                                       f"{len(self.paths)} images in the output library")
+            if self.catch_up:
+                for path in watcher.rescan():
+                    debouncer.offer(path)
+
+            while not stop.is_set():
+                busy = in_flight or len(debouncer)
+                for path in watcher.poll(min(settle / 2, 0.05) if busy else 0.5):
+                    debouncer.offer(path)
+
+                for path, st, first_seen in debouncer.ready():
+                    if self.placed_sources.get(path) == (st.st_size, st.st_mtime_ns):
+                        continue  # e.g. opened for writing and closed again, unchanged
+                    if path not in retried:
+                        metrics.inc('files_scanned', 'scan')
+                    img = ImageData(catalog=synchronizer.catalog, row=synchronizer.catalog.add(Path(path), st))
+                    action, _, reason = ImageProcessor.check_image(img.file_path, st.st_size)
+                    if action == 'skip':
+                        synchronizer.skip_image(img, reason)
+                        self.stats["skipped"] += 1
+                        self.place(img, first_seen)
+                        continue
+                    executor = lane if action == 'lane' else pool
+                    future = executor.submit(hash_files_packed, [path], False, True if action == 'reduce' else None)
+                    in_flight[future] = (img, first_seen)
+
+                if in_flight:
+                    done, _ = wait(in_flight, timeout=0, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        img, first_seen = in_flight.pop(future)
+                        try:
+                            _, _, packed_hashes, timings, bytes_read = future.result()[0]
+                        except Exception as e:
+                            packed_hashes, timings, bytes_read = b"", {}, 0
+                            print(f"Error hashing {img.file_path}: {e}")
+                        path = os.fspath(img.file_path)
+                        if not packed_hashes and path not in retried:
+                            # Possibly still being written; give it one more settle period
+                            retried.add(path)
+                            debouncer.offer(path)
+                            continue
+                        metrics.record_hashed(bytes_read, timings, bool(packed_hashes))
+                        retried.discard(path)
+                        img.apply_packed(b"", packed_hashes)
+                        self.place(img, first_seen)
+
+                if time.monotonic() - self._last_flush >= flush_interval:
+                    self.flush()
+        finally:
+            for future in in_flight:
+                future.cancel()
+            pool.shutdown(wait=True)
+            lane.shutdown(wait=True)
+            watcher.close()
+            self.flush()
+        return self.stats
@@ -0,0 +1,51 @@
+"""
+Vectorized Hamming-distance kernels for Automatic Image Sync
+Compares packed uint64 hash arrays with XOR + popcount instead of per-bit Python loops
+"""
+
+from typing import Dict
+
+import numpy as np
+
+
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def popcount(words: np.ndarray) -> np.ndarray:
+    """Number of set bits in each uint64 element"""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words)
+    # NumPy < 2.0: look up every byte of each word
+    as_bytes = np.ascontiguousarray(words).view(np.uint8).reshape(words.shape + (8,))
+    return _POPCOUNT_TABLE[as_bytes].sum(axis=-1, dtype=np.uint8)
+
+
+def distances_to_many(query: np.ndarray, block: np.ndarray) -> np.ndarray:
+    """Hamming distance from one hash (words,) to every row of a (rows, words) block"""
+    return popcount(np.bitwise_xor(block, query)).sum(axis=-1, dtype=np.int32)
+
+
+def distances_between(block_a: np.ndarray, block_b: np.ndarray) -> np.ndarray:
+    """Hamming distance matrix (rows_a, rows_b) between two blocks of hashes"""
+    xor = np.bitwise_xor(block_a[:, None, :], block_b[None, :, :])
+    return popcount(xor).sum(axis=-1, dtype=np.int32)
+
+
+def similarity_scores(query: Dict[str, np.ndarray], blocks: Dict[str, np.ndarray], bits: int) -> np.ndarray:
+    """Average similarity (0-1) between one image's hashes and many rows
+
+    query maps each hash type to a (words,) array, blocks map the same hash types
+    to (rows, words) arrays; bits is the number of bits per hash.
+    """
+    total = None
+    for hash_type, words in query.items():
+        distances = distances_to_many(words, blocks[hash_type])
+        total = distances if total is None else total + distances
+    return 1.0 - total / (bits * len(query))
+
+
+def hex_to_words(hex_hash: str) -> np.ndarray:
+    """Convert an imagehash hex string into uint64 words, MSB-first"""
+    raw = int(hex_hash, 16).to_bytes((len(hex_hash) * 4 + 7) // 8, 'big')
+    padded = raw.ljust((len(raw) + 7) // 8 * 8, b"\0")
+    return np.frombuffer(padded, dtype='>u8').astype(np.uint64)
@@ -0,0 +1,156 @@
+"""
+Persistent hash cache for Automatic Image Sync
+Stores file digests and perceptual hashes in SQLite so unchanged files are not re-hashed
+"""
+
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+
+HASH_TYPES = ('ahash', 'phash', 'dhash', 'whash')
+
+
+def default_cache_path() -> Path:
+    """Get the default location of the hash cache database"""
+    base = os.environ.get('XDG_CACHE_HOME') or (Path.home() / ".cache")
+    return Path(base) / "automatic_image_sync" / "hash_cache.sqlite3"
+
+
+class HashCache:
+    """SQLite (WAL mode) cache of file digests and perceptual hashes
+
+    Entries are keyed by (device, inode, size, mtime_ns) so an unchanged file is
+    found without reading it. The content digest is indexed as a fallback key,
+    which lets renamed or copied files reuse their perceptual hashes. Every entry
+    is stamped with a version string; entries from another version are dropped.
+    Either value may be missing: digests are only computed for files whose size
+    collides with another file, and perceptual hashes are skipped in exact-only runs.
+    """
+
+    SCHEMA_VERSION = 2
+    COMMIT_INTERVAL = 500
+
+    def __init__(self, db_path: Path, version: str):
+        self.db_path = Path(db_path)
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._pending = 0
+
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        if self._conn.execute("PRAGMA user_version").fetchone()[0] != self.SCHEMA_VERSION:
+            self._conn.execute("DROP TABLE IF EXISTS hashes")
+            self._conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS hashes ("
+            " dev INTEGER NOT NULL, ino INTEGER NOT NULL,"
+            " size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL,"
+            " version TEXT NOT NULL, file_hash BLOB NOT NULL, image_hashes BLOB,"
+            " PRIMARY KEY (dev, ino, size, mtime_ns))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS hashes_file_hash ON hashes (file_hash)")
+        self._conn.commit()
+
+        # Invalidate entries written with another algorithm or hash size. Lookups
+        # filter on the version too, so this can wait if another run holds the lock.
+        try:
+            self._conn.execute("DELETE FROM hashes WHERE version != ?", (self.version,))
+            self._conn.commit()
+        except sqlite3.OperationalError:
+            self._conn.rollback()
+
+    @staticmethod
+    def stat_key(st: os.stat_result) -> Tuple[int, int, int, int]:
+        """Build the primary cache key from a stat result"""
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    @staticmethod
+    def pack_hashes(image_hashes: Dict[str, str]) -> bytes:
+        """Pack a hex hash dict into one blob (empty blob = image could not be decoded)"""
+        if not image_hashes:
+            return b""
+        return b"".join(bytes.fromhex(image_hashes[hash_type]) for hash_type in HASH_TYPES)
+
+    @staticmethod
+    def unpack_hashes(blob: bytes) -> Dict[str, str]:
+        """Unpack a blob written by pack_hashes"""
+        if not blob:
+            return {}
+        width = len(blob) // len(HASH_TYPES)
+        return {
+            hash_type: blob[i * width:(i + 1) * width].hex()
+            for i, hash_type in enumerate(HASH_TYPES)
+        }
+
+    def get(self, key: Tuple[int, int, int, int]) -> Optional[Tuple[bytes, Optional[Dict[str, str]]]]:
+        """Look up (raw digest, image_hashes) for an unchanged file
+
+        The digest is b"" and image_hashes None when that value was never computed.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT file_hash, image_hashes FROM hashes"
+                " WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ? AND version = ?",
+                tuple(key) + (self.version,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        image_hashes = None if row[1] is None else self.unpack_hashes(bytes(row[1]))
+        return bytes(row[0]), image_hashes
+
+    def get_by_digest(self, digest: bytes) -> Optional[Dict[str, str]]:
+        """Look up perceptual hashes of a file with the same content digest"""
+        if not digest:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT image_hashes FROM hashes"
+                " WHERE file_hash = ? AND version = ? AND image_hashes IS NOT NULL LIMIT 1",
+                (digest, self.version)
+            ).fetchone()
+        if row is None:
+            return None
+        return self.unpack_hashes(bytes(row[0]))
+
+    def put(self, key: Tuple[int, int, int, int], digest: bytes = b"",
+            image_hashes: Optional[Dict[str, str]] = None):
+        """Store what is known about a file, keeping earlier values; commits are batched"""
+        if not digest and image_hashes is None:
+            return
+        packed = None if image_hashes is None else self.pack_hashes(image_hashes)
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (dev, ino, size, mtime_ns) DO UPDATE SET"
+                " file_hash = CASE WHEN excluded.file_hash != x'' OR version != excluded.version"
+                "   THEN excluded.file_hash ELSE file_hash END,"
+                " image_hashes = CASE WHEN version != excluded.version"
+                "   THEN excluded.image_hashes ELSE COALESCE(excluded.image_hashes, image_hashes) END,"
+                " version = excluded.version",
+                tuple(key) + (self.version, digest, packed)
+            )
+            self._pending += 1
+            if self._pending >= self.COMMIT_INTERVAL:
+                self._conn.commit()
+                self._pending = 0
+
+    def flush(self):
+        """Commit pending writes"""
+        with self._lock:
+            self._conn.commit()
+            self._pending = 0
+
+    def close(self):
+        """Commit pending writes and close the database"""
+        self.flush()
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,271 @@
+"""
+Multi-hash kernel for Automatic Image Sync
+Computes average, perceptual, difference and wavelet hashes from a single decode
+"""
+
+import time
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import pywt
+import scipy.fftpack
+import imagehash
+from PIL import Image
+
+
+HASH_TYPES = ('ahash', 'phash', 'dhash', 'whash')
+PHASH_HIGHFREQ_FACTOR = 4
+DRAFT_OVERSAMPLING = 2  # decode at least this many times the largest small buffer
+RESAMPLE = Image.LANCZOS  # what imagehash calls ANTIALIAS
+
+# Bytes per pixel of decoded Pillow modes; anything else is assumed to be 4
+MODE_BYTES = {'1': 1, 'L': 1, 'P': 1, 'LA': 2, 'PA': 2, 'I;16': 2, 'I;16B': 2, 'I;16L': 2,
+              'RGB': 3, 'YCbCr': 3, 'LAB': 3, 'HSV': 3, 'RGBA': 4, 'RGBX': 4, 'CMYK': 4, 'I': 4, 'F': 4}
+
+
+def draft_size(hash_size: int) -> int:
+    """Shortest side a reduced decode must keep for the given hash size"""
+    return hash_size * PHASH_HIGHFREQ_FACTOR * DRAFT_OVERSAMPLING
+
+
+def reduce_decode(image: Image.Image, hash_size: int) -> Image.Image:
+    """Let the decoder downscale in the DCT domain and emit luminance directly
+
+    Only JPEG supports this (Image.draft); other formats are left untouched.
+    Must be called before the image data is loaded.
+    """
+    target = draft_size(hash_size)
+    if image.format == 'JPEG' and min(image.size) >= 2 * target:
+        image.draft('L', (target, target))
+    return image
+
+
+def decoded_size(size: Tuple[int, int], image_format: str, hash_size: int, reduced_decode: bool) -> Tuple[int, int]:
+    """Dimensions the decoder will produce, following reduce_decode's rules"""
+    width, height = size
+    target = draft_size(hash_size)
+    if reduced_decode and image_format == 'JPEG' and min(size) >= 2 * target:
+        scale = 1
+        while scale < 8 and min(width, height) // (scale * 2) >= target:
+            scale *= 2
+        width, height = -(-width // scale), -(-height // scale)
+    return width, height
+
+
+def estimate_peak_bytes(size: Tuple[int, int], mode: str, image_format: str, hash_size: int,
+                        reduced_decode: bool = False) -> int:
+    """Estimate the memory compute_hashes needs for an image, from its header alone
+
+    Counts the decoded image, the luminance plane (and the RGB intermediate for
+    other modes) and the wavelet buffer, which are alive at the same time.
+    """
+    width, height = decoded_size(size, image_format, hash_size, reduced_decode)
+    pixels = width * height
+    if reduced_decode and (width, height) != tuple(size):
+        return pixels + whash_scale((width, height), hash_size) ** 2  # draft decodes straight to L
+    total = pixels * MODE_BYTES.get(mode, 4)
+    if mode not in ('L', 'RGB'):
+        total += pixels * 3
+    if mode != 'L':
+        total += pixels
+    return total + whash_scale((width, height), hash_size) ** 2
+
+
+def to_luminance(image: Image.Image) -> Image.Image:
+    """Convert an image to 8-bit luminance once
+
+    Modes other than L and RGB go through RGB first, matching the RGB conversion
+    that get_image_hashes historically did before hashing.
+    """
+    if image.mode == 'L':
+        return image
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return image.convert('L')
+
+
+def whash_scale(size, hash_size: int) -> int:
+    """Side of the square buffer the wavelet hash works on (largest power of 2 that fits)"""
+    image_natural_scale = 2 ** int(np.log2(min(size)))
+    return max(image_natural_scale, hash_size)
+
+
+def build_pyramid(gray: Image.Image, hash_size: int) -> Dict[str, np.ndarray]:
+    """Resample the luminance plane to the buffer each hash needs
+
+    Every level is resampled from the full luminance plane rather than chained
+    from the previous level: Lanczos is not composable, and chaining would break
+    bit-parity with imagehash.
+    """
+    phash_size = hash_size * PHASH_HIGHFREQ_FACTOR
+    scale = whash_scale(gray.size, hash_size)
+    return {
+        'ahash': np.asarray(gray.resize((hash_size, hash_size), RESAMPLE)),
+        'dhash': np.asarray(gray.resize((hash_size + 1, hash_size), RESAMPLE)),
+        'phash': np.asarray(gray.resize((phash_size, phash_size), RESAMPLE)),
+        'whash': np.asarray(gray.resize((scale, scale), RESAMPLE)),
+    }
+
+
+def hash_bits(pyramid: Dict[str, np.ndarray], hash_size: int) -> Dict[str, np.ndarray]:
+    """Compute the boolean bit matrix of every hash type from the shared buffers"""
+    pixels = pyramid['ahash']
+    ahash = pixels > np.mean(pixels)
+
+    pixels = pyramid['dhash']
+    dhash = pixels[:, 1:] > pixels[:, :-1]
+
+    dct_low = phash_dct(pyramid['phash'])[:hash_size, :hash_size]
+    phash = dct_low > np.median(dct_low)
+
+    whash = wavelet_bits(pyramid['whash'], hash_size)
+
+    return {'ahash': ahash, 'phash': phash, 'dhash': dhash, 'whash': whash}
+
+
+def phash_dct(pixels: np.ndarray) -> np.ndarray:
+    """2-D DCT-II of the phash buffer, rows (vertical frequency) first"""
+    return scipy.fftpack.dct(scipy.fftpack.dct(pixels, axis=0), axis=1)
+
+
+def canonical_transform(dct: np.ndarray) -> Tuple[bool, bool, bool]:
+    """(transpose, flip_x, flip_y) turning an image into its canonical orientation
+
+    The eight rotations and mirrors of an image are a transpose and/or flips,
+    applied in that order. Flipping left-right negates DCT coefficients of odd
+    horizontal frequency, flipping upside down those of odd vertical frequency,
+    and transposing transposes the coefficients. The canonical variant is the
+    one with the smallest key (-C[0, 1], -C[1, 0]): brighter on the left than
+    the right, on top than the bottom, and more so left-right. Every rotation
+    or mirror of an image has the same canonical variant (barring ties).
+    """
+    horizontal, vertical = dct[0, 1], dct[1, 0]
+    transpose = abs(vertical) > abs(horizontal)
+    if transpose:
+        horizontal, vertical = vertical, horizontal
+    return bool(transpose), bool(horizontal < 0), bool(vertical < 0)
+
+
+def orient(matrix: np.ndarray, transform: Tuple[bool, bool, bool]) -> np.ndarray:
+    """Rearrange a pixel or bit matrix as canonical_transform describes"""
+    transpose, flip_x, flip_y = transform
+    if transpose:
+        matrix = matrix.T
+    if flip_x:
+        matrix = matrix[:, ::-1]
+    if flip_y:
+        matrix = matrix[::-1, :]
+    return matrix
+
+
+def canonical_bits(gray: Image.Image, pyramid: Dict[str, np.ndarray], hash_size: int) -> Dict[str, np.ndarray]:
+    """Hash bits of the image turned to its canonical orientation
+
+    The variants come from the buffers already made, not from a transformed
+    image: ahash and whash bits move with the pixels (their mean and median do
+    not change), and the phash coefficients are the original ones transposed
+    and with signs flipped. Only a transposed dhash needs one more buffer,
+    since it compares vertical neighbours.
+    """
+    dct = phash_dct(pyramid['phash'])
+    transform = canonical_transform(dct)
+    transpose, flip_x, flip_y = transform
+
+    dct_low = dct[:hash_size, :hash_size]
+    if transpose:
+        dct_low = dct_low.T
+    signs = np.where(np.arange(hash_size) % 2, -1.0, 1.0)
+    if flip_x:
+        dct_low = dct_low * signs[None, :]
+    if flip_y:
+        dct_low = dct_low * signs[:, None]
+    phash = dct_low > np.median(dct_low)
+
+    pixels = pyramid['ahash']
+    ahash = orient(pixels > np.mean(pixels), transform)
+
+    if transpose:
+        pixels = np.asarray(gray.resize((hash_size, hash_size + 1), RESAMPLE)).T
+    else:
+        pixels = pyramid['dhash']
+    pixels = orient(pixels, (False, flip_x, flip_y))
+    dhash = pixels[:, 1:] > pixels[:, :-1]
+
+    whash = orient(wavelet_bits(pyramid['whash'], hash_size), transform)
+
+    return {'ahash': ahash, 'phash': phash, 'dhash': dhash, 'whash': whash}
+
+
+def wavelet_bits(pixels: np.ndarray, hash_size: int) -> np.ndarray:
+    """Haar wavelet hash bits, with an integer fast path
+
+    With the max-level LL band removed, the LL(K) band of a Haar decomposition is
+    the block means minus the global mean, scaled by a positive constant. Comparing
+    exact integer block sums against their median therefore gives the same bits as
+    the floating-point decomposition, unless a block ties with the median; only
+    then is pywt run, so results stay bit-identical to imagehash.
+    """
+    block = pixels.shape[0] // hash_size
+    sums = pixels.reshape(hash_size, block, hash_size, block).sum(axis=(1, 3), dtype=np.int64)
+    med = np.median(sums)
+    if not np.any(sums == med):
+        return sums > med
+
+    pixels = pixels / 255.
+    ll_max_level = int(np.log2(pixels.shape[0]))
+    dwt_level = ll_max_level - int(np.log2(hash_size))
+    # Remove the lowest frequency LL(max) band, as imagehash does by default
+    coeffs = list(pywt.wavedec2(pixels, 'haar', level=ll_max_level))
+    coeffs[0] *= 0
+    pixels = pywt.waverec2(coeffs, 'haar')
+    dwt_low = pywt.wavedec2(pixels, 'haar', level=dwt_level)[0]
+    return dwt_low > np.median(dwt_low)
+
+
+def pack_bits(bits: np.ndarray) -> bytes:
+    """Pack a bit matrix MSB-first, the same layout as an imagehash hex string"""
+    return np.packbits(bits.ravel()).tobytes()
+
+
+def reducible(image_format: str) -> bool:
+    """Whether the decoder can produce a downscaled image without a full decode"""
+    return image_format == 'JPEG'
+
+
+def compute_hashes(image: Image.Image, hash_size: int, reduced_decode: bool = False,
+                   canonical: bool = False, timings: Optional[Dict[str, float]] = None) -> Dict[str, bytes]:
+    """Compute all four hashes of an opened image as packed bytes
+
+    With reduced_decode, JPEGs are decoded at a fraction of their resolution;
+    the hashes then drift slightly from a full decode: tests hold phash within
+    32 of 256 bits and the other types within 8 (see benchmark.py decode).
+    With canonical, the hashes are those of the image's canonical orientation
+    (see canonical_bits), so rotated and mirrored copies hash alike.
+    timings, if given, receives the seconds spent decoding ('decode') and
+    hashing the decoded pixels ('hash').
+    """
+    start = time.perf_counter()
+    if reduced_decode:
+        image = reduce_decode(image, hash_size)
+    image.load()
+    decoded = time.perf_counter()
+    gray = to_luminance(image)
+    pyramid = build_pyramid(gray, hash_size)
+    bits = canonical_bits(gray, pyramid, hash_size) if canonical else hash_bits(pyramid, hash_size)
+    hashes = {hash_type: pack_bits(bits[hash_type]) for hash_type in HASH_TYPES}
+    if timings is not None:
+        timings['decode'] = decoded - start
+        timings['hash'] = time.perf_counter() - decoded
+    return hashes
+
+
+def reference_hashes(image: Image.Image, hash_size: int) -> Dict[str, bytes]:
+    """Compute the hashes with imagehash itself, used to check kernel parity"""
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return {
+        'ahash': bytes.fromhex(str(imagehash.average_hash(image, hash_size=hash_size))),
+        'phash': bytes.fromhex(str(imagehash.phash(image, hash_size=hash_size))),
+        'dhash': bytes.fromhex(str(imagehash.dhash(image, hash_size=hash_size))),
+        'whash': bytes.fromhex(str(imagehash.whash(image, hash_size=hash_size))),
+    }
@@ -1,92 +1,194 @@
+import io
 import os
-import hashlib
-import shutil
 from pathlib import Path
 from PIL import Image
 import imagehash
 import cv2
 import numpy as np
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Dict, List, Tuple, Set
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Deque, Dict, Iterable, Iterator, List, Optional, Tuple, Set
+import queue
+from collections import deque
 import threading
 
+import hamming
+import hash_kernel
+from catalog import ImageCatalog, HASH_TYPES, PROCESSED, HAS_DIGEST, HAS_HASHES
+from similarity_index import DisjointSet, HammingIndex, SimilarityCascade, equal_row_pairs
+from config import ALGORITHM_SETTINGS, IMAGE_PROCESSING, PERFORMANCE
+from hash_cache import HashCache, default_cache_path
+from file_walker import walk_files
+from placement import MODES as PLACEMENT_MODES, PlacementEngine
+from checkpoint import RunCheckpoint, comparison_key, default_checkpoint_dir, run_key
+from library_index import LibraryIndex
+from metrics import Metrics
+import placement_plan
+from placement_plan import PlacementPlan
+import content_digest
+
 
 class ImageProcessor:
     """Fast image processing and comparison utilities"""
     
     SUPPORTED_FORMATS = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.tif', '.gif', '.webp'}
     HASH_SIZE = 16  # Increased for better accuracy
+    PARTIAL_HASH_BYTES = 64 * 1024  # Head and tail read when screening for exact duplicates
+    DIGEST_ALGORITHM = content_digest.resolve_algorithm(IMAGE_PROCESSING.get('DIGEST_ALGORITHM', 'blake2b'))
+    
+    @staticmethod
+    def hash_version() -> str:
+        """Identify the hash algorithms and settings, used to invalidate cached hashes"""
+        version = f"{ImageProcessor.DIGEST_ALGORITHM};ahash,phash,dhash,whash;size={ImageProcessor.HASH_SIZE};imagehash={imagehash.__version__}"
+        if IMAGE_PROCESSING.get('REDUCED_DECODE'):
+            version += f";draft={hash_kernel.draft_size(ImageProcessor.HASH_SIZE)}"
+        if IMAGE_PROCESSING.get('OVERSIZED_IMAGES', 'reduce') == 'reduce':
+            version += f";oversized={IMAGE_PROCESSING.get('MAX_IMAGE_MEGAPIXELS', 0)}MP"
+        if ALGORITHM_SETTINGS.get('DETECT_TRANSFORMATIONS'):
+            version += ";canonical"
+        return version
     
     @staticmethod
     def is_image_file(file_path: Path) -> bool:
         """Check if file is a supported image format"""
         return file_path.suffix.lower() in ImageProcessor.SUPPORTED_FORMATS
     
+    @staticmethod
+    def get_file_digest(file_path: Path, counts: Optional[Dict[str, int]] = None) -> bytes:
+        """Get raw content digest of file for exact duplicate detection
+        
+        counts, if given, has the bytes read added to counts['bytes_read'].
+        """
+        try:
+            return content_digest.digest_file(file_path, ImageProcessor.DIGEST_ALGORITHM, counts=counts)
+        except Exception:
+            return b""
+    
     @staticmethod
     def get_file_hash(file_path: Path) -> str:
-        """Get MD5 hash of file for exact duplicate detection"""
+        """Get content digest of file as hex"""
+        return ImageProcessor.get_file_digest(file_path).hex()
+    
+    @staticmethod
+    def get_partial_digest(file_path: Path, size: int) -> bytes:
+        """Get raw digest of the first and last PARTIAL_HASH_BYTES of a file"""
         try:
-            hash_md5 = hashlib.md5()
-            with open(file_path, "rb") as f:
-                for chunk in iter(lambda: f.read(4096), b""):
-                    hash_md5.update(chunk)
-            return hash_md5.hexdigest()
+            return content_digest.digest_head_tail(file_path, size, ImageProcessor.PARTIAL_HASH_BYTES,
+                                                   ImageProcessor.DIGEST_ALGORITHM)
         except Exception:
-            return ""
+            return b""
     
     @staticmethod
-    def get_image_hashes(file_path: Path) -> Dict[str, str]:
-        """Get multiple perceptual hashes for robust comparison"""
+    def check_image(file_path: Path, file_size: int) -> Tuple[str, int, str]:
+        """Decide how to hash an image from its file size and header alone
+        
+        Returns (action, estimated decode bytes, reason), where action is 'hash',
+        'reduce' (decode at reduced scale), 'lane' (full decode in the low-concurrency
+        lane) or 'skip'. Limits are IMAGE_PROCESSING['MAX_FILE_SIZE_MB'] and
+        ['MAX_IMAGE_MEGAPIXELS']; the policy is ['OVERSIZED_IMAGES'].
+        """
+        reduced_decode = IMAGE_PROCESSING.get('REDUCED_DECODE', False)
         try:
             with Image.open(file_path) as img:
-                # Convert to RGB if necessary
-                if img.mode != 'RGB':
-                    img = img.convert('RGB')
-                
-                return {
-                    'ahash': str(imagehash.average_hash(img, hash_size=ImageProcessor.HASH_SIZE)),
-                    'phash': str(imagehash.phash(img, hash_size=ImageProcessor.HASH_SIZE)),
-                    'dhash': str(imagehash.dhash(img, hash_size=ImageProcessor.HASH_SIZE)),
-                    'whash': str(imagehash.whash(img, hash_size=ImageProcessor.HASH_SIZE))
-                }
+                size, mode, image_format = img.size, img.mode, img.format
+        except Image.DecompressionBombError:
+            return 'skip', 0, "exceeds Pillow's decompression bomb limit"
+        except Exception:
+            return 'hash', 0, ""  # Let the decoder report it
+        
+        def estimate(reduced: bool) -> int:
+            return hash_kernel.estimate_peak_bytes(size, mode, image_format, ImageProcessor.HASH_SIZE, reduced)
+        
+        max_file_mb = IMAGE_PROCESSING.get('MAX_FILE_SIZE_MB', 0)
+        max_megapixels = IMAGE_PROCESSING.get('MAX_IMAGE_MEGAPIXELS', 0)
+        width, height = hash_kernel.decoded_size(size, image_format, ImageProcessor.HASH_SIZE, reduced_decode)
+        if max_file_mb and file_size > max_file_mb * 2 ** 20:
+            reason = f"{file_size / 2 ** 20:.0f} MB file is over the {max_file_mb} MB limit"
+        elif max_megapixels and width * height > max_megapixels * 1e6:
+            reason = f"{size[0]}x{size[1]} image is over the {max_megapixels} megapixel limit"
+        else:
+            return 'hash', estimate(reduced_decode), ""
+        
+        policy = IMAGE_PROCESSING.get('OVERSIZED_IMAGES', 'reduce')
+        if policy == 'skip':
+            return 'skip', 0, reason
+        if policy == 'reduce' and hash_kernel.reducible(image_format):
+            return 'reduce', estimate(True), reason
+        return 'lane', estimate(reduced_decode), reason
+    
+    @staticmethod
+    def get_image_hashes(file_path: Path, reduced_decode: Optional[bool] = None,
+                         timings: Optional[Dict[str, float]] = None,
+                         counts: Optional[Dict[str, int]] = None) -> Dict[str, str]:
+        """Get multiple perceptual hashes for robust comparison (single decode, shared buffers)
+        
+        With ALGORITHM_SETTINGS['DETECT_TRANSFORMATIONS'] the hashes are those of the
+        image's canonical orientation, so rotated and mirrored copies compare as similar.
+        timings, if given, receives the decode and hash times (see hash_kernel.compute_hashes);
+        counts, if given, has the bytes the decoder read added to counts['bytes_read'].
+        """
+        if reduced_decode is None:
+            reduced_decode = IMAGE_PROCESSING.get('REDUCED_DECODE', False)
+        canonical = ALGORITHM_SETTINGS.get('DETECT_TRANSFORMATIONS', False)
+        raw = None
+        try:
+            raw = content_digest.CountingFile(file_path)
+            with io.BufferedReader(raw) as f, Image.open(f) as img:
+                hashes = hash_kernel.compute_hashes(img, ImageProcessor.HASH_SIZE, reduced_decode, canonical, timings)
+                return {hash_type: value.hex() for hash_type, value in hashes.items()}
         except Exception:
             return {}
+        finally:
+            if counts is not None and raw is not None:
+                counts['bytes_read'] = counts.get('bytes_read', 0) + raw.bytes_read
     
     @staticmethod
     def calculate_hash_similarity(hash1: str, hash2: str) -> float:
         """Calculate similarity between two hashes (0-1, where 1 is identical)"""
         try:
-            # Convert hex strings to binary and calculate Hamming distance
-            bin1 = bin(int(hash1, 16))[2:].zfill(len(hash1) * 4)
-            bin2 = bin(int(hash2, 16))[2:].zfill(len(hash2) * 4)
-            
-            if len(bin1) != len(bin2):
+            if len(hash1) != len(hash2):
                 return 0.0
             
-            differences = sum(c1 != c2 for c1, c2 in zip(bin1, bin2))
-            similarity = 1.0 - (differences / len(bin1))
-            return similarity
+            # XOR + popcount over packed uint64 words
+            words1 = hamming.hex_to_words(hash1)
+            words2 = hamming.hex_to_words(hash2)
+            differences = int(hamming.distances_to_many(words1, words2[None, :])[0])
+            return 1.0 - (differences / (len(hash1) * 4))
         except Exception:
             return 0.0
     
+    @staticmethod
+    def similarity_cascade(threshold: float = 0.85, hash_types: Iterable[str] = HASH_TYPES,
+                           hash_bits: Optional[int] = None) -> SimilarityCascade:
+        """The weighted comparison set by ALGORITHM_SETTINGS['HASH_WEIGHTS'] and ['MIN_HASH_MATCHES']"""
+        hash_bits = hash_bits or ImageProcessor.HASH_SIZE * ImageProcessor.HASH_SIZE
+        return SimilarityCascade(list(hash_types), (hash_bits + 63) // 64, threshold,
+                                 ALGORITHM_SETTINGS.get('HASH_WEIGHTS'), ALGORITHM_SETTINGS.get('MIN_HASH_MATCHES', 1),
+                                 hash_bits)
+    
     @staticmethod
     def are_images_similar(hashes1: Dict[str, str], hashes2: Dict[str, str], threshold: float = 0.85) -> bool:
-        """Compare two sets of image hashes to determine similarity"""
+        """Compare two sets of image hashes to determine similarity
+        
+        Images are similar when the weighted average of the per-hash similarities
+        meets the threshold and enough hashes meet it on their own; see
+        SimilarityCascade, which usually decides after one or two hashes.
+        """
         if not hashes1 or not hashes2:
             return False
         
-        similarities = []
-        for hash_type in ['ahash', 'phash', 'dhash', 'whash']:
-            if hash_type in hashes1 and hash_type in hashes2:
-                sim = ImageProcessor.calculate_hash_similarity(hashes1[hash_type], hashes2[hash_type])
-                similarities.append(sim)
+        hash_types = [t for t in HASH_TYPES if t in hashes1 and t in hashes2]
+        if not hash_types or any(len(hashes1[t]) != len(hashes2[t]) for t in hash_types):
+            return False
         
-        if not similarities:
+        try:
+            left = np.concatenate([hamming.hex_to_words(hashes1[t]) for t in hash_types])[None, :]
+            right = np.concatenate([hamming.hex_to_words(hashes2[t]) for t in hash_types])[None, :]
+        except ValueError:
             return False
         
-        # Images are similar if average similarity exceeds threshold
-        avg_similarity = sum(similarities) / len(similarities)
-        return avg_similarity >= threshold
+        cascade = ImageProcessor.similarity_cascade(threshold, hash_types, len(hashes1[hash_types[0]]) * 4)
+        pair = np.zeros(1, dtype=np.int64)
+        return bool(cascade.verify(left, right, pair, pair)[0])
     
     @staticmethod
     def extract_image_context(file_path: Path) -> str:
@@ -108,33 +210,314 @@ class ImageProcessor:
 
 
 class ImageData:
-    """Container for image file information"""
+    """View of one image record in an ImageCatalog"""
+    
+    __slots__ = ('catalog', 'row')
+    
+    def __init__(self, file_path: Optional[Path] = None, catalog: Optional[ImageCatalog] = None,
+                 row: Optional[int] = None):
+        if catalog is None:
+            catalog = ImageCatalog(ImageProcessor.HASH_SIZE, capacity=1)
+        if row is None:
+            row = catalog.add(file_path)
+        self.catalog = catalog
+        self.row = row
+    
+    def __eq__(self, other):
+        return isinstance(other, ImageData) and self.catalog is other.catalog and self.row == other.row
+    
+    def __hash__(self):
+        return hash((id(self.catalog), self.row))
+    
+    def __repr__(self):
+        return f"ImageData({self.file_path!r})"
+    
+    @property
+    def file_path(self) -> Path:
+        return self.catalog.path(self.row)
+    
+    @property
+    def file_hash(self) -> str:
+        return self.catalog.digest(self.row).hex()
+    
+    @file_hash.setter
+    def file_hash(self, value: str):
+        self.catalog.set_digest(self.row, bytes.fromhex(value))
+    
+    @property
+    def digest(self) -> bytes:
+        return self.catalog.digest(self.row)
+    
+    @digest.setter
+    def digest(self, value: bytes):
+        self.catalog.set_digest(self.row, value)
     
-    def __init__(self, file_path: Path):
-        self.file_path = file_path
-        self.file_hash = ""
-        self.image_hashes = {}
-        self.context = ""
-        self.processed = False
+    @property
+    def image_hashes(self) -> Dict[str, str]:
+        return {hash_type: value.hex() for hash_type, value in self.catalog.hash_bytes_of(self.row).items()}
     
-    def process(self):
-        """Process image to extract hashes and context"""
+    @image_hashes.setter
+    def image_hashes(self, value: Dict[str, str]):
+        self.catalog.set_hash_bytes(self.row, {hash_type: bytes.fromhex(h) for hash_type, h in value.items()})
+    
+    @property
+    def context(self) -> str:
+        return ImageProcessor.extract_image_context(self.file_path)
+    
+    @property
+    def processed(self) -> bool:
+        return self.catalog.has_flag(self.row, PROCESSED)
+    
+    @processed.setter
+    def processed(self, value: bool):
+        self.catalog.set_flag(self.row, PROCESSED, value)
+    
+    def cache_key(self) -> Optional[Tuple[int, int, int, int]]:
+        """Hash cache key of the file, from the scan's stat data when available"""
+        key = self.catalog.stat_key(self.row)
+        if key is None:
+            try:
+                key = HashCache.stat_key(self.file_path.stat())
+            except OSError:
+                return None
+        return key
+    
+    def process(self, cache: Optional[HashCache] = None, digest: bool = True, metrics: Optional[Metrics] = None):
+        """Process image to extract hashes, consulting the hash cache first
+        
+        With digest=False the content digest is not computed here; it is kept if
+        already known (from the cache or the exact-duplicate stage).
+        """
         if self.processed:
             return
         
-        self.file_hash = ImageProcessor.get_file_hash(self.file_path)
-        self.image_hashes = ImageProcessor.get_image_hashes(self.file_path)
-        self.context = ImageProcessor.extract_image_context(self.file_path)
+        key = self.cache_key() if cache is not None else None
+        if key is not None and self.load_cached(cache, key, digest):
+            if metrics is not None:
+                metrics.inc('cache_hits', 'hash')
+            return
+        self.compute(cache, key, digest, metrics=metrics)
+    
+    def load_cached(self, cache: HashCache, key: Tuple[int, int, int, int], digest: bool = True) -> bool:
+        """Fill in what the hash cache knows; True if nothing is left to compute"""
+        entry = cache.get(key)
+        if entry is None:
+            return False
+        cached_digest, image_hashes = entry
+        if cached_digest and not self.digest:
+            self.digest = cached_digest
+        if image_hashes is not None and (self.digest or not digest):
+            self.image_hashes = image_hashes
+            self.processed = True
+            return True
+        return False
+    
+    def compute(self, cache: Optional[HashCache] = None, key: Optional[Tuple[int, int, int, int]] = None,
+                digest: bool = True, reduced_decode: Optional[bool] = None, metrics: Optional[Metrics] = None):
+        """Hash the file and store the result in the cache under key
+        
+        Bytes read, decode and hash times and failures are added to metrics, if given.
+        """
+        file_path = self.file_path
+        if digest and not self.digest:
+            counts = {'bytes_read': 0}
+            self.digest = ImageProcessor.get_file_digest(file_path, counts)
+            if metrics is not None:
+                metrics.inc('bytes_read', 'hash', counts['bytes_read'])
+        
+        # A file with the same content may have been hashed under another path
+        image_hashes = None
+        if key is not None:
+            image_hashes = cache.get_by_digest(self.digest)
+            if image_hashes is not None and metrics is not None:
+                metrics.inc('cache_hits', 'hash')
+        if image_hashes is None:
+            timings: Dict[str, float] = {}
+            counts = {'bytes_read': 0}
+            image_hashes = ImageProcessor.get_image_hashes(file_path, reduced_decode, timings, counts)
+            if metrics is not None:
+                metrics.record_hashed(counts['bytes_read'], timings, bool(image_hashes))
+        self.image_hashes = image_hashes
+        
+        if key is not None:
+            cache.put(key, self.digest, image_hashes)
+        
+        self.processed = True
+    
+    def apply_packed(self, digest: bytes, packed_hashes: bytes):
+        """Fill in results computed elsewhere (e.g. by a worker process)"""
+        if digest:
+            self.digest = digest
+        self.image_hashes = HashCache.unpack_hashes(packed_hashes)
         self.processed = True
 
 
+def hash_files_packed(paths: List[str], with_digest: bool = False,
+                      reduced_decode: Optional[bool] = None) -> List[Tuple[str, bytes, bytes, Dict[str, float], int]]:
+    """Hash a chunk of files in a worker process
+
+    Returns (path, file digest, packed perceptual hashes, decode and hash
+    timings, bytes read) tuples rather than ImageData objects so results stay
+    cheap to pickle back to the parent. The digest is empty unless with_digest
+    is set; bytes read counts both the digest and the decode.
+    """
+    results = []
+    for path in paths:
+        file_path = Path(path)
+        counts = {'bytes_read': 0}
+        digest = ImageProcessor.get_file_digest(file_path, counts) if with_digest else b""
+        timings: Dict[str, float] = {}
+        image_hashes = ImageProcessor.get_image_hashes(file_path, reduced_decode, timings, counts)
+        results.append((path, digest, HashCache.pack_hashes(image_hashes), timings, counts['bytes_read']))
+    return results
+
+
+def default_worker_count() -> int:
+    """Number of hashing workers when none is configured"""
+    return IMAGE_PROCESSING.get('MAX_WORKERS') or os.cpu_count() or 4
+
+
 class ImageSynchronizer:
     """Main class for image synchronization and organization"""
     
-    def __init__(self, progress_callback=None, status_callback=None):
+    EXECUTORS = ('thread', 'process')
+    SCAN_QUEUE_SIZE = 1024  # Discovered files waiting for a hashing worker
+    PROCESS_CHUNK_SIZE = 16  # Most files per task sent to a worker process
+    STATE_FOLDER = ".image_sync"  # In the output folder: plan and journal of the last run
+    
+    def __init__(self, progress_callback=None, status_callback=None, hash_cache: Optional[HashCache] = None,
+                 max_workers: Optional[int] = None, executor: Optional[str] = None, exact_only: bool = False,
+                 placement_mode: Optional[str] = None, link_duplicates: Optional[bool] = None,
+                 resume: bool = False, threshold: Optional[float] = None, metrics: Optional[Metrics] = None):
         self.progress_callback = progress_callback
         self.status_callback = status_callback
         self.stop_processing = threading.Event()
+        self.hash_cache = hash_cache
+        self.catalog = ImageCatalog(ImageProcessor.HASH_SIZE)
+        self.max_workers = max_workers or default_worker_count()
+        self.executor = executor or IMAGE_PROCESSING.get('EXECUTOR', 'thread')
+        self.exact_only = exact_only
+        self.placement_mode = placement_mode or IMAGE_PROCESSING.get('PLACEMENT_MODE', 'move')
+        if link_duplicates is None:
+            link_duplicates = IMAGE_PROCESSING.get('LINK_DUPLICATES', False)
+        self.link_duplicates = link_duplicates
+        self.resume = resume
+        if threshold is None:
+            threshold = IMAGE_PROCESSING.get('DEFAULT_SIMILARITY_THRESHOLD', 0.85)
+        self.threshold = threshold
+        self.checkpoint: Optional[RunCheckpoint] = None
+        self.exact_stats: Dict[str, int] = {}
+        self.comparison_stats: Dict[str, int] = {}
+        self.skipped: List[Tuple[Path, str]] = []
+        self.metrics = metrics or Metrics()
+        if self.executor not in self.EXECUTORS:
+            raise ValueError(f"Unknown executor '{self.executor}', expected one of {self.EXECUTORS}")
+        if self.placement_mode not in PLACEMENT_MODES:
+            raise ValueError(f"Unknown placement mode '{self.placement_mode}', expected one of {PLACEMENT_MODES}")
+        if not 0.0 <= self.threshold <= 1.0:
+            raise ValueError(f"Similarity threshold must be between 0 and 1, got {self.threshold}")
+    
+    def open_hash_cache(self) -> Optional[HashCache]:
+        """Open the default persistent hash cache if enabled in config"""
+        if self.hash_cache is None and PERFORMANCE.get('ENABLE_HASH_CACHE'):
+            cache_path = PERFORMANCE.get('HASH_CACHE_PATH') or default_cache_path()
+            try:
+                self.hash_cache = HashCache(cache_path, ImageProcessor.hash_version())
+            except Exception as e:
+                print(f"Hash cache disabled: {e}")
+        return self.hash_cache
+    
+    def open_checkpoint(self, folder1: Path, folder2: Path) -> Optional[RunCheckpoint]:
+        """Open the checkpoint of a run over these folders with the current settings
+        
+        Without resume an existing checkpoint is started over.
+        """
+        if not PERFORMANCE.get('ENABLE_CHECKPOINTS'):
+            return None
+        directory = Path(PERFORMANCE.get('CHECKPOINT_DIR') or default_checkpoint_dir())
+        key = run_key(os.path.abspath(folder1), os.path.abspath(folder2), ImageProcessor.hash_version(), self.exact_only)
+        try:
+            self.checkpoint = RunCheckpoint(directory / f"{key}.ckpt", self.resume,
+                                            PERFORMANCE.get('CHECKPOINT_INTERVAL', 30))
+        except Exception as e:
+            print(f"Checkpoints disabled: {e}")
+            self.checkpoint = None
+        return self.checkpoint
+    
+    def checkpoint_image(self, img: ImageData, reason: str = ""):
+        """Append what is known about an image to the checkpoint"""
+        catalog = self.catalog
+        key = catalog.stat_key(img.row)
+        if self.checkpoint is None or key is None:
+            return
+        flags = int(catalog.flags[img.row]) & (PROCESSED | HAS_DIGEST | HAS_HASHES)
+        hash_bytes = b"".join(catalog.hash_bytes_of(img.row).values())
+        self.checkpoint.add_hashed(str(img.file_path), key, flags, catalog.digest(img.row), hash_bytes, reason)
+    
+    def restore_checkpointed(self, images: Iterable[ImageData]) -> Iterator[ImageData]:
+        """Pass images on, filling in results the checkpoint holds for unchanged files"""
+        checkpoint = self.checkpoint
+        catalog = self.catalog
+        for img in images:
+            entry = checkpoint.hashed.get(str(img.file_path))
+            if entry is not None and entry[0] == catalog.stat_key(img.row):
+                _, flags, digest, hash_bytes, reason = entry
+                if flags & HAS_DIGEST:
+                    img.digest = digest
+                if flags & PROCESSED:
+                    width = len(hash_bytes) // len(HASH_TYPES)
+                    catalog.set_hash_bytes(img.row, {
+                        hash_type: hash_bytes[i * width:(i + 1) * width] for i, hash_type in enumerate(HASH_TYPES)
+                    } if hash_bytes else {})
+                    img.processed = True
+                    if reason:
+                        self.skipped.append((img.file_path, reason))
+                checkpoint.restored += 1
+            yield img
+    
+    def open_library(self, output_folder: Path) -> LibraryIndex:
+        """The library index kept in an output folder (empty if there is none yet)
+        
+        New segments get query tables for this synchronizer's threshold.
+        """
+        return LibraryIndex(Path(output_folder) / self.STATE_FOLDER / "library", ImageProcessor.hash_version(),
+                            len(HASH_TYPES) * self.catalog.hash_words,
+                            ImageProcessor.similarity_cascade(self.threshold),
+                            ALGORITHM_SETTINGS.get('INDEX_RECALL', 1.0))
+    
+    def hash_vectors(self, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """All four hashes of each row concatenated, and whether the row has them"""
+        catalog = self.catalog
+        vectors = np.hstack([catalog.hashes[hash_type][rows] for hash_type in HASH_TYPES])
+        return vectors, (catalog.flags[rows] & HAS_HASHES) != 0
+    
+    def match_library(self, library: LibraryIndex, images: List[ImageData], output_folder: Path,
+                      threshold: Optional[float] = None) -> Dict[int, List[int]]:
+        """Library entries similar to each image, by catalog row
+        
+        Only the new images are hashed and queried; entries whose file is no
+        longer in the output folder are ignored. threshold defaults to self.threshold.
+        """
+        if not len(library) or not images:
+            return {}
+        self.update_status(f"Matching {len(images)} new images against {len(library)} in the library...")
+        rows = np.fromiter((img.row for img in images), dtype=np.int64, count=len(images))
+        vectors, valid = self.hash_vectors(rows)
+        queried = np.flatnonzero(valid)
+        cascade = ImageProcessor.similarity_cascade(self.threshold if threshold is None else threshold)
+        with self.metrics.timed('library'):
+            query, entries = library.query(vectors[queried], cascade,
+                                           ALGORITHM_SETTINGS.get('INDEX_RECALL', 1.0))
+        self.metrics.inc('comparisons', 'library', sum(cascade.stage_counts().values()))
+        
+        present: Dict[int, bool] = {}
+        matches: Dict[int, List[int]] = {}
+        for q, entry in zip(query.tolist(), entries.tolist()):
+            if entry not in present:
+                present[entry] = os.path.lexists(os.path.join(output_folder, library.path(entry)))
+            if present[entry]:
+                matches.setdefault(int(rows[queried[q]]), []).append(entry)
+        return matches
     
     def update_progress(self, value: float, message: str = ""):
         """Update progress callback"""
@@ -150,186 +533,750 @@ class ImageSynchronizer:
         """Stop the synchronization process"""
         self.stop_processing.set()
     
+    def iter_images(self, folder_path: Path) -> Iterator[ImageData]:
+        """Yield image files below a folder as they are found"""
+        scan_workers = IMAGE_PROCESSING.get('SCAN_WORKERS', 8)
+        for path, st in walk_files(folder_path, ImageProcessor.SUPPORTED_FORMATS, scan_workers, self.stop_processing):
+            if self.stop_processing.is_set():
+                break
+            self.metrics.inc('files_scanned', 'scan')
+            yield ImageData(catalog=self.catalog, row=self.catalog.add(path, st))
+    
     def collect_images(self, folder_path: Path) -> List[ImageData]:
         """Collect all image files from folder"""
-        images = []
-        if not folder_path.exists():
-            return images
+        return list(self.iter_images(folder_path))
+    
+    def scan_folders(self, folders: List[Path], found: List[List[ImageData]]) -> Iterator[ImageData]:
+        """Walk several folders at once, yielding images as they are discovered
         
-        for file_path in folder_path.rglob("*"):
-            if self.stop_processing.is_set():
-                break
-            
-            if file_path.is_file() and ImageProcessor.is_image_file(file_path):
-                images.append(ImageData(file_path))
+        Each folder is walked in its own thread and records pass through a bounded
+        queue, so the walk cannot run far ahead of hashing. Images found in
+        folders[i] are also appended to found[i].
+        """
+        records = queue.Queue(maxsize=self.SCAN_QUEUE_SIZE)
+        done = object()
+        closed = threading.Event()
+        
+        def offer(item) -> bool:
+            while not closed.is_set():
+                try:
+                    records.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        
+        def walk(folder: Path, images: List[ImageData]):
+            try:
+                for img in self.iter_images(folder):
+                    images.append(img)
+                    if not offer(img):
+                        break
+            except Exception as e:
+                print(f"Error scanning {folder}: {e}")
+                self.metrics.inc('errors', 'scan')
+            finally:
+                offer(done)
+        
+        walkers = [threading.Thread(target=walk, args=(folder, images), daemon=True)
+                   for folder, images in zip(folders, found)]
+        for walker in walkers:
+            walker.start()
         
-        return images
+        try:
+            remaining = len(walkers)
+            while remaining:
+                item = records.get()
+                if item is done:
+                    remaining -= 1
+                else:
+                    yield item
+        finally:
+            closed.set()
+            for walker in walkers:
+                walker.join()
+    
+    def process_images_parallel(self, images: Iterable[ImageData], max_workers: Optional[int] = None,
+                                digest: bool = True, discovered=None) -> int:
+        """Process images in parallel as they arrive from an iterable
+        
+        Works on a list or on a generator that is still being filled (e.g. by
+        scan_folders). Submission is windowed: at most PERFORMANCE['BATCH_SIZE']
+        images are in flight, and the decoded size of in-flight images, estimated
+        from their headers, stays within PERFORMANCE['MAX_MEMORY_MB'] (a single
+        larger image runs alone). Results go into the catalog as they complete.
+        Headers are read ahead by PERFORMANCE['HEADER_WORKERS'] threads, so the
+        submitting thread does not wait on them; each image's memory is still
+        charged before it is handed to a worker. Oversized images are skipped, decoded at reduced scale or sent to a
+        separate lane of IMAGE_PROCESSING['OVERSIZED_WORKERS'] threads, as
+        ImageProcessor.check_image decides. discovered, if given, returns the
+        number of images found so far for progress reports. Returns the number
+        processed. The call is timed as the 'hash' stage in self.metrics, which
+        includes the walk when images come from scan_folders.
+        """
+        with self.metrics.timed('hash'):
+            return self._process_images_parallel(images, max_workers, digest, discovered)
     
-    def process_images_parallel(self, images: List[ImageData], max_workers: int = 4):
-        """Process images in parallel for better performance"""
-        total = len(images)
+    def _process_images_parallel(self, images: Iterable[ImageData], max_workers: Optional[int],
+                                 digest: bool, discovered) -> int:
+        metrics = self.metrics
+        max_workers = max_workers or self.max_workers
+        use_processes = self.executor == 'process'
+        max_images = max(PERFORMANCE.get('BATCH_SIZE', 100), 2 * max_workers)
+        memory_budget = PERFORMANCE.get('MAX_MEMORY_MB', 1024) * 2 ** 20
+        chunk_size = max(1, min(self.PROCESS_CHUNK_SIZE, max_images // (2 * max_workers)))
+        
+        in_flight: Dict[Future, Tuple[List[ImageData], int, bool]] = {}
+        keys: Dict[int, Tuple[int, int, int, int]] = {}
+        headers: Deque[Tuple[ImageData, Optional[Tuple[int, int, int, int]], Future]] = deque()
+        chunk: List[ImageData] = []
+        chunk_bytes = 0
+        in_flight_images = 0
+        in_flight_bytes = 0
         processed = 0
         
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            future_to_image = {executor.submit(img.process): img for img in images}
+        if discovered is None:
+            total = len(images) if isinstance(images, list) else None
+            discovered = lambda: total if total is not None else processed + in_flight_images + len(headers)
+        
+        def report():
+            found = max(discovered(), processed)
+            self.update_progress(processed / found * 50 if found else 0,
+                                 f"Discovered {found}, hashed {processed}, pending {found - processed}")
+        
+        def collect(block: bool):
+            nonlocal processed, in_flight_images, in_flight_bytes
+            if not in_flight:
+                return
+            done, _ = wait(in_flight, timeout=None if block else 0, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch, cost, packed = in_flight.pop(future)
+                in_flight_images -= len(batch)
+                in_flight_bytes -= cost
+                try:
+                    results = future.result()
+                except Exception as e:
+                    print(f"Error processing images: {e}")
+                    metrics.inc('errors', 'hash', len(batch))
+                    continue
+                if packed:
+                    for img, (_, file_digest, packed_hashes, timings, bytes_read) in zip(batch, results):
+                        metrics.record_hashed(bytes_read, timings, bool(packed_hashes))
+                        img.apply_packed(file_digest, packed_hashes)
+                        if img.row in keys:
+                            self.hash_cache.put(keys.pop(img.row), img.digest, img.image_hashes)
+                if self.checkpoint is not None:
+                    for img in batch:
+                        self.checkpoint_image(img)
+                processed += len(batch)
+            if done:
+                report()
+        
+        def submit(batch: List[ImageData], cost: int, fn, *args):
+            nonlocal in_flight_images, in_flight_bytes
+            # Backpressure: wait for results before going over either limit
+            while in_flight and (in_flight_images + len(batch) > max_images
+                                 or in_flight_bytes + cost > memory_budget):
+                collect(block=True)
+            in_flight[executor.submit(fn, *args)] = (batch, cost, fn is hash_files_packed)
+            in_flight_images += len(batch)
+            in_flight_bytes += cost
+            collect(block=False)
+        
+        def submit_chunk():
+            submit(chunk, chunk_bytes, hash_files_packed, [str(img.file_path) for img in chunk], digest)
+        
+        def submit_lane(img: ImageData, key):
+            nonlocal in_flight_images
+            # The lane has its own concurrency limit, so it does not count against the budget
+            in_flight[lane.submit(img.compute, self.hash_cache, key, digest, None, metrics)] = ([img], 0, False)
+            in_flight_images += 1
+        
+        def dispatch(img: ImageData, key, check: Future):
+            nonlocal chunk, chunk_bytes, processed
+            action, cost, reason = check.result()
+            if action == 'skip':
+                self.skip_image(img, reason)
+                processed += 1
+                return
+            if action == 'lane':
+                submit_lane(img, key)
+                return
+            reduced_decode = True if action == 'reduce' else None
+            
+            if not use_processes:
+                submit([img], cost, img.compute, self.hash_cache, key, digest, reduced_decode, metrics)
+                return
             
-            for future in as_completed(future_to_image):
+            if key is not None:
+                keys[img.row] = key
+            if reduced_decode:
+                submit([img], cost, hash_files_packed, [str(img.file_path)], digest, True)
+                return
+            
+            # Worker processes hash a chunk one file at a time, so a chunk
+            # needs the memory of its largest image
+            chunk.append(img)
+            chunk_bytes = max(chunk_bytes, cost)
+            if len(chunk) >= chunk_size:
+                submit_chunk()
+                chunk, chunk_bytes = [], 0
+        
+        pool = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        lane_workers = IMAGE_PROCESSING.get('OVERSIZED_WORKERS', 1)
+        header_workers = PERFORMANCE.get('HEADER_WORKERS', 4)
+        with pool(max_workers=max_workers) as executor, \
+                ThreadPoolExecutor(max_workers=lane_workers, thread_name_prefix="oversized") as lane, \
+                ThreadPoolExecutor(max_workers=header_workers, thread_name_prefix="header") as header_pool:
+            for img in images:
                 if self.stop_processing.is_set():
                     break
+                if img.processed:
+                    processed += 1
+                    continue
                 
-                try:
-                    future.result()
+                # Cache lookups stay in this thread, so cached images cost no header read
+                key = img.cache_key() if self.hash_cache is not None else None
+                if key is not None and img.load_cached(self.hash_cache, key, digest):
+                    metrics.inc('cache_hits', 'hash')
                     processed += 1
-                    self.update_progress(processed / total * 50, f"Processing images... {processed}/{total}")
-                except Exception as e:
-                    print(f"Error processing image: {e}")
+                    continue
+                # Headers are read ahead by the header pool; images are dispatched in order
+                size = int(self.catalog.sizes[img.row])
+                headers.append((img, key, header_pool.submit(ImageProcessor.check_image, img.file_path, size)))
+                while headers and (headers[0][2].done() or not in_flight or len(headers) >= max_images):
+                    dispatch(*headers.popleft())
+            
+            while headers and not self.stop_processing.is_set():
+                dispatch(*headers.popleft())
+            
+            if chunk and not self.stop_processing.is_set():
+                submit_chunk()
+            
+            while in_flight:
+                if self.stop_processing.is_set():
+                    # Drop queued work, but keep (and checkpoint) files already being hashed
+                    for future in [future for future in in_flight if future.cancel()]:
+                        batch, cost, _ = in_flight.pop(future)
+                        in_flight_images -= len(batch)
+                        in_flight_bytes -= cost
+                collect(block=True)
+        
+        report()
+        return processed
+    
+    def skip_image(self, img: ImageData, reason: str):
+        """Leave an image without perceptual hashes and record why"""
+        img.image_hashes = {}
+        img.processed = True
+        self.skipped.append((img.file_path, reason))
+        self.metrics.inc('files_skipped', 'hash')
+        self.checkpoint_image(img, reason)
+        self.update_status(f"Skipping {img.file_path.name}: {reason}")
+    
+    def detect_exact_duplicates(self, images: List[ImageData]) -> Dict[str, int]:
+        """Find byte-identical files with a size -> head/tail hash -> full hash funnel
+        
+        Files with a unique size are never read. Files whose head and tail also
+        collide are read in full, and their digests are stored in the catalog
+        (and the hash cache) for find_similar_groups. Timed as the 'digest' stage.
+        """
+        with self.metrics.timed('digest'):
+            return self._detect_exact_duplicates(images)
+    
+    def _detect_exact_duplicates(self, images: List[ImageData]) -> Dict[str, int]:
+        self.update_status("Checking for exact duplicates...")
+        catalog = self.catalog
+        cache = self.hash_cache
+        block = ImageProcessor.PARTIAL_HASH_BYTES
+        stats = {"size_collisions": 0, "partial_hashed": 0, "full_hashed": 0, "bytes_read": 0}
+        
+        # Stage 1: only files sharing their size with another file can be duplicates
+        sizes = catalog.sizes[[img.row for img in images]]
+        _, inverse, counts = np.unique(sizes, return_inverse=True, return_counts=True)
+        candidates = [images[i] for i in np.flatnonzero(counts[inverse] > 1)]
+        stats["size_collisions"] = len(candidates)
+        
+        # Digests already in the hash cache need no reading
+        known_sizes: Set[int] = set()
+        unknown = []
+        for img in candidates:
+            if not img.digest and cache is not None:
+                key = catalog.stat_key(img.row)
+                entry = cache.get(key) if key is not None else None
+                if entry is not None and entry[0]:
+                    img.digest = entry[0]
+            if img.digest:
+                known_sizes.add(int(catalog.sizes[img.row]))
+            else:
+                unknown.append(img)
+        
+        # Stage 2: hash head and tail; small files are read in full right away
+        small = [img for img in unknown if catalog.sizes[img.row] <= 2 * block]
+        large = [img for img in unknown if catalog.sizes[img.row] > 2 * block]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            partials = list(executor.map(
+                lambda img: ImageProcessor.get_partial_digest(img.file_path, int(catalog.sizes[img.row])), large))
+        stats["partial_hashed"] = len(large)
+        stats["bytes_read"] += 2 * block * len(large)
+        
+        buckets: Dict[Tuple[int, bytes], List[ImageData]] = {}
+        for img, partial in zip(large, partials):
+            if partial:
+                buckets.setdefault((int(catalog.sizes[img.row]), partial), []).append(img)
+        # A file can only be compared with a cached digest by hashing it in full
+        survivors = small + [
+            img for (size, _), bucket in buckets.items()
+            if len(bucket) > 1 or size in known_sizes
+            for img in bucket
+        ]
+        
+        # Stage 3: full content digest of what is left
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            digests = list(executor.map(lambda img: ImageProcessor.get_file_digest(img.file_path), survivors))
+        for img, file_digest in zip(survivors, digests):
+            if not file_digest:
+                self.metrics.inc('errors', 'digest')
+                continue
+            img.digest = file_digest
+            stats["full_hashed"] += 1
+            stats["bytes_read"] += int(catalog.sizes[img.row])
+            key = catalog.stat_key(img.row)
+            if cache is not None and key is not None:
+                cache.put(key, file_digest)
+            self.checkpoint_image(img)
+        
+        self.exact_stats = stats
+        self.metrics.inc('bytes_read', 'digest', stats["bytes_read"])
+        self.update_status(f"Exact duplicate check: {stats['size_collisions']} size collisions, "
+                           f"{stats['full_hashed']} files read in full, "
+                           f"{stats['bytes_read'] / 2 ** 20:.1f} MB read")
+        return stats
     
-    def find_similar_groups(self, images1: List[ImageData], images2: List[ImageData]) -> Dict[str, List[ImageData]]:
-        """Find groups of similar images"""
+    def defer_size_collisions(self, images: Iterable[ImageData], deferred: List[ImageData],
+                              seen_sizes: Optional[Set[int]] = None) -> Iterator[ImageData]:
+        """Pass on the first image of each file size; hold back the rest in deferred
+        
+        Held-back images may be byte-identical to an earlier one, in which case
+        they reuse its hashes instead of being decoded. seen_sizes may name sizes
+        to treat as already seen.
+        """
+        seen_sizes = set(seen_sizes or ())
+        for img in images:
+            size = int(self.catalog.sizes[img.row])
+            if size in seen_sizes:
+                deferred.append(img)
+            else:
+                seen_sizes.add(size)
+                yield img
+    
+    def split_representatives(self, images: List[ImageData]) -> Tuple[List[ImageData], List[Tuple[int, int]]]:
+        """Pick one image per digest to hash perceptually
+        
+        Returns the images to hash and (representative row, duplicate row) pairs
+        whose hashes can be copied afterwards with share_representative_hashes.
+        """
+        catalog = self.catalog
+        representatives = []
+        duplicates = []
+        first_row: Dict[bytes, int] = {}
+        # Images hashed while the scan was running represent their digest
+        for img in images:
+            digest = catalog.digest(img.row)
+            if digest and img.processed:
+                first_row.setdefault(digest, img.row)
+        for img in images:
+            digest = catalog.digest(img.row)
+            if not digest:
+                representatives.append(img)
+                continue
+            rep_row = first_row.setdefault(digest, img.row)
+            if rep_row == img.row:
+                representatives.append(img)
+            else:
+                duplicates.append((rep_row, img.row))
+        return representatives, duplicates
+    
+    def share_representative_hashes(self, duplicates: List[Tuple[int, int]]):
+        """Copy perceptual hashes from each representative to its exact duplicates"""
+        catalog = self.catalog
+        if not duplicates:
+            return
+        source, target = np.array(duplicates, dtype=np.int64).T
+        for block in catalog.hashes.values():
+            block[target] = block[source]
+        catalog.flags[target] |= catalog.flags[source] & np.uint8(PROCESSED | HAS_HASHES)
+    
+    def find_similar_groups(self, images1: List[ImageData], images2: List[ImageData],
+                            threshold: Optional[float] = None) -> Dict[str, List[ImageData]]:
+        """Find groups of similar images (at self.threshold unless threshold is given)"""
         self.update_status("Finding similar images...")
         
         all_images = images1 + images2
-        groups = {}
-        processed = 0
-        total_comparisons = len(all_images) * (len(all_images) - 1) // 2
+        pairs = self.similar_pairs(all_images, threshold)
+        if self.stop_processing.is_set():
+            return {}
+        return self.group_similar(all_images, *pairs)
+    
+    def similar_pairs(self, all_images: List[ImageData],
+                      threshold: Optional[float] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """(first, second) positions in all_images of every exact or perceptual match"""
+        with self.metrics.timed('compare'):
+            return self._similar_pairs(all_images, threshold)
+    
+    def _similar_pairs(self, all_images: List[ImageData],
+                       threshold: Optional[float] = None) -> Tuple[np.ndarray, np.ndarray]:
+        n = len(all_images)
         
-        for i, img1 in enumerate(all_images):
-            if self.stop_processing.is_set():
-                break
-            
-            for j, img2 in enumerate(all_images[i + 1:], i + 1):
-                if self.stop_processing.is_set():
-                    break
-                
-                # Check for exact duplicates first (much faster)
-                if img1.file_hash and img2.file_hash and img1.file_hash == img2.file_hash:
-                    similarity = True
-                else:
-                    # Check perceptual similarity
-                    similarity = ImageProcessor.are_images_similar(img1.image_hashes, img2.image_hashes)
-                
-                if similarity:
-                    # Find existing group or create new one
-                    group_key = None
-                    for key, group in groups.items():
-                        if img1 in group or img2 in group:
-                            group_key = key
-                            break
-                    
-                    if group_key is None:
-                        # Create new group using the first image's context
-                        group_key = img1.context or img2.context or f"group_{len(groups) + 1}"
-                        groups[group_key] = []
-                    
-                    # Add both images to group
-                    if img1 not in groups[group_key]:
-                        groups[group_key].append(img1)
-                    if img2 not in groups[group_key]:
-                        groups[group_key].append(img2)
-                
-                processed += 1
-                if processed % 100 == 0:
-                    progress = 50 + (processed / total_comparisons * 30)
-                    self.update_progress(progress, f"Comparing images... {processed}/{total_comparisons}")
+        # Exact duplicates: rows with identical digests
+        catalog = self.catalog
+        rows = np.fromiter((img.row for img in all_images), dtype=np.int64, count=n)
+        has_digest = np.flatnonzero(catalog.flags[rows] & HAS_DIGEST)
+        digests = np.ascontiguousarray(catalog.digests[rows[has_digest]]).view(np.uint64)
+        exact_first, exact_second = equal_row_pairs(digests)
+        
+        # Perceptual matches: all four hashes concatenated; candidates within the
+        # cascade's Hamming radius are settled by its weighted, early-exit test
+        vectors = np.hstack([catalog.hashes[hash_type][rows] for hash_type in HASH_TYPES])
+        has_hashes = (catalog.flags[rows] & HAS_HASHES) != 0
+        cascade = ImageProcessor.similarity_cascade(self.threshold if threshold is None else threshold)
+        recall = ALGORITHM_SETTINGS.get('INDEX_RECALL', 1.0)
+        index = HammingIndex(vectors, cascade.candidate_radius, valid=has_hashes, cascade=cascade, recall=recall)
+        if index.mode == 'substrings':
+            self.update_status(f"Threshold {cascade.threshold}: looking up {len(index.substrings)} hash substrings")
+        elif index.mode == 'sampled':
+            self.update_status(f"Threshold {cascade.threshold}: looking up {len(index.sampled)} sampled-bit keys "
+                               f"(recall {recall})")
+        
+        def report(fraction):
+            self.update_progress(50 + fraction * 30, f"Comparing images... {index.comparisons} comparisons")
+        
+        # Units finished before an interruption are taken from the checkpoint
+        done: Dict[int, Tuple[np.ndarray, np.ndarray]] = {}
+        on_unit = None
+        if self.checkpoint is not None:
+            comparison = comparison_key(vectors, has_hashes, cascade.candidate_radius,
+                                        f"{cascade.key()};{index.mode};{recall!r}")
+            done = self.checkpoint.compared.get(comparison, {})
+            on_unit = lambda unit, unit_first, unit_second: self.checkpoint.add_compared(
+                comparison, unit, unit_first, unit_second)
+        first, second = index.pairs(self.stop_processing, report, done.keys(), on_unit)
+        self.comparison_stats = cascade.stage_counts()
+        metrics = self.metrics
+        metrics.inc('comparisons', 'compare', index.comparisons)
+        for hash_type, count in self.comparison_stats.items():
+            metrics.inc('pairs_settled', hash_type, count)
+        if not done and not self.stop_processing.is_set():
+            hashed = int(np.count_nonzero(has_hashes))
+            metrics.inc('candidates_pruned', 'compare', max(0, hashed * (hashed - 1) // 2 - index.comparisons))
+        settled = ", ".join(f"{hash_type} {count}" for hash_type, count in self.comparison_stats.items())
+        self.update_status(f"Compared {sum(self.comparison_stats.values())} candidate pairs; settled by {settled}")
+        if done:
+            first = np.concatenate([first] + [pair[0] for pair in done.values()])
+            second = np.concatenate([second] + [pair[1] for pair in done.values()])
+        return np.concatenate([has_digest[exact_first], first]), np.concatenate([has_digest[exact_second], second])
+    
+    def group_similar(self, all_images: List[ImageData], first: np.ndarray,
+                      second: np.ndarray) -> Dict[str, List[ImageData]]:
+        """Merge matching pairs into named groups; a later pair can link two earlier groups"""
+        groups = {}
+        components = DisjointSet(len(all_images))
+        components.union_pairs(first, second)
+        for members in components.groups():
+            group = [all_images[i] for i in members]
+            # Name the group after its first image with a usable context
+            base_key = next((img.context for img in group if img.context), f"group_{len(groups) + 1}")
+            group_key, suffix = base_key, 1
+            while group_key in groups:
+                suffix += 1
+                group_key = f"{base_key}_{suffix}"
+            groups[group_key] = group
         
         return groups
     
     def organize_images(self, folder1: Path, folder2: Path, output_folder: Path) -> Dict[str, int]:
-        """Main method to organize images"""
-        self.update_status("Starting image organization...")
+        """Main method to organize images
         
-        # Create output folder
-        output_folder.mkdir(parents=True, exist_ok=True)
+        The plan is saved to STATE_FOLDER in the output folder and applied with a
+        journal there, so an interrupted run can be resumed or rolled back with
+        'cli.py apply'. A previous run that was interrupted has to be finished or
+        rolled back that way first; until then nothing is done.
+        """
+        state_folder = output_folder / self.STATE_FOLDER
+        plan_path = state_folder / "plan.json.gz"
+        journal_path = placement_plan.journal_path_for(plan_path)
+        if os.path.exists(journal_path):
+            try:
+                pending = placement_plan.unfinished_operations(plan_path, journal_path)
+                problem = f"{pending} operations of the last run were never carried out" if pending else ""
+            except (OSError, ValueError) as e:
+                problem = f"the journal of the last run cannot be checked against its plan ({e})"
+            if problem:
+                message = (f"Not starting: {problem}. Finish that run with 'cli.py apply \"{plan_path}\" "
+                           f"--journal \"{journal_path}\"' or undo it by adding --rollback")
+                self.update_status(message)
+                return {"error": 1, "message": message}
         
-        # Collect images
-        self.update_status("Collecting images from folder 1...")
-        images1 = self.collect_images(folder1)
+        plan = self.plan_images(folder1, folder2, output_folder)
+        if isinstance(plan, dict):
+            return plan
         
-        self.update_status("Collecting images from folder 2...")
-        images2 = self.collect_images(folder2)
+        state_folder.mkdir(parents=True, exist_ok=True)
+        if os.path.exists(journal_path):
+            os.unlink(journal_path)  # finished: every operation placed, or none
+        plan.save(plan_path)
+        return self.apply_plan(plan, journal_path, progress_start=80)
+    
+    def plan_images(self, folder1: Path, folder2: Path, output_folder: Path):
+        """Scan, hash and group both folders and decide where every file goes
         
-        if not images1 and not images2:
-            return {"error": 1, "message": "No images found in either folder"}
+        Nothing is moved. Returns a PlacementPlan, or a stats dict with "error"
+        or "cancelled" set. Hashing and comparison progress is checkpointed;
+        with resume set, work recorded by an interrupted run is not redone.
+        The checkpoint is deleted once the plan is complete.
+        """
+        self.update_status("Starting image organization...")
+        checkpoint = self.open_checkpoint(folder1, folder2)
+        try:
+            plan = self._plan_images(folder1, folder2, output_folder)
+        finally:
+            self.checkpoint = None
+            if checkpoint is not None:
+                checkpoint.close()
+        if checkpoint is not None and not isinstance(plan, dict):
+            checkpoint.discard()
+        return plan
+    
+    def _plan_images(self, folder1: Path, folder2: Path, output_folder: Path):
+        self.catalog = ImageCatalog(ImageProcessor.HASH_SIZE)
+        self.skipped = []
+        library = None if self.exact_only else self.open_library(output_folder)
+        if library is not None and not library.compatible:
+            self.update_status("The output library index was built with other hash settings; starting a new one")
         
-        # Process images
-        all_images = images1 + images2
-        self.process_images_parallel(all_images)
+        # Walk both folders while hashing what has been found so far. Files whose
+        # size was already seen may be exact duplicates and wait for that check.
+        self.update_status("Scanning folders and hashing images...")
+        images1, images2 = [], []
+        deferred: List[ImageData] = []
+        scan = records = self.scan_folders([folder1, folder2], [images1, images2])
+        seen_sizes: Set[int] = set()
+        if self.checkpoint is not None and self.checkpoint.hashed:
+            self.update_status(f"Resuming: {len(self.checkpoint.hashed)} files in the checkpoint")
+            records = self.restore_checkpointed(records)
+            # A file arriving before its already hashed duplicate must still wait
+            seen_sizes = {entry[0][2] for entry in self.checkpoint.hashed.values()}
+        cache = self.open_hash_cache()
+        try:
+            if self.exact_only:
+                for _ in records:
+                    pass
+            else:
+                self.process_images_parallel(self.defer_size_collisions(records, deferred, seen_sizes), digest=False,
+                                             discovered=lambda: len(images1) + len(images2))
+            
+            # The walk order varies between runs; sort so grouping does not
+            images1.sort(key=lambda img: img.file_path)
+            images2.sort(key=lambda img: img.file_path)
+            all_images = images1 + images2
+            if not all_images:
+                return {"error": 1, "message": "No images found in either folder"}
+            
+            # Exact duplicates, then perceptual hashes for the remaining representatives
+            if not self.stop_processing.is_set():
+                self.detect_exact_duplicates(all_images)
+            if deferred and not self.stop_processing.is_set():
+                representatives, duplicates = self.split_representatives(all_images)
+                self.process_images_parallel(representatives, digest=False)
+                self.share_representative_hashes(duplicates)
+        finally:
+            records.close()
+            scan.close()
+            if cache is not None:
+                cache.flush()
         
         if self.stop_processing.is_set():
             return {"cancelled": 1}
         
-        # Find similar groups
+        # Find similar groups, then images that belong with files already in the output folder
         similar_groups = self.find_similar_groups(images1, images2)
+        matches = self.match_library(library, all_images, output_folder) if library is not None else {}
+        return self.plan_placement(all_images, similar_groups, output_folder, library, matches)
+    
+    def plan_placement(self, all_images: List[ImageData], similar_groups: Dict[str, List[ImageData]],
+                       output_folder: Path, library: Optional[LibraryIndex] = None,
+                       matches: Optional[Dict[int, List[int]]] = None) -> PlacementPlan:
+        """Decide every destination up front: groups into similar_* folders, the rest into unique_images
         
-        # Track statistics
-        stats = {
-            "similar_groups": 0,
-            "unique_images": 0,
-            "total_processed": 0,
-            "errors": 0
-        }
-        
-        # Process similar groups
+        matches (from match_library) send images to the folders of similar library files.
+        """
+        matches = matches or {}
+        similar_count = 0
+        library_matches = 0
+        placement = PlacementEngine(IMAGE_PROCESSING.get('PLACEMENT_WORKERS', 8), self.stop_processing,
+                                    self.placement_mode)
+        placed_unique: List[bool] = []
+        placed_rows: List[int] = []
+        library_entries: Dict[int, int] = {}
         grouped_images = set()
-        for group_name, group_images in similar_groups.items():
-            if self.stop_processing.is_set():
-                break
-            
-            self.update_status(f"Creating folder for similar images: {group_name}")
-            
-            # Create folder for similar images
+        # Exact duplicates become hard links to the first placed copy (symlinks already share data)
+        first_copy: Optional[Dict[bytes, int]] = None
+        if self.link_duplicates and self.placement_mode != 'symlink':
+            first_copy = {}
+        
+        def place(img: ImageData, folder: Path, unique: bool):
+            digest = self.catalog.digest(img.row) if first_copy is not None else b""
+            link_to = first_copy.get(digest) if digest else None
+            index = placement.add(img.file_path, folder, self.catalog.device_of(img.row), link_to)
+            if digest and link_to is None:
+                first_copy[digest] = index
+            placed_unique.append(unique)
+            placed_rows.append(img.row)
+        
+        # New group folders never reuse a folder that is already in the output
+        try:
+            with os.scandir(output_folder) as entries:
+                taken = {entry.name.casefold() for entry in entries}
+        except OSError:
+            taken = set()
+        
+        def new_group_folder(group_name: str) -> Path:
+            nonlocal similar_count
             safe_name = "".join(c for c in group_name if c.isalnum() or c in (' ', '-', '_')).strip()
-            group_folder = output_folder / f"similar_{safe_name}"
-            group_folder.mkdir(parents=True, exist_ok=True)
+            folder, suffix = f"similar_{safe_name}", 1
+            while folder.casefold() in taken:
+                suffix += 1
+                folder = f"similar_{safe_name}_{suffix}"
+            taken.add(folder.casefold())
+            similar_count += 1
+            return output_folder / folder
+        
+        # Groups first, then single images
+        components = list(similar_groups.items())
+        for group_images in similar_groups.values():
+            grouped_images.update(group_images)
+        components += [(None, [img]) for img in all_images if img not in grouped_images]
+        
+        unique_folder = output_folder / "unique_images"
+        relocated: Dict[int, Path] = {}
+        for group_name, group_images in components:
+            entries = sorted({entry for img in group_images for entry in matches.get(img.row, ())})
+            if not entries:
+                folder = unique_folder if group_name is None else new_group_folder(group_name)
+                for img in group_images:
+                    place(img, folder, group_name is None)
+                continue
             
-            # Move images to group folder
+            # Join the first matching library group; matched unique library files move in with them
+            folders = {entry: relocated.get(entry) or output_folder / Path(library.path(entry)).parts[0]
+                       for entry in entries}
+            grouped = [entry for entry in entries if folders[entry] != unique_folder]
+            if grouped:
+                folder = folders[grouped[0]]
+            else:
+                context = ImageProcessor.extract_image_context(Path(library.path(entries[0])))
+                folder = new_group_folder(group_name or context or f"group_{similar_count + 1}")
+            for entry in entries:
+                if folders[entry] == unique_folder:
+                    index = placement.add(output_folder / library.path(entry), folder, relocate=True)
+                    relocated[entry] = folder
+                    library_entries[index] = entry
+                    placed_unique.append(False)
+                    placed_rows.append(-1)
             for img in group_images:
-                try:
-                    dest_path = group_folder / img.file_path.name
-                    # Handle name conflicts
-                    counter = 1
-                    while dest_path.exists():
-                        stem = img.file_path.stem
-                        suffix = img.file_path.suffix
-                        dest_path = group_folder / f"{stem}_{counter}{suffix}"
-                        counter += 1
-                    
-                    shutil.move(str(img.file_path), str(dest_path))
-                    grouped_images.add(img)
-                    stats["total_processed"] += 1
-                except Exception as e:
-                    print(f"Error moving {img.file_path}: {e}")
-                    stats["errors"] += 1
-            
-            stats["similar_groups"] += 1
+                place(img, folder, False)
+            library_matches += len(group_images)
+        
+        plan = PlacementPlan.from_engine(placement, output_folder, placed_unique)
+        plan.similar_groups = similar_count
+        plan.skipped = len(self.skipped)
+        if library is not None:
+            rows = np.array(placed_rows, dtype=np.int64)
+            plan.hash_version = library.version
+            plan.vectors, plan.valid = self.hash_vectors(np.maximum(rows, 0))
+            plan.valid &= rows >= 0
+            plan.library_entries = library_entries
+            plan.library_matches = library_matches
+        return plan
+    
+    def apply_plan(self, plan: PlacementPlan, journal_path, progress_start: float = 0) -> Dict[str, int]:
+        """Carry out a plan, resuming from its journal if one exists"""
+        self.update_status(f"Placing {len(plan)} files...")
         
-        # Process unique images
-        unique_images = [img for img in all_images if img not in grouped_images]
+        def report(done, total):
+            self.update_progress(progress_start + (100 - progress_start) * done / total,
+                                 f"Placing files... {done}/{total}")
         
-        if unique_images and not self.stop_processing.is_set():
-            self.update_status("Moving unique images...")
-            unique_folder = output_folder / "unique_images"
-            unique_folder.mkdir(parents=True, exist_ok=True)
-            
-            for img in unique_images:
-                try:
-                    dest_path = unique_folder / img.file_path.name
-                    # Handle name conflicts
-                    counter = 1
-                    while dest_path.exists():
-                        stem = img.file_path.stem
-                        suffix = img.file_path.suffix
-                        dest_path = unique_folder / f"{stem}_{counter}{suffix}"
-                        counter += 1
-                    
-                    shutil.move(str(img.file_path), str(dest_path))
-                    stats["unique_images"] += 1
-                    stats["total_processed"] += 1
-                except Exception as e:
-                    print(f"Error moving {img.file_path}: {e}")
-                    stats["errors"] += 1
+        with self.metrics.timed('place'):
+            engine, errors = placement_plan.apply_plan(plan, journal_path,
+                                                       IMAGE_PROCESSING.get('PLACEMENT_WORKERS', 8),
+                                                       self.stop_processing, report)
+        for index, error in sorted(errors.items()):
+            print(f"Error placing {plan.operations[index][0]}: {error}")
+        self.metrics.inc('files_placed', 'place', sum(engine.placed))
+        self.metrics.inc('errors', 'place', len(errors))
+        
+        if self.stop_processing.is_set():
+            return {"cancelled": 1}
+        if plan.vectors is not None:
+            self.update_library(plan, engine.placed)
         
         self.update_progress(100, "Organization complete!")
         self.update_status("Image organization completed successfully!")
         
+        placed = [placed and index not in plan.relocations for index, placed in enumerate(engine.placed)]
+        stats = {
+            "similar_groups": plan.similar_groups,
+            "unique_images": sum(placed and unique for placed, unique in zip(placed, plan.unique)),
+            "total_processed": sum(placed),
+            "skipped": plan.skipped,
+            "errors": len(errors)
+        }
+        if plan.library_matches:
+            stats["library_matches"] = plan.library_matches
         return stats
+    
+    def update_library(self, plan: PlacementPlan, placed: bytearray):
+        """Add a plan's placed files to the output library index and record its relocations"""
+        library = self.open_library(plan.output_folder)
+        if plan.hash_version != library.version:
+            return
+        plan_id = plan.identity()
+        done = np.frombuffer(bytes(placed), dtype=np.uint8).astype(bool)
+        ingested = library.ingested(plan_id, len(plan))
+        new = np.flatnonzero(done & ~ingested)
+        if not len(new):
+            return
+        
+        relative = lambda path: os.path.relpath(path, plan.output_folder)
+        if library.compatible:
+            for index in new.tolist():
+                if index in plan.library_entries:
+                    source, destination = plan.operations[index][:2]
+                    library.relocate(plan.library_entries[index], relative(source), relative(destination))
+        rows = np.array([index for index in new.tolist() if index not in plan.relocations], dtype=np.int64)
+        library.add([relative(plan.operations[index][1]) for index in rows.tolist()],
+                     plan.vectors[rows], plan.valid[rows], plan_id, done)
+    
+    def rollback_plan(self, plan: PlacementPlan, journal_path) -> Dict[str, int]:
+        """Undo the operations a journal records for a plan"""
+        self.update_status("Rolling back placed files...")
+        
+        def report(done, total):
+            self.update_progress(100 * done / total, f"Rolling back... {done}/{total}")
+        
+        rolled_back, errors = placement_plan.rollback_plan(plan, journal_path, report)
+        for index, error in sorted(errors.items()):
+            print(f"Error rolling back {plan.operations[index][1]}: {error}")
+        
+        # Library files moved back to their old folders are found there again
+        if plan.library_entries:
+            library = self.open_library(plan.output_folder)
+            for index, entry in plan.library_entries.items():
+                source, destination = plan.operations[index][:2]
+                if os.path.exists(source) and not os.path.lexists(destination):
+                    library.relocate(entry, os.path.relpath(destination, plan.output_folder),
+                                     os.path.relpath(source, plan.output_folder))
+            if library.compatible:
+                library.save()
+        return {"rolled_back": rolled_back, "errors": len(errors)}
@@ -0,0 +1,262 @@
+"""
+Library index for Automatic Image Sync
+Keeps the perceptual hashes of everything placed in an output folder, so later runs hash only new inputs
+"""
+
+import base64
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from similarity_index import HammingIndex, SimilarityCascade
+
+
+LIBRARY_FORMAT = 1
+# Segments are merged once there are more than this many, keeping queries to a few binary searches
+MAX_SEGMENTS = 8
+# Query tables are kept per segment for this many recent settings (threshold, weights, recall)
+TABLE_SETTINGS = 2
+# Plans whose ingested operations are remembered, so re-applying one adds nothing twice
+RECENT_PLANS = 8
+
+
+class LibraryIndex:
+    """Hash vectors and relative paths of the files placed in an output folder
+
+    Stored in <output>/.image_sync/library as segments: every ingest appends one
+    segment (vectors.npy, valid.npy and a paths file) and the manifest lists them.
+    Vectors are memory-mapped, so opening the library reads only the manifest.
+    Entries are numbered across segments in order. Files moved inside the output
+    folder later are recorded in the manifest rather than rewriting a segment.
+    The manifest also remembers which operations of recent plans were ingested.
+
+    Each segment also keeps the sorted lookup tables of HammingIndex.query_tables()
+    for the cascade and recall it was written with, so a query costs a few
+    binary searches per segment and table. Segments queried with other settings
+    get their tables on first use. Where no table is selective (thresholds below
+    about 0.92 at full recall), the segment is scanned.
+    """
+
+    def __init__(self, directory, version: str, hash_words: int,
+                 cascade: Optional[SimilarityCascade] = None, recall: float = 1.0):
+        self.directory = Path(directory)
+        self.version = version
+        self.hash_words = hash_words
+        self.cascade = cascade
+        self.recall = recall
+        self.segments: List[Dict] = []
+        self.moved: Dict[int, str] = {}
+        self.plans: Dict[str, str] = {}
+        self.next_segment = 1
+        self.compatible = True
+        self._vectors: Dict[str, np.ndarray] = {}
+        self._paths: Dict[str, List[str]] = {}
+
+        manifest = self.directory / "manifest.json"
+        if manifest.exists():
+            with open(manifest, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if (data.get("format") != LIBRARY_FORMAT or data.get("version") != version
+                    or data.get("hash_words") != hash_words):
+                # Hashes made with other settings cannot be compared; start a new library
+                self.compatible = False
+                return
+            self.segments = data["segments"]
+            self.moved = {int(entry): path for entry, path in data.get("moved", {}).items()}
+            self.next_segment = data.get("next_segment", len(self.segments) + 1)
+            self.plans = data.get("plans", {})
+
+    def __len__(self) -> int:
+        return sum(segment["size"] for segment in self.segments)
+
+    def _offsets(self) -> List[int]:
+        offsets = [0]
+        for segment in self.segments:
+            offsets.append(offsets[-1] + segment["size"])
+        return offsets
+
+    def vectors(self, name: str) -> np.ndarray:
+        if name not in self._vectors:
+            self._vectors[name] = np.load(self.directory / f"{name}.vectors.npy", mmap_mode='r')
+        return self._vectors[name]
+
+    def _segment_paths(self, name: str) -> List[str]:
+        if name not in self._paths:
+            with open(self.directory / f"{name}.paths", "r", encoding="utf-8", errors="surrogateescape") as f:
+                self._paths[name] = f.read().split("\0")[:-1]
+        return self._paths[name]
+
+    def path(self, entry: int) -> str:
+        """Path of an entry relative to the output folder"""
+        if entry in self.moved:
+            return self.moved[entry]
+        offsets = self._offsets()
+        k = int(np.searchsorted(offsets, entry, 'right')) - 1
+        return self._segment_paths(self.segments[k]["name"])[entry - offsets[k]]
+
+    def query(self, vectors: np.ndarray, cascade: SimilarityCascade,
+              recall: float = 1.0) -> Tuple[np.ndarray, np.ndarray]:
+        """(query row, entry) pairs the cascade finds similar, looked up segment by segment
+
+        recall below 1 lets segments too large to scan use sampled-bit tables (see HammingIndex).
+        """
+        found_query, found_entry = [], []
+        built = False
+        for offset, segment in zip(self._offsets(), self.segments):
+            index = self._index(segment["name"], cascade, recall)
+            key = self.table_key(cascade, recall)
+            if key not in segment.get("tables", ()):
+                self._write_tables(segment, index, key)
+                built = True
+            query, row = index.query_many(vectors, self._tables(segment["name"], key))
+            found_query.append(query)
+            found_entry.append(row + offset)
+        if built:
+            self.save()
+        if not found_query:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty
+        return np.concatenate(found_query), np.concatenate(found_entry)
+
+    @staticmethod
+    def table_key(cascade: SimilarityCascade, recall: float) -> str:
+        """Name of the query tables for a cascade and recall"""
+        return hashlib.sha1(f"{cascade.key()};{recall!r}".encode("utf-8")).hexdigest()[:12]
+
+    def _index(self, name: str, cascade: SimilarityCascade, recall: float) -> HammingIndex:
+        valid = np.load(self.directory / f"{name}.valid.npy", mmap_mode='r')
+        return HammingIndex(self.vectors(name), cascade.candidate_radius, valid=valid,
+                            cascade=cascade, recall=recall)
+
+    def _tables(self, name: str, key: str) -> Dict[str, np.ndarray]:
+        """A segment's stored query tables (memory-mapped), empty if it is scanned"""
+        tables = {}
+        for part in ("substrings", "positions", "keys", "rows"):
+            path = self.directory / f"{name}.{key}.{part}.npy"
+            if path.exists():
+                tables[part] = np.load(path, mmap_mode='r')
+        return tables
+
+    def _write_tables(self, segment: Dict, index: HammingIndex, key: str):
+        """Build and store a segment's query tables for the index's settings
+
+        Only the tables of the TABLE_SETTINGS most recent settings are kept.
+        """
+        name = segment["name"]
+        for part, array in index.query_tables().items():
+            if part == "rows":
+                array = array.astype(np.uint32)  # entries of one segment
+            np.save(self.directory / f"{name}.{key}.{part}.npy", array)
+        tables = segment.setdefault("tables", [])
+        tables.append(key)
+        while len(tables) > TABLE_SETTINGS:
+            for path in self.directory.glob(f"{name}.{tables.pop(0)}.*"):
+                path.unlink()
+
+    def ingested(self, plan_id: str, size: int) -> np.ndarray:
+        """Which operations of a plan are already in the library"""
+        if plan_id not in self.plans:
+            return np.zeros(size, dtype=bool)
+        bits = np.frombuffer(base64.b64decode(self.plans[plan_id]), dtype=np.uint8)
+        return np.unpackbits(bits, count=size).astype(bool)
+
+    def add(self, paths: List[str], vectors: np.ndarray, valid: np.ndarray,
+            plan_id: Optional[str] = None, ingested: Optional[np.ndarray] = None):
+        """Append a segment of newly placed files (paths relative to the output folder)
+
+        plan_id and ingested record which operations of a plan are now in the library.
+        """
+        if not self.compatible:
+            self.clear()
+        if plan_id is not None:
+            self.plans.pop(plan_id, None)
+            self.plans[plan_id] = base64.b64encode(np.packbits(ingested)).decode("ascii")
+            while len(self.plans) > RECENT_PLANS:
+                del self.plans[next(iter(self.plans))]
+        if paths:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self.segments.append(self._write_segment(paths, vectors, valid))
+            if len(self.segments) > MAX_SEGMENTS:
+                self.compact(self._merge_start())
+        self.save()
+
+    def relocate(self, entry: int, old_path: str, new_path: str) -> bool:
+        """Record that an entry's file was moved inside the output folder"""
+        if entry >= len(self) or self.path(entry) != old_path:
+            return False
+        self.moved[entry] = new_path
+        return True
+
+    def _merge_start(self) -> int:
+        """First of the newest segments to merge: together they outgrow the one before them
+
+        Older, larger segments are rewritten only once enough has been added after them.
+        """
+        sizes = [segment["size"] for segment in self.segments]
+        first = len(sizes) - 2
+        while first > 0 and sizes[first - 1] <= sum(sizes[first:]):
+            first -= 1
+        return first
+
+    def compact(self, first: int = 0):
+        """Merge the segments from first on (and their recorded moves) into one"""
+        start = self._offsets()[first]
+        paths = [self.path(entry) for entry in range(start, len(self))]
+        merged = self.segments[first:]
+        vectors = np.concatenate([np.asarray(self.vectors(s["name"])) for s in merged])
+        valid = np.concatenate([np.load(self.directory / f"{s['name']}.valid.npy") for s in merged])
+        self.segments = self.segments[:first] + [self._write_segment(paths, vectors, valid)]
+        self.moved = {entry: path for entry, path in self.moved.items() if entry < start}
+        self.save()
+        for segment in merged:
+            self._vectors.pop(segment["name"], None)
+            self._paths.pop(segment["name"], None)
+            for path in self.directory.glob(f"{segment['name']}.*"):
+                path.unlink()
+
+    def _write_segment(self, paths: List[str], vectors: np.ndarray, valid: np.ndarray) -> Dict:
+        """Write a new segment, with query tables for the library's cascade, and return its manifest entry"""
+        name = f"{self.next_segment:06d}"
+        self.next_segment += 1
+        np.save(self.directory / f"{name}.vectors.npy", np.ascontiguousarray(vectors, dtype=np.uint64))
+        np.save(self.directory / f"{name}.valid.npy", np.asarray(valid, dtype=bool))
+        with open(self.directory / f"{name}.paths", "w", encoding="utf-8", errors="surrogateescape") as f:
+            f.write("".join(path + "\0" for path in paths))
+        segment = {"name": name, "size": len(paths)}
+        if self.cascade is not None:
+            self._write_tables(segment, self._index(name, self.cascade, self.recall),
+                               self.table_key(self.cascade, self.recall))
+        return segment
+
+    def save(self):
+        """Write the manifest (atomically)"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        manifest = self.directory / "manifest.json"
+        temporary = self.directory / "manifest.json.tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump({
+                "format": LIBRARY_FORMAT,
+                "version": self.version,
+                "hash_words": self.hash_words,
+                "segments": self.segments,
+                "next_segment": self.next_segment,
+                "moved": {str(entry): path for entry, path in self.moved.items()},
+                "plans": self.plans,
+            }, f)
+        os.replace(temporary, manifest)
+
+    def clear(self):
+        """Delete all entries, e.g. those hashed with other settings"""
+        self._vectors.clear()
+        self._paths.clear()
+        if self.directory.exists():
+            for path in self.directory.iterdir():
+                path.unlink()
+        self.segments = []
+        self.moved = {}
+        self.plans = {}
+        self.compatible = True
@@ -11,7 +11,9 @@ except ImportError:
 
 from pathlib import Path
 import threading
+from config import IMAGE_PROCESSING
 from image_processor import ImageSynchronizer
+from placement import MODES as PLACEMENT_MODES
 
 
 class ImageSyncGUI:
@@ -107,6 +109,18 @@ class ImageSyncGUI:
             self.similarity_label.config(text=f"{self.similarity_var.get():.2f}")
         
         self.similarity_var.trace_add('write', update_similarity_label)
+        
+        # Placement mode
+        ttk.Label(options_frame, text="Placement:").grid(row=1, column=0, sticky=tk.W, pady=(10, 0))
+        self.placement_var = tk.StringVar(value=IMAGE_PROCESSING.get('PLACEMENT_MODE', 'move'))
+        ttk.Combobox(options_frame, textvariable=self.placement_var, values=PLACEMENT_MODES,
+                     state="readonly", width=12).grid(row=1, column=1, sticky=tk.W, padx=(10, 10), pady=(10, 0))
+        self.link_duplicates_var = tk.BooleanVar(value=IMAGE_PROCESSING.get('LINK_DUPLICATES', False))
+        ttk.Checkbutton(options_frame, text="Hard-link exact duplicates",
+                        variable=self.link_duplicates_var).grid(row=2, column=1, sticky=tk.W, padx=(10, 10), pady=(5, 0))
+        self.resume_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(options_frame, text="Resume interrupted run",
+                        variable=self.resume_var).grid(row=3, column=1, sticky=tk.W, padx=(10, 10), pady=(5, 0))
         options_frame.columnconfigure(1, weight=1)
         
         # Control buttons
@@ -267,7 +281,11 @@ class ImageSyncGUI:
         # Create synchronizer
         self.synchronizer = ImageSynchronizer(
             progress_callback=self.update_progress,
-            status_callback=self.update_status
+            status_callback=self.update_status,
+            placement_mode=self.placement_var.get(),
+            link_duplicates=self.link_duplicates_var.get(),
+            resume=self.resume_var.get(),
+            threshold=round(self.similarity_var.get(), 2)
         )
         
         # Start processing in separate thread
@@ -312,9 +330,14 @@ class ImageSyncGUI:
         
         self.results_text.insert(tk.END, f"📊 Results Summary:\n")
         self.results_text.insert(tk.END, f"  • Similar image groups created: {stats.get('similar_groups', 0)}\n")
-        self.results_text.insert(tk.END, f"  • Unique images moved: {stats.get('unique_images', 0)}\n")
+        verb = "moved" if self.synchronizer.placement_mode == 'move' else "placed"
+        self.results_text.insert(tk.END, f"  • Unique images {verb}: {stats.get('unique_images', 0)}\n")
         self.results_text.insert(tk.END, f"  • Total images processed: {stats.get('total_processed', 0)}\n")
-        self.results_text.insert(tk.END, f"  • Errors encountered: {stats.get('errors', 0)}\n\n")
+        self.results_text.insert(tk.END, f"  • Errors encountered: {stats.get('errors', 0)}\n")
+        if stats.get('library_matches', 0) > 0:
+            self.results_text.insert(tk.END, f"  • Matched to images already in the output folder: "
+                                             f"{stats['library_matches']}\n")
+        self.results_text.insert(tk.END, "\n")
         
         self.results_text.insert(tk.END, f"📁 Output folder: {self.output_path.get()}\n")
         self.results_text.insert(tk.END, f"  • Similar images are in folders named 'similar_[context]'\n")
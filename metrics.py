@@ -0,0 +1,223 @@
+"""
+Run metrics for Automatic Image Sync
+Per-stage counters and latency histograms, exported as JSON or in Prometheus text format
+"""
+
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Sequence, Tuple
+
+
+PREFIX = "image_sync_"
+
+# Counters, by name: help text. Every value is labelled with the stage it belongs to.
+COUNTERS = {
+    'files_scanned': "Image files found in the source folders",
+    'bytes_read': "Bytes read from image files for digests and decoding",
+    'files_hashed': "Images decoded and hashed (hash cache hits excluded)",
+    'cache_hits': "Images whose hashes came from the hash cache",
+    'files_skipped': "Oversized images left without perceptual hashes",
+    'comparisons': "Candidate pairs compared hash by hash",
+    'candidates_pruned': "Image pairs never compared because no index lookup paired them",
+    'pairs_settled': "Compared pairs settled by each hash type (the stage label is the hash type)",
+    'files_placed': "Files moved, copied or linked into the output folder",
+    'errors': "Files that could not be scanned, hashed or placed",
+}
+
+# Histograms, by name: help text
+HISTOGRAMS = {
+    'decode_seconds': "Time to decode one image (including reduced-scale decodes)",
+    'hash_seconds': "Time to compute the four perceptual hashes of one decoded image",
+    'stage_seconds': "Wall time of a whole stage",
+    'placement_latency_seconds': "Watch mode: time from a new file being seen to it being placed",
+}
+
+# Upper bounds of the histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus layout"""
+
+    __slots__ = ('bounds', 'counts', 'count', 'sum')
+
+    def __init__(self, bounds: Sequence[float] = LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)  # the last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """(upper bound, observations at or below it) pairs, ending with +Inf"""
+        total = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+    def snapshot(self) -> dict:
+        mean = self.sum / self.count if self.count else 0.0
+        return {"count": self.count, "sum": round(self.sum, 6), "mean": round(mean, 6),
+                "buckets": {_format_bound(bound): count for bound, count in self.cumulative()}}
+
+
+def _format_bound(bound: float) -> str:
+    return "+Inf" if bound == float('inf') else repr(bound)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metrics:
+    """Counters and latency histograms of a synchronizer, labelled by stage
+
+    Stages are the pipeline steps ('scan', 'digest', 'hash', 'compare',
+    'place', 'library'); watch mode uses the same names, plus 'watch' for its
+    placement latency. Updates are safe from
+    worker threads. snapshot() and save() give a JSON summary of a run;
+    prometheus_text() and serve() expose the same values for scraping while a
+    long-running session is up.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[Tuple[str, str], float] = {}
+        self.histograms: Dict[Tuple[str, str], Histogram] = {}
+        self.started = time.time()
+
+    def inc(self, name: str, stage: str, value: float = 1):
+        """Add value to a counter"""
+        if name not in COUNTERS:
+            raise KeyError(f"Unknown counter '{name}'")
+        if not value:
+            return
+        with self._lock:
+            key = (name, stage)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, stage: str, seconds: float):
+        """Record one observation in a histogram"""
+        if name not in HISTOGRAMS:
+            raise KeyError(f"Unknown histogram '{name}'")
+        with self._lock:
+            histogram = self.histograms.get((name, stage))
+            if histogram is None:
+                histogram = self.histograms[(name, stage)] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timed(self, stage: str):
+        """Record the wall time of a block as the stage's stage_seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('stage_seconds', stage, time.perf_counter() - start)
+
+    def record_hashed(self, size: int, timings: Dict[str, float], ok: bool, stage: str = 'hash'):
+        """Count one image read and decoded, with the times ImageProcessor.get_image_hashes reported
+
+        An image that could not be decoded (ok False) counts as an error.
+        """
+        self.inc('bytes_read', stage, size)
+        self.inc('files_hashed' if ok else 'errors', stage)
+        if 'decode' in timings:
+            self.observe('decode_seconds', stage, timings['decode'])
+        if 'hash' in timings:
+            self.observe('hash_seconds', stage, timings['hash'])
+
+    def counter(self, name: str, stage: Optional[str] = None) -> float:
+        """A counter's value for one stage, or summed over all stages"""
+        with self._lock:
+            return sum(value for (n, s), value in self.counters.items()
+                       if n == name and (stage is None or s == stage))
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.started = time.time()
+
+    def snapshot(self) -> dict:
+        """Every counter and histogram as nested dicts: name -> stage -> value"""
+        with self._lock:
+            counters: Dict[str, Dict[str, float]] = {}
+            for (name, stage), value in sorted(self.counters.items()):
+                counters.setdefault(name, {})[stage] = value
+            histograms: Dict[str, Dict[str, dict]] = {}
+            for (name, stage), histogram in sorted(self.histograms.items()):
+                histograms.setdefault(name, {})[stage] = histogram.snapshot()
+        return {"started": self.started, "elapsed_seconds": round(time.time() - self.started, 3),
+                "counters": counters, "histograms": histograms}
+
+    def save(self, path):
+        """Write snapshot() as JSON, replacing the file atomically"""
+        path = os.fspath(path)
+        temporary = f"{path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, indent=2)
+            f.write("\n")
+        os.replace(temporary, path)
+
+    def prometheus_text(self) -> str:
+        """All metrics in the Prometheus text exposition format (version 0.0.4)"""
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(h.cumulative()), h.sum, h.count)) for key, h in self.histograms.items())
+        lines = []
+        for name, help_text in COUNTERS.items():
+            values = [(stage, value) for (n, stage), value in counters if n == name]
+            if not values:
+                continue
+            metric = f"{PREFIX}{name}_total"
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter"]
+            lines += [f'{metric}{{stage="{_escape(stage)}"}} {value!r}' for stage, value in values]
+        for name, help_text in HISTOGRAMS.items():
+            values = [(stage, data) for (n, stage), data in histograms if n == name]
+            if not values:
+                continue
+            metric = f"{PREFIX}{name}"
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} histogram"]
+            for stage, (buckets, total, count) in values:
+                label = f'stage="{_escape(stage)}"'
+                lines += [f'{metric}_bucket{{{label},le="{_format_bound(bound)}"}} {cumulative}'
+                          for bound, cumulative in buckets]
+                lines += [f"{metric}_sum{{{label}}} {total!r}", f"{metric}_count{{{label}}} {count}"]
+        lines += [f"# HELP {PREFIX}start_time_seconds When the metrics were started (Unix time)",
+                  f"# TYPE {PREFIX}start_time_seconds gauge",
+                  f"{PREFIX}start_time_seconds {self.started!r}"]
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+        """Serve prometheus_text() at /metrics from a background thread; shut down() the result to stop"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/metrics", "/"):
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+        return server
@@ -0,0 +1,355 @@
+"""
+File placement engine for Automatic Image Sync
+Moves, copies or links files into destination folders in parallel, resolving name conflicts in memory
+"""
+
+import errno
+import os
+import shutil
+import stat
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional, Set, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+MODES = ('move', 'copy', 'hardlink', 'reflink', 'symlink')
+
+# Operations per task; large destination folders are split so they still run in parallel
+OPS_PER_TASK = 256
+COPY_CHUNK = 1 << 30
+FICLONE = 0x40049409  # Linux ioctl: share all extents of another file (btrfs, XFS)
+
+# Errors meaning "this filesystem cannot do that", after which a plain copy is made
+UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP,
+               errno.ENOTTY, errno.EPERM, errno.EMLINK}
+
+
+def copy_file_data(source: str, destination: str):
+    """Copy file contents in the kernel where possible, never replacing an existing file
+
+    Uses os.copy_file_range (which lets filesystems share extents or copy
+    server-side), then os.sendfile, then a plain buffered copy.
+    """
+    with open(source, "rb") as src:
+        fd = os.open(destination, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            with open(fd, "wb") as dst:
+                _copy_open_files(src, dst)
+        except BaseException:
+            os.unlink(destination)
+            raise
+
+
+def _copy_open_files(src, dst):
+    """Copy between two open files, trying the kernel copy calls first"""
+    size = os.fstat(src.fileno()).st_size
+    for copy in (getattr(os, 'copy_file_range', None), getattr(os, 'sendfile', None)):
+        if copy is None:
+            continue
+        try:
+            offset = 0
+            while offset < size:
+                if copy is os.sendfile:
+                    sent = copy(dst.fileno(), src.fileno(), offset, min(COPY_CHUNK, size - offset))
+                else:
+                    sent = copy(src.fileno(), dst.fileno(), min(COPY_CHUNK, size - offset), offset)
+                if not sent:
+                    break
+                offset += sent
+            if offset >= size:
+                return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                               errno.ENOTSUP, errno.EBADF, errno.ETXTBSY):
+                raise
+        # Start over with the next method
+        os.ftruncate(dst.fileno(), 0)
+        dst.seek(0)
+        src.seek(0)
+    shutil.copyfileobj(src, dst, 1 << 20)
+
+
+def copy_file(source: str, destination: str):
+    """Copy a file with its timestamps"""
+    copy_file_data(source, destination)
+    shutil.copystat(source, destination)
+
+
+def move_file(source: str, destination: str, same_device: bool):
+    """Move a file with a rename when possible, else copy and delete"""
+    if same_device:
+        try:
+            os.rename(source, destination)
+            return
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+    copy_file(source, destination)
+    os.unlink(source)
+
+
+def hardlink_file(source: str, destination: str):
+    """Hard-link a file, copying it where links are impossible (e.g. across filesystems)"""
+    try:
+        os.link(source, destination)
+    except OSError as e:
+        if e.errno not in UNSUPPORTED:
+            raise
+        copy_file(source, destination)
+
+
+def reflink_file(source: str, destination: str):
+    """Clone a file with FICLONE so it shares storage until modified, else copy it"""
+    if fcntl is not None:
+        with open(source, "rb") as src:
+            fd = os.open(destination, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+            try:
+                fcntl.ioctl(fd, FICLONE, src.fileno())
+            except OSError as e:
+                os.close(fd)
+                os.unlink(destination)
+                if e.errno not in UNSUPPORTED:
+                    raise
+            else:
+                os.close(fd)
+                shutil.copystat(source, destination)
+                return
+    copy_file(source, destination)
+
+
+def symlink_file(source: str, destination: str):
+    """Create a symbolic link to the absolute source path"""
+    os.symlink(os.path.abspath(source), destination)
+
+
+class PlacementEngine:
+    """Collects source -> folder placements, then carries them out in parallel
+
+    Destination names are chosen up front from an in-memory set of the names in
+    each folder (read once with os.scandir), so conflicts are resolved without a
+    stat per candidate name. Names are compared case-insensitively, which keeps
+    results valid on case-insensitive filesystems.
+
+    mode is one of MODES. An operation added with link_to is instead placed as a
+    hard link to the destination of that earlier operation (one physical copy for
+    exact duplicates); in move mode its source is then removed. Operations in
+    relocations are always moves, whatever the mode (files already in the output
+    folder that change folders).
+    """
+
+    def __init__(self, max_workers: int = 8, stop_event: Optional[threading.Event] = None, mode: str = 'move'):
+        if mode not in MODES:
+            raise ValueError(f"Unknown placement mode '{mode}', expected one of {MODES}")
+        self.max_workers = max_workers
+        self.stop_event = stop_event
+        self.mode = mode
+        self.operations: List[Tuple[str, str, Optional[int], Optional[int]]] = []
+        self.relocations: Set[int] = set()
+        self.placed = bytearray()
+        self._names: Dict[str, Set[str]] = {}
+        self._devices: Dict[str, int] = {}
+        self._op_dirs: List[str] = []
+
+    def _names_in(self, directory: str) -> Set[str]:
+        names = self._names.get(directory)
+        if names is None:
+            names = set()
+            try:
+                with os.scandir(directory) as entries:
+                    names.update(entry.name.casefold() for entry in entries)
+            except OSError:
+                pass
+            self._names[directory] = names
+        return names
+
+    def reserve(self, directory, name: str) -> str:
+        """Claim a free file name in a folder: name, then stem_1, stem_2, ..."""
+        directory = os.fspath(directory)
+        names = self._names_in(directory)
+        candidate = name
+        if candidate.casefold() in names:
+            stem, suffix = os.path.splitext(name)
+            counter = 1
+            while candidate.casefold() in names:
+                candidate = f"{stem}_{counter}{suffix}"
+                counter += 1
+        names.add(candidate.casefold())
+        return os.path.join(directory, candidate)
+
+    def add(self, source, directory, source_device: Optional[int] = None, link_to: Optional[int] = None,
+            relocate: bool = False) -> int:
+        """Plan to place source into directory; returns the operation index"""
+        source = os.fspath(source)
+        directory = os.fspath(directory)
+        destination = self.reserve(directory, os.path.basename(source))
+        index = self.add_operation(source, destination, source_device, link_to)
+        if relocate:
+            self.relocations.add(index)
+        return index
+
+    def add_operation(self, source: str, destination: str, source_device: Optional[int] = None,
+                      link_to: Optional[int] = None) -> int:
+        """Add an operation whose destination was already chosen (e.g. by a saved plan)"""
+        self.operations.append((source, destination, source_device, link_to))
+        self._op_dirs.append(os.path.dirname(destination))
+        return len(self.operations) - 1
+
+    def _device_of(self, directory: str) -> int:
+        device = self._devices.get(directory)
+        if device is None:
+            device = self._devices[directory] = os.stat(directory).st_dev
+        return device
+
+    def _tasks(self, indices: List[int]) -> List[List[int]]:
+        """Operation indices grouped by destination folder, split into chunks"""
+        by_directory: Dict[str, List[int]] = {}
+        for index in indices:
+            by_directory.setdefault(self._op_dirs[index], []).append(index)
+        return [indices[i:i + OPS_PER_TASK]
+                for indices in by_directory.values()
+                for i in range(0, len(indices), OPS_PER_TASK)]
+
+    def run(self, progress=None, journal=None, indices: Optional[List[int]] = None) -> Dict[int, Exception]:
+        """Carry out all operations (or those in indices); returns the errors by operation index
+
+        placed[i] is set for every operation that completed; operations already
+        marked placed before the call are skipped. progress, if given, is called
+        with (done, total) as tasks finish. journal, if given, gets a
+        record(index, linked) call for every completed operation.
+        """
+        errors: Dict[int, Exception] = {}
+        if len(self.placed) < len(self.operations):
+            self.placed += bytearray(len(self.operations) - len(self.placed))
+        if indices is None:
+            indices = range(len(self.operations))
+        for directory in {self._op_dirs[index] for index in indices}:
+            try:
+                os.makedirs(directory, exist_ok=True)
+                self._device_of(directory)
+            except OSError as e:
+                for index in indices:
+                    if self._op_dirs[index] == directory:
+                        errors[index] = e
+        unavailable = set(errors)
+
+        def place(indices: List[int]) -> Dict[int, Exception]:
+            failed = {}
+            for index in indices:
+                if (self.placed[index] or index in unavailable
+                        or (self.stop_event is not None and self.stop_event.is_set())):
+                    continue
+                try:
+                    linked = self.place_one(index)
+                    self.placed[index] = 1
+                except Exception as e:
+                    failed[index] = e
+                    continue
+                if journal is not None:
+                    journal.record(index, linked)
+            return failed
+
+        # Links to other destinations run once those destinations exist
+        first = [i for i in indices if self.operations[i][3] is None]
+        second = [i for i in indices if self.operations[i][3] is not None]
+        phases = [self._tasks(phase) for phase in (first, second)]
+        total = len(first) + len(second)
+        done = 0
+        if all(len(tasks) <= 1 for tasks in phases):
+            # A few operations into one folder (watch mode places files one at a time): no pool to start
+            for task in phases[0] + phases[1]:
+                errors.update(place(task))
+                done += len(task)
+                if progress:
+                    progress(done, total)
+            return errors
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="place") as executor:
+            for tasks in phases:
+                futures = {executor.submit(place, indices): len(indices) for indices in tasks}
+                for future in as_completed(futures):
+                    errors.update(future.result())
+                    done += futures[future]
+                    if progress:
+                        progress(done, total)
+        return errors
+
+    def place_one(self, index: int) -> bool:
+        """Carry out one operation; returns True if it was placed as a link to its link_to target"""
+        source, destination, source_device, link_to = self.operations[index]
+        if index in self.relocations:
+            move_file(source, destination, True)
+            return False
+        if link_to is not None and self.placed[link_to]:
+            hardlink_file(self.operations[link_to][1], destination)
+            if self.mode == 'move':
+                os.unlink(source)
+            return True
+        if self.mode == 'move':
+            same_device = source_device is None or source_device == self._devices[self._op_dirs[index]]
+            move_file(source, destination, same_device)
+        elif self.mode == 'copy':
+            copy_file(source, destination)
+        elif self.mode == 'hardlink':
+            hardlink_file(source, destination)
+        elif self.mode == 'reflink':
+            reflink_file(source, destination)
+        else:
+            symlink_file(source, destination)
+        return False
+
+    def recover(self, index: int) -> Optional[bool]:
+        """Recognise an operation an interrupted run completed without recording it
+
+        Returns None if the destination does not exist, else whether it holds the
+        operation's result (linked ops are recognised as links). A move that had
+        copied its file but not yet removed the source is finished here.
+        """
+        source, destination, _, link_to = self.operations[index]
+        mode = 'move' if index in self.relocations else self.mode
+        try:
+            placed = os.lstat(destination)
+        except FileNotFoundError:
+            return None
+        try:
+            source_stat = os.stat(source)
+        except FileNotFoundError:
+            source_stat = None
+        if mode == 'symlink' and link_to is None:
+            return stat.S_ISLNK(placed.st_mode) and os.readlink(destination) == os.path.abspath(source)
+        if link_to is not None:
+            try:
+                if os.path.samefile(self.operations[link_to][1], destination):
+                    if mode == 'move' and source_stat is not None:
+                        os.unlink(source)
+                    return True
+            except FileNotFoundError:
+                pass
+        if source_stat is None:
+            # Only a finished move removes its source
+            return mode == 'move'
+        if os.path.samestat(source_stat, placed) or (
+                source_stat.st_size == placed.st_size and source_stat.st_mtime_ns == placed.st_mtime_ns):
+            # Hard links share the inode; copies get the source mtime as their last step
+            if mode == 'move':
+                os.unlink(source)
+            return True
+        return False
+
+    def undo(self, index: int, linked: bool = False):
+        """Reverse a completed operation: moves go back to their source, anything else is deleted"""
+        source, destination, _, _ = self.operations[index]
+        if self.mode != 'move' and index not in self.relocations:
+            os.unlink(destination)
+            return
+        if os.path.lexists(source):
+            raise FileExistsError(errno.EEXIST, "Source path is in use again", source)
+        os.makedirs(os.path.dirname(source), exist_ok=True)
+        if linked:
+            hardlink_file(destination, source)
+            os.unlink(destination)
+        else:
+            move_file(destination, source, True)
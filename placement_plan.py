@@ -0,0 +1,356 @@
+"""
+Placement plans for Automatic Image Sync
+A reviewable list of source -> destination operations, applied with a resumable journal
+"""
+
+import base64
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from placement import MODES, PlacementEngine
+
+
+PLAN_FORMAT = 1
+
+# The journal is fsynced after this many records or seconds, whichever comes first.
+# Records lost to a crash are recognised on disk by PlacementEngine.recover.
+JOURNAL_SYNC_RECORDS = 256
+JOURNAL_SYNC_SECONDS = 1.0
+
+PLACED = '+'
+LINKED = '='
+UNDONE = '-'
+
+
+def journal_path_for(plan_path) -> str:
+    """Default journal location for a plan file"""
+    return os.fspath(plan_path) + ".journal"
+
+
+class PlacementPlan:
+    """Every file operation of one organize run, decided before anything is touched
+
+    Operations are (source, destination, source_device, link_to) tuples as used
+    by PlacementEngine; unique[i] marks operations into the unique_images folder
+    and relocations the moves of files already in the library. vectors and
+    valid hold the perceptual hashes of the placed files for the library index
+    (library_entries maps relocations to their entries). Plans are saved as
+    gzipped JSON with directories interned, which keeps 100k-file plans at a few MB.
+    """
+
+    def __init__(self, output_folder, mode: str = 'move'):
+        if mode not in MODES:
+            raise ValueError(f"Unknown placement mode '{mode}', expected one of {MODES}")
+        self.output_folder = os.path.abspath(os.fspath(output_folder))
+        self.mode = mode
+        self.operations: List[Tuple[str, str, Optional[int], Optional[int]]] = []
+        self.unique = bytearray()
+        self.relocations: Set[int] = set()
+        self.similar_groups = 0
+        self.skipped = 0
+        self.hash_version = ""
+        self.vectors: Optional[np.ndarray] = None
+        self.valid: Optional[np.ndarray] = None
+        self.library_entries: Dict[int, int] = {}
+        self.library_matches = 0
+
+    def __len__(self) -> int:
+        return len(self.operations)
+
+    @classmethod
+    def from_engine(cls, engine: PlacementEngine, output_folder, unique: List[bool]) -> 'PlacementPlan':
+        """Take the planned (not yet run) operations of an engine"""
+        plan = cls(output_folder, engine.mode)
+        plan.operations = [(os.path.abspath(source), os.path.abspath(destination), device, link_to)
+                           for source, destination, device, link_to in engine.operations]
+        plan.unique = bytearray(unique)
+        plan.relocations = set(engine.relocations)
+        return plan
+
+    def engine(self, max_workers: int = 8, stop_event: Optional[threading.Event] = None) -> PlacementEngine:
+        """Create an engine holding this plan's operations"""
+        engine = PlacementEngine(max_workers, stop_event, self.mode)
+        for operation in self.operations:
+            engine.add_operation(*operation)
+        engine.relocations = set(self.relocations)
+        return engine
+
+    def identity(self) -> str:
+        """Digest of the operations, used to tie a journal to its plan"""
+        hasher = hashlib.blake2b(digest_size=16)
+        hasher.update(self.mode.encode())
+        for source, destination, _, link_to in self.operations:
+            hasher.update(f"\0{source}\0{destination}\0{link_to}".encode("utf-8", "surrogateescape"))
+        hasher.update(repr(sorted(self.relocations)).encode())
+        return hasher.hexdigest()
+
+    def to_dict(self) -> Dict:
+        dirs: Dict[str, int] = {}
+
+        def split(path: str) -> Tuple[int, str]:
+            directory, name = os.path.split(path)
+            return dirs.setdefault(directory, len(dirs)), name
+
+        operations = []
+        for (source, destination, device, link_to), unique in zip(self.operations, self.unique):
+            operations.append([*split(source), *split(destination), device, link_to, unique])
+        data = {
+            "format": PLAN_FORMAT,
+            "mode": self.mode,
+            "output": self.output_folder,
+            "similar_groups": self.similar_groups,
+            "skipped": self.skipped,
+            "dirs": list(dirs),
+            "operations": operations,
+            "relocations": sorted(self.relocations),
+        }
+        if self.vectors is not None:
+            data["library"] = {
+                "version": self.hash_version,
+                "hash_words": self.vectors.shape[1],
+                "vectors": base64.b64encode(self.vectors.astype("<u8").tobytes()).decode("ascii"),
+                "valid": base64.b64encode(np.packbits(self.valid)).decode("ascii"),
+                "entries": {str(index): entry for index, entry in self.library_entries.items()},
+                "matches": self.library_matches,
+            }
+        return data
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'PlacementPlan':
+        if data.get("format") != PLAN_FORMAT:
+            raise ValueError(f"Unsupported plan format {data.get('format')}")
+        plan = cls(data["output"], data["mode"])
+        plan.similar_groups = data.get("similar_groups", 0)
+        plan.skipped = data.get("skipped", 0)
+        dirs = data["dirs"]
+        for source_dir, source_name, dest_dir, dest_name, device, link_to, unique in data["operations"]:
+            plan.operations.append((os.path.join(dirs[source_dir], source_name),
+                                    os.path.join(dirs[dest_dir], dest_name), device, link_to))
+            plan.unique.append(unique)
+        plan.relocations = set(data.get("relocations", ()))
+        library = data.get("library")
+        if library is not None:
+            plan.hash_version = library["version"]
+            vectors = np.frombuffer(base64.b64decode(library["vectors"]), dtype="<u8")
+            plan.vectors = vectors.astype(np.uint64).reshape(len(plan), library["hash_words"])
+            valid = np.unpackbits(np.frombuffer(base64.b64decode(library["valid"]), dtype=np.uint8))
+            plan.valid = valid[:len(plan)].astype(bool)
+            plan.library_entries = {int(index): entry for index, entry in library["entries"].items()}
+            plan.library_matches = library.get("matches", 0)
+        return plan
+
+    def save(self, path):
+        """Write the plan (atomically replacing an existing file)"""
+        path = os.fspath(path)
+        temporary = path + ".tmp"
+        with gzip.open(temporary, "wt", encoding="utf-8", errors="surrogateescape") as f:
+            json.dump(self.to_dict(), f, separators=(",", ":"))
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path) -> 'PlacementPlan':
+        with gzip.open(os.fspath(path), "rt", encoding="utf-8", errors="surrogateescape") as f:
+            return cls.from_dict(json.load(f))
+
+
+def read_journal(path, plan_id: Optional[str] = None) -> Tuple[Dict[int, str], int]:
+    """Completed operations a journal records, and the length of a torn last line
+
+    Raises ValueError if plan_id is given and the journal belongs to another plan.
+    """
+    with open(os.fspath(path), "rb") as f:
+        data = f.read()
+    lines = data.decode("ascii").split("\n")
+    header = json.loads(lines[0]) if lines[0] else {}
+    if plan_id is not None and header.get("plan") != plan_id:
+        raise ValueError(f"Journal {os.fspath(path)} belongs to another plan")
+    state: Dict[int, str] = {}
+    for line in lines[1:-1]:
+        kind, index = line[:1], int(line[1:])
+        state.pop(index, None)
+        if kind != UNDONE:
+            state[index] = kind
+    return state, len(lines[-1])
+
+
+def unfinished_operations(plan_path, journal_path) -> int:
+    """Operations of a partly applied plan that are neither placed nor rolled back
+
+    0 when the journal records none of the plan's operations (never applied, or
+    rolled back) or all of them. Raises ValueError (or OSError) when the plan
+    cannot be read or is not the one the journal belongs to.
+    """
+    plan = PlacementPlan.load(plan_path)
+    state, _ = read_journal(journal_path, plan.identity())
+    return len(plan) - len(state) if state else 0
+
+
+class OperationJournal:
+    """Append-only record of the operations of one plan that were carried out
+
+    The first line names the plan; every further line is '+N' (operation N
+    placed), '=N' (placed as a hard link to its link_to target) or '-N'
+    (rolled back). Records are buffered and fsynced in batches; a torn last
+    line is ignored when the journal is read back.
+    """
+
+    def __init__(self, path, plan_id: str):
+        self.path = os.fspath(path)
+        self.plan_id = plan_id
+        # Completed operations in the order they were carried out
+        self.state: Dict[int, str] = {}
+        self._lock = threading.Lock()
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+        if os.path.exists(self.path):
+            self._replay()
+            self._file = open(self.path, "a", encoding="ascii")
+        else:
+            self._file = open(self.path, "w", encoding="ascii")
+            self._file.write(json.dumps({"format": PLAN_FORMAT, "plan": plan_id}) + "\n")
+            self.sync()
+
+    def _replay(self):
+        self.state, torn = read_journal(self.path, self.plan_id)
+        # The text after the last newline is a record that was cut off; drop it
+        # so new records start on a line of their own
+        if torn:
+            os.truncate(self.path, os.path.getsize(self.path) - torn)
+
+    def record(self, index: int, linked: bool = False):
+        """Append a completed operation"""
+        self._append(LINKED if linked else PLACED, index)
+
+    def record_undone(self, index: int):
+        """Append a rolled back operation"""
+        self._append(UNDONE, index)
+
+    def _append(self, kind: str, index: int):
+        with self._lock:
+            self._file.write(f"{kind}{index}\n")
+            if kind == UNDONE:
+                self.state.pop(index, None)
+            else:
+                self.state[index] = kind
+            self._unsynced += 1
+            if (self._unsynced >= JOURNAL_SYNC_RECORDS
+                    or time.monotonic() - self._last_sync >= JOURNAL_SYNC_SECONDS):
+                self._sync_locked()
+
+    def _sync_locked(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def sync(self):
+        """Flush buffered records to disk"""
+        with self._lock:
+            self._sync_locked()
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._sync_locked()
+                self._file.close()
+
+
+def apply_plan(plan: PlacementPlan, journal_path, max_workers: int = 8,
+               stop_event: Optional[threading.Event] = None,
+               progress=None) -> Tuple[PlacementEngine, Dict[int, Exception]]:
+    """Carry out a plan, resuming from its journal if one exists
+
+    Operations the journal records are skipped. For the others, an existing
+    destination is checked with PlacementEngine.recover: results an interrupted
+    run left unrecorded are accepted, anything else is reported as a conflict
+    rather than overwritten. Returns the engine (see engine.placed) and the errors.
+    """
+    engine = plan.engine(max_workers, stop_event)
+    journal = OperationJournal(journal_path, plan.identity())
+    try:
+        engine.placed = bytearray(len(plan))
+        for index in journal.state:
+            engine.placed[index] = 1
+
+        errors: Dict[int, Exception] = {}
+        existing = _existing_names(plan)
+        for index, (_, destination, _, _) in enumerate(plan.operations):
+            if engine.placed[index]:
+                continue
+            directory, name = os.path.split(destination)
+            if name.casefold() not in existing.get(directory, ()):
+                continue
+            try:
+                recovered = engine.recover(index)
+            except OSError as e:
+                errors[index] = e
+                continue
+            if recovered:
+                engine.placed[index] = 1
+                journal.record(index, plan.operations[index][3] is not None)
+            elif recovered is not None:
+                errors[index] = FileExistsError(f"Destination already exists: {destination}")
+        for index in errors:
+            # Keep the engine from trying these
+            engine.placed[index] = 1
+        errors.update(engine.run(progress, journal))
+        for index in errors:
+            if index not in journal.state:
+                engine.placed[index] = 0
+    finally:
+        journal.close()
+    return engine, errors
+
+
+def rollback_plan(plan: PlacementPlan, journal_path,
+                  progress=None) -> Tuple[int, Dict[int, Exception]]:
+    """Reverse every operation the journal records, newest first
+
+    Moves are moved back, other placements are deleted; destination folders
+    left empty are removed. Returns the number rolled back and the errors.
+    """
+    engine = plan.engine()
+    journal = OperationJournal(journal_path, plan.identity())
+    errors: Dict[int, Exception] = {}
+    undone = 0
+    try:
+        completed = list(journal.state.items())
+        for done, (index, kind) in enumerate(reversed(completed), 1):
+            try:
+                engine.undo(index, kind == LINKED)
+            except OSError as e:
+                errors[index] = e
+                continue
+            journal.record_undone(index)
+            undone += 1
+            if progress:
+                progress(done, len(completed))
+    finally:
+        journal.close()
+
+    for directory in sorted({os.path.dirname(op[1]) for op in plan.operations}, reverse=True):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            pass
+    return undone, errors
+
+
+def _existing_names(plan: PlacementPlan) -> Dict[str, set]:
+    """Names present in each destination folder, read with one scandir per folder"""
+    names: Dict[str, set] = {}
+    for directory in {os.path.dirname(op[1]) for op in plan.operations}:
+        try:
+            with os.scandir(directory) as entries:
+                names[directory] = {entry.name.casefold() for entry in entries}
+        except OSError:
+            names[directory] = set()
+    return names
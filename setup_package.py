@@ -46,6 +46,9 @@ setup(
             "black>=21.0",
             "flake8>=3.8",
         ],
+        "fast": [
+            "xxhash>=3.0",
+        ],
     },
     entry_points={
         "console_scripts": [
@@ -0,0 +1,760 @@
+"""
+Near-neighbour index for Automatic Image Sync
+Finds every pair of hash vectors within a Hamming radius without comparing all pairs
+"""
+
+import math
+import threading
+from typing import Collection, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import hamming
+
+
+# Use the index only when exact substring matches are expected to keep fewer
+# than this fraction of all pairs as candidates; otherwise a blocked scan is faster
+MAX_CANDIDATE_FRACTION = 0.05
+
+BRUTE_FORCE_BLOCK_ROWS = 64
+BRUTE_FORCE_BLOCK_COLS = 65536
+VERIFY_CHUNK = 1 << 20
+# The cascade evaluates whole blocks while more than this share of their pairs is
+# undecided, then gathers the remaining pairs
+DENSE_FRACTION = 0.1
+
+# Sampled-bit tables (see HammingIndex) are only considered from this many rows,
+# and use between these many bits per key
+SAMPLED_MIN_ROWS = 4096
+SAMPLED_BITS = (8, 32)
+SAMPLED_SEED = 0x5EED
+# Estimated cost of one row in one sampled table, and of verifying one candidate,
+# relative to one pair of the blocked scan (see benchmark.py index)
+SAMPLED_ROW_COST = 8.0
+SAMPLED_VERIFY_COST = 10.0
+
+
+def radius_for_threshold(threshold: float, total_bits: int) -> int:
+    """Largest total Hamming distance whose average similarity still meets the threshold"""
+    radius = int(np.floor((1.0 - threshold) * total_bits + 1e-9))
+    return max(0, min(radius, total_bits))
+
+
+def split_bits(start: int, bits: int, count: int) -> List[Tuple[int, int]]:
+    """count disjoint (start, length) substrings of bits [start, start + bits)
+
+    No substring is longer than 64 bits or shorter than one, so count may be raised or lowered.
+    """
+    count = min(max(count, -(-bits // 64)), bits)
+    bounds = np.linspace(start, start + bits, count + 1).astype(np.int64)
+    return [(int(a), int(b - a)) for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+def candidate_fraction(substrings: Sequence[Tuple[int, int]]) -> float:
+    """Expected share of random pairs that agree on at least one substring"""
+    return sum(2.0 ** -length for _, length in substrings)
+
+
+def agreement_probability(bits: int, radius: int, sampled: int) -> float:
+    """Chance that two vectors radius of bits apart agree on sampled distinct random bits"""
+    return float(np.prod((bits - radius - np.arange(sampled)) / (bits - np.arange(sampled))))
+
+
+def equal_row_pairs(keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """All (i, j) pairs, i < j, of rows with identical keys
+
+    keys is a (rows,) or (rows, columns) integer array.
+    """
+    if keys.ndim == 1:
+        keys = keys[:, None]
+    n = len(keys)
+    if n < 2:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty
+
+    order = np.argsort(keys[:, 0], kind='stable') if keys.shape[1] == 1 else np.lexsort(keys.T[::-1])
+    sorted_keys = keys[order]
+    new_run = np.ones(n, dtype=bool)
+    new_run[1:] = np.any(sorted_keys[1:] != sorted_keys[:-1], axis=1)
+    run_start = np.flatnonzero(new_run)
+    run_end = np.append(run_start[1:], n)
+
+    # For each sorted position p, its partners are the later positions of its run
+    run_of = np.cumsum(new_run) - 1
+    partners = run_end[run_of] - np.arange(n) - 1
+    total = int(partners.sum())
+    if total == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty
+
+    first = np.repeat(np.arange(n), partners)
+    starts = np.repeat(np.cumsum(partners) - partners, partners)
+    second = first + 1 + (np.arange(total) - starts)
+
+    a, b = order[first], order[second]
+    return np.minimum(a, b), np.maximum(a, b)
+
+
+class DisjointSet:
+    """Union-find over row indices, with path compression and union by rank"""
+
+    def __init__(self, size: int):
+        self.parent = list(range(size))
+        self.rank = bytearray(size)
+
+    def find(self, x: int) -> int:
+        """Root of x's set, compressing the path to it"""
+        parent = self.parent
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    def union(self, a: int, b: int) -> int:
+        """Merge the sets of a and b and return the new root"""
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a == root_b:
+            return root_a
+        if self.rank[root_a] < self.rank[root_b]:
+            root_a, root_b = root_b, root_a
+        self.parent[root_b] = root_a
+        if self.rank[root_a] == self.rank[root_b]:
+            self.rank[root_a] += 1
+        return root_a
+
+    def union_pairs(self, first: np.ndarray, second: np.ndarray):
+        """Union every (first[k], second[k]) pair"""
+        for a, b in zip(first.tolist(), second.tolist()):
+            self.union(a, b)
+
+    def groups(self, min_size: int = 2) -> List[np.ndarray]:
+        """Members of every set with at least min_size rows, ordered by lowest member"""
+        roots = np.fromiter((self.find(x) for x in range(len(self.parent))), dtype=np.int64,
+                            count=len(self.parent))
+        order = np.argsort(roots, kind='stable')
+        boundaries = np.flatnonzero(np.diff(roots[order])) + 1
+        members = [m for m in np.split(order, boundaries) if len(m) >= min_size]
+        members.sort(key=lambda m: m[0])
+        return members
+
+
+class SimilarityCascade:
+    """Weighted, early-exit similarity test over concatenated hash vectors
+
+    Vectors hold one hash per type side by side (hash_words words each, in
+    hash_types order). Two images are similar when the weighted average of
+    their per-type similarities meets the threshold and at least min_matches
+    types meet it on their own. Types are compared in order of decreasing
+    weight, so the most selective hash goes first; a pair is settled as soon as
+    its weighted distance so far exceeds the budget (or could not exceed it even
+    if every remaining bit differed) and the per-type match count can no longer
+    (or already does) reach min_matches. decided[k] counts the pairs settled by
+    the k-th type compared.
+    """
+
+    def __init__(self, hash_types: Sequence[str], hash_words: int, threshold: float,
+                 weights: Optional[Dict[str, float]] = None, min_matches: int = 1, hash_bits: Optional[int] = None):
+        self.hash_types = list(hash_types)
+        self.hash_words = hash_words
+        self.hash_bits = hash_bits or hash_words * 64
+        self.threshold = threshold
+        raw = [max(0.0, float((weights or {}).get(t, 1.0))) for t in self.hash_types]
+        if not sum(raw):
+            raw = [1.0] * len(raw)
+        self.weights = [w / sum(raw) for w in raw]
+        self.min_matches = max(0, min(min_matches, len(self.hash_types)))
+        self.order = sorted(range(len(self.hash_types)), key=lambda k: -self.weights[k])
+        # Largest weighted distance (in bits) whose weighted similarity meets the threshold
+        self.budget = (1.0 - threshold) * self.hash_bits + 1e-9
+        self.type_radius = radius_for_threshold(threshold, self.hash_bits)
+        # Largest distance of each type a similar pair can have, the whole budget spent on it
+        self.type_radii = {t: self.hash_bits if not w else min(self.hash_bits, int(self.budget / w))
+                           for t, w in zip(self.hash_types, self.weights)}
+        # Every pair that can pass is within this plain Hamming distance of the whole
+        # vector: the budget spent on the lowest-weight types
+        reach, budget = 0, self.budget
+        for k in sorted(range(len(self.weights)), key=lambda k: self.weights[k]):
+            bits = self.hash_bits if self.weights[k] == 0 else min(self.hash_bits, int(budget / self.weights[k]))
+            reach += bits
+            budget -= bits * self.weights[k]
+            if budget <= 1e-9:
+                break
+        self.candidate_radius = min(reach, len(self.hash_types) * self.hash_bits)
+        self._substrings: Optional[List[Tuple[int, int]]] = None
+        self.decided = [0] * len(self.hash_types)
+        self.accepted = 0
+
+    @property
+    def substrings(self) -> List[Tuple[int, int]]:
+        """(start, length) bit substrings for index lookups, see _plan_substrings"""
+        if self._substrings is None:
+            self._substrings = self._plan_substrings()
+        return self._substrings
+
+    def _plan_substrings(self) -> List[Tuple[int, int]]:
+        """Bit substrings of which every similar pair shares at least one exactly
+
+        A pair agreeing on none of s substrings of a type differs in at least s
+        bits of it. So no similar pair is missed by substrings whose weighted
+        count exceeds the budget, nor by type_radius + 1 substrings in all but
+        min_matches - 1 types. Of the two, the allocation expected to find fewer
+        candidates is used; tighter thresholds need fewer, longer substrings.
+        Empty when neither rules anything out.
+        """
+        bits = self.hash_bits
+
+        def cost(count: int) -> float:
+            # candidate_fraction(split_bits(0, bits, count)) without building the list
+            if not count:
+                return 0.0
+            count = min(max(count, -(-bits // 64)), bits)
+            length, longer = divmod(bits, count)
+            return (count - longer) * 2.0 ** -length + longer * 2.0 ** -(length + 1)
+
+        # Weighted: add substrings where they buy the most weight per expected candidate
+        weighted = [0] * len(self.hash_types)
+        spent = 0.0
+        while spent <= self.budget:
+            open_types = [k for k, w in enumerate(self.weights) if w and weighted[k] < bits]
+            if not open_types:
+                break
+            k = min(open_types, key=lambda k: (cost(weighted[k] + 1) - cost(weighted[k])) / self.weights[k])
+            weighted[k] += 1
+            spent += self.weights[k]
+        plans = [weighted] if spent > self.budget else []
+        if self.min_matches and self.type_radius < bits:
+            unmatched = self.min_matches - 1
+            plans.append([0] * unmatched + [self.type_radius + 1] * (len(self.hash_types) - unmatched))
+        if not plans:
+            return []
+
+        counts = min(plans, key=lambda plan: sum(cost(count) for count in plan))
+        substrings = []
+        for k, count in enumerate(counts):
+            if count:
+                substrings.extend(split_bits(k * self.hash_words * 64, bits, count))
+        return substrings
+
+    def key(self) -> str:
+        """Identify the test, e.g. for checkpoints of its results"""
+        return f"{self.threshold!r};{self.weights!r};{self.min_matches}"
+
+    def stage_counts(self) -> Dict[str, int]:
+        """Pairs settled by each hash type, in the order they are compared"""
+        return {self.hash_types[k]: self.decided[stage] for stage, k in enumerate(self.order)}
+
+    def _settle(self, stage: int, partial: np.ndarray,
+                matches: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        """(rejected, accepted) masks after the stage-th type has been added
+
+        accepted is None while no pair can be accepted yet.
+        """
+        remaining = len(self.order) - stage - 1
+        remaining_weight = sum(self.weights[k] for k in self.order[stage + 1:])
+        rejected = partial > self.budget
+        if self.min_matches - remaining > 0:
+            rejected |= matches < self.min_matches - remaining
+        if remaining_weight * self.hash_bits > self.budget:
+            return rejected, None
+        accepted = ~rejected & (partial <= self.budget - remaining_weight * self.hash_bits)
+        if self.min_matches:
+            accepted &= matches >= self.min_matches
+        return rejected, accepted
+
+    def verify(self, left: np.ndarray, right: np.ndarray, first: np.ndarray, second: np.ndarray,
+               start: int = 0, partial: Optional[np.ndarray] = None,
+               matches: Optional[np.ndarray] = None) -> np.ndarray:
+        """Which pairs (left[first[m]], right[second[m]]) are similar
+
+        start, partial and matches continue pairs already compared on the first
+        start types.
+        """
+        count = len(first)
+        keep = np.zeros(count, dtype=bool)
+        partial = np.zeros(count) if partial is None else partial.astype(np.float64)
+        matches = np.zeros(count, dtype=np.int32) if matches is None else matches.astype(np.int32)
+        alive = np.arange(count)
+        for stage in range(start, len(self.order)):
+            if not len(alive):
+                break
+            k = self.order[stage]
+            cols = slice(k * self.hash_words, (k + 1) * self.hash_words)
+            distance = hamming.popcount(np.bitwise_xor(left[first[alive], cols],
+                                                       right[second[alive], cols])).sum(axis=-1, dtype=np.int32)
+            partial[alive] += self.weights[k] * distance
+            matches[alive] += distance <= self.type_radius
+            rejected, accepted = self._settle(stage, partial[alive], matches[alive])
+            if accepted is not None:
+                keep[alive[accepted]] = True
+                rejected |= accepted
+            self.decided[stage] += int(np.count_nonzero(rejected))
+            alive = alive[~rejected]
+        self.accepted += int(keep.sum())
+        return keep
+
+    def verify_block(self, block: np.ndarray, other: np.ndarray,
+                     mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """(i, j) of the similar pairs (block[i], other[j]), limited to mask if given
+
+        Types are compared on the whole block while many pairs are undecided,
+        then only on the pairs still undecided.
+        """
+        shape = (len(block), len(other))
+        undecided = np.ones(shape, dtype=bool) if mask is None else mask.copy()
+        keep = np.zeros(shape, dtype=bool)
+        partial = np.zeros(shape)
+        matches = np.zeros(shape, dtype=np.int8)
+        stage, pending = 0, np.count_nonzero(undecided)
+        while stage < len(self.order) and pending > DENSE_FRACTION * undecided.size:
+            k = self.order[stage]
+            distance = np.zeros(shape, dtype=np.int16)
+            for word in range(k * self.hash_words, (k + 1) * self.hash_words):
+                distance += hamming.popcount(np.bitwise_xor(block[:, word, None], other[None, :, word]))
+            partial += self.weights[k] * distance
+            matches += distance <= self.type_radius
+            rejected, accepted = self._settle(stage, partial, matches)
+            if accepted is not None:
+                accepted &= undecided
+                keep |= accepted
+                self.accepted += int(np.count_nonzero(accepted))
+                rejected |= accepted
+            undecided &= ~rejected
+            remaining = np.count_nonzero(undecided)
+            self.decided[stage] += int(pending - remaining)
+            pending = remaining
+            stage += 1
+
+        i, j = np.nonzero(undecided)
+        if len(i):
+            later = self.verify(block, other, i, j, stage, partial[i, j], matches[i, j])
+            keep[i[later], j[later]] = True
+        return np.nonzero(keep)
+
+
+class HammingIndex:
+    """Multi-index hashing over packed uint64 hash vectors
+
+    Vectors are split into radius + 1 disjoint bit substrings. By the pigeonhole
+    principle two vectors within the radius agree exactly on at least one
+    substring, so candidates come from exact substring matches and are then
+    verified with a full XOR + popcount. No pair within the radius is missed.
+    With a cascade, the substrings are the cascade's (split by hash type, fewer
+    as its threshold tightens) and candidates are verified by the cascade instead.
+
+    When the radius is too large for substrings to be selective (the cascade's
+    default 0.85 threshold among them) and recall is below 1, candidates come
+    from sampled-bit tables instead: each table keys
+    the rows by a few random bits, and a pair is a candidate when it agrees on
+    all of them in some table. With a cascade, every hash type gets its own
+    tables, and a similar pair has min_matches types within type_radius, each
+    another chance to be found. Enough tables are used that a pair at the
+    radius is found with probability recall; closer pairs are likelier still.
+    Candidates are verified as before, so nothing dissimilar is ever reported.
+    pairs() and query_many() each plan their tables for the work at hand and
+    fall back to a blocked vectorized scan of every pair when that is cheaper;
+    query() scans unless the substrings are used. The tables query_many()
+    probes can be built once with query_tables() and kept with the vectors.
+    """
+
+    def __init__(self, vectors: np.ndarray, radius: int, valid: Optional[np.ndarray] = None,
+                 cascade: Optional[SimilarityCascade] = None, recall: float = 1.0):
+        self.vectors = np.ascontiguousarray(vectors, dtype=np.uint64)
+        self.cascade = cascade
+        if cascade is not None:
+            radius = cascade.candidate_radius
+        self.radius = radius
+        self.recall = recall
+        self.total_bits = self.vectors.shape[1] * 64
+        self.rows = np.flatnonzero(valid) if valid is not None else np.arange(len(self.vectors))
+        self.comparisons = 0
+        self._tables: Optional[Dict[str, np.ndarray]] = None
+
+        if cascade is not None:
+            self.substrings = cascade.substrings
+        else:
+            self.substrings = split_bits(0, self.total_bits, radius + 1)
+        self.use_index = bool(self.substrings) and candidate_fraction(self.substrings) < MAX_CANDIDATE_FRACTION
+        # Bit positions of each sampled-bit table, empty unless pairs() uses them
+        self.sampled: List[np.ndarray] = []
+        if not self.use_index and recall < 1.0 and len(self.rows) >= SAMPLED_MIN_ROWS:
+            self.sampled = self._plan_sampled()
+
+    def _plan_sampled(self, queries: Optional[int] = None, stored: bool = False) -> List[np.ndarray]:
+        """Bit positions of the sampled-bit tables, or [] when the scan is expected to be faster
+
+        The bits per key are chosen to minimize the estimated cost: more bits
+        make random collisions rarer but need more tables for the same recall.
+        Positions come from a fixed seed, so the same rows always give the same
+        candidates (and an interrupted comparison can resume). queries, if given,
+        plans for that many vectors queried against the rows instead of the self-join;
+        stored leaves keying the rows out of the cost, as their tables are kept.
+        """
+        cascade = self.cascade
+        if cascade is not None and cascade.min_matches:
+            bits = cascade.hash_bits
+            domains = [k * cascade.hash_words * 64 + np.arange(bits) for k in range(len(cascade.hash_types))]
+            radius, chances = cascade.type_radius, cascade.min_matches
+        elif cascade is not None:
+            bits = cascade.hash_bits * len(cascade.hash_types)
+            domains = [np.concatenate([k * cascade.hash_words * 64 + np.arange(cascade.hash_bits)
+                                       for k in range(len(cascade.hash_types))])]
+            radius, chances = self.radius, 1
+        else:
+            bits = self.total_bits
+            domains = [np.arange(bits)]
+            radius, chances = self.radius, 1
+
+        n = len(self.rows)
+        if queries is None:
+            keyed, all_pairs = n, n * (n - 1) / 2
+        else:
+            keyed, all_pairs = queries if stored else n + queries, n * queries
+        best, best_cost = None, all_pairs  # the scan
+        low, high = SAMPLED_BITS
+        for sampled in range(low, min(high, bits - radius) + 1):
+            p = agreement_probability(bits, radius, sampled)
+            if p <= 0.0:
+                break
+            per_domain = math.ceil(math.log(1.0 - self.recall) / (chances * math.log1p(-p))) if p < 1.0 else 1
+            tables = per_domain * len(domains)
+            cost = tables * (keyed * SAMPLED_ROW_COST + all_pairs * 2.0 ** -sampled * SAMPLED_VERIFY_COST)
+            if cost < best_cost:
+                best, best_cost = (sampled, per_domain), cost
+        if best is None:
+            return []
+
+        sampled, per_domain = best
+        rng = np.random.default_rng(SAMPLED_SEED)
+        return [np.sort(rng.choice(domain, sampled, replace=False))
+                for domain in domains for _ in range(per_domain)]
+
+    @property
+    def mode(self) -> str:
+        """How pairs() finds its candidates: 'substrings', 'sampled' or 'scan'"""
+        if self.use_index:
+            return 'substrings'
+        return 'sampled' if self.sampled else 'scan'
+
+    def substring_keys(self, vectors: np.ndarray, start: int, length: int) -> np.ndarray:
+        """Extract bits [start, start + length) of each vector as an integer key"""
+        word, offset = divmod(start, 64)
+        key = vectors[:, word] << np.uint64(offset)
+        if offset + length > 64:
+            key |= vectors[:, word + 1] >> np.uint64(64 - offset)
+        return key >> np.uint64(64 - length)
+
+    @staticmethod
+    def sampled_keys(columns: np.ndarray, positions: np.ndarray) -> np.ndarray:
+        """Gather the bits at positions (MSB-first, as substring_keys) of each vector into an integer key
+
+        columns holds the vectors word by word, shape (words, rows).
+        """
+        key = np.zeros(columns.shape[1], dtype=np.uint64)
+        bit = np.empty_like(key)
+        one = np.uint64(1)
+        for k, position in enumerate(positions.tolist()):
+            word, offset = divmod(position, 64)
+            np.right_shift(columns[word], np.uint64(63 - offset), out=bit)
+            bit &= one
+            bit <<= np.uint64(k)
+            key |= bit
+        return key
+
+    def distances(self, first: np.ndarray, second: np.ndarray) -> np.ndarray:
+        """Full Hamming distance of each (first[k], second[k]) row pair"""
+        self.comparisons += len(first)
+        xor = np.bitwise_xor(self.vectors[first], self.vectors[second])
+        return hamming.popcount(xor).sum(axis=-1, dtype=np.int32)
+
+    def verify(self, queries: np.ndarray, first: np.ndarray, second: np.ndarray) -> np.ndarray:
+        """Which candidate pairs (queries[first[k]], row second[k]) match"""
+        if self.cascade is not None:
+            self.comparisons += len(first)
+            return self.cascade.verify(queries, self.vectors, first, second)
+        if queries is self.vectors:
+            return self.distances(first, second) <= self.radius
+        self.comparisons += len(first)
+        xor = np.bitwise_xor(queries[first], self.vectors[second])
+        return hamming.popcount(xor).sum(axis=-1, dtype=np.int32) <= self.radius
+
+    def _block_pairs(self, block: np.ndarray, other: np.ndarray,
+                     mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """(i, j) of the matching pairs between two blocks of vectors"""
+        if self.cascade is not None:
+            return self.cascade.verify_block(block, other, mask)
+        distance = np.zeros((len(block), len(other)), dtype=np.int32)
+        for word in range(block.shape[1]):
+            distance += hamming.popcount(np.bitwise_xor(block[:, word, None], other[None, :, word]))
+        within = distance <= self.radius
+        if mask is not None:
+            within &= mask
+        return np.nonzero(within)
+
+    def pairs(self, stop_event: Optional[threading.Event] = None, progress=None,
+              done_units: Collection[int] = (), on_unit=None) -> Tuple[np.ndarray, np.ndarray]:
+        """All row pairs (i < j) within the radius, sorted by (i, j)
+
+        progress, if given, is called with the fraction of work done. The work is
+        split into numbered units (verification chunks, sampled-bit tables, or row
+        blocks of the scan);
+        units in done_units are skipped and their pairs left out, and on_unit, if
+        given, is called with (unit, first, second) as each unit finishes. Together
+        they let an interrupted comparison resume.
+        """
+        if self.use_index:
+            first, second = self._index_pairs(stop_event, progress, done_units, on_unit)
+        elif self.sampled:
+            first, second = self._sampled_pairs(stop_event, progress, done_units, on_unit)
+        else:
+            first, second = self._scan_pairs(stop_event, progress, done_units, on_unit)
+        order = np.lexsort((second, first))
+        return first[order], second[order]
+
+    def _index_pairs(self, stop_event, progress, done_units, on_unit):
+        """Candidate pairs from exact substring matches, then verified"""
+        vectors = self.vectors[self.rows]
+        n = len(self.rows)
+        codes: List[np.ndarray] = []
+
+        for k, (start, length) in enumerate(self.substrings):
+            if stop_event is not None and stop_event.is_set():
+                break
+            first, second = equal_row_pairs(self.substring_keys(vectors, start, length))
+            codes.append(first * n + second)
+            if progress:
+                progress(0.5 * (k + 1) / len(self.substrings))
+
+        candidates = np.unique(np.concatenate(codes)) if codes else np.empty(0, dtype=np.int64)
+        found_first, found_second = [], []
+        for unit, offset in enumerate(range(0, len(candidates), VERIFY_CHUNK)):
+            if stop_event is not None and stop_event.is_set():
+                break
+            if unit not in done_units:
+                chunk = candidates[offset:offset + VERIFY_CHUNK]
+                first, second = self.rows[chunk // n], self.rows[chunk % n]
+                keep = self.verify(self.vectors, first, second)
+                found_first.append(first[keep])
+                found_second.append(second[keep])
+                if on_unit:
+                    on_unit(unit, found_first[-1], found_second[-1])
+            if progress:
+                progress(0.5 + 0.5 * min(1.0, (offset + VERIFY_CHUNK) / len(candidates)))
+
+        return self._concat(found_first), self._concat(found_second)
+
+    def _sampled_pairs(self, stop_event, progress, done_units, on_unit):
+        """Candidate pairs from each sampled-bit table, verified table by table
+
+        Close pairs agree in most tables; those already found are not verified again.
+        """
+        columns = np.ascontiguousarray(self.vectors[self.rows].T)
+        n = len(self.rows)
+        found = np.empty(0, dtype=np.int64)
+
+        for unit, positions in enumerate(self.sampled):
+            if stop_event is not None and stop_event.is_set():
+                break
+            if unit not in done_units:
+                first, second = equal_row_pairs(self.sampled_keys(columns, positions))
+                codes = first * n + second
+                if len(found):
+                    codes = codes[found[np.minimum(np.searchsorted(found, codes), len(found) - 1)] != codes]
+                first, second = self.rows[codes // n], self.rows[codes % n]
+                keep = np.zeros(len(codes), dtype=bool)
+                for offset in range(0, len(codes), VERIFY_CHUNK):
+                    chunk = slice(offset, offset + VERIFY_CHUNK)
+                    keep[chunk] = self.verify(self.vectors, first[chunk], second[chunk])
+                found = np.union1d(found, codes[keep])
+                if on_unit:
+                    on_unit(unit, first[keep], second[keep])
+            if progress:
+                progress((unit + 1) / len(self.sampled))
+
+        return self.rows[found // n], self.rows[found % n]
+
+    def _scan_pairs(self, stop_event, progress, done_units, on_unit):
+        """Blocked all-pairs scan, accumulating distances one word at a time"""
+        vectors = self.vectors[self.rows]
+        n = len(self.rows)
+        total = n * (n - 1) // 2
+        done = 0
+        found_first, found_second = [], []
+
+        for unit, a in enumerate(range(0, n, BRUTE_FORCE_BLOCK_ROWS)):
+            if stop_event is not None and stop_event.is_set():
+                break
+            pairs_in_block = sum(n - r - 1 for r in range(a, min(a + BRUTE_FORCE_BLOCK_ROWS, n)))
+            done += pairs_in_block
+            if unit in done_units:
+                if progress and total:
+                    progress(done / total)
+                continue
+            block = vectors[a:a + BRUTE_FORCE_BLOCK_ROWS]
+            unit_first, unit_second = [], []
+            for b in range(a, n, BRUTE_FORCE_BLOCK_COLS):
+                other = vectors[b:b + BRUTE_FORCE_BLOCK_COLS]
+                # Only pairs i < j; the first column block overlaps the rows
+                upper = None
+                if b < a + len(block):
+                    upper = np.arange(b, b + len(other))[None, :] > np.arange(a, a + len(block))[:, None]
+                i, j = self._block_pairs(block, other, upper)
+                unit_first.append(self.rows[i + a])
+                unit_second.append(self.rows[j + b])
+            found_first.append(self._concat(unit_first))
+            found_second.append(self._concat(unit_second))
+            if on_unit:
+                on_unit(unit, found_first[-1], found_second[-1])
+            self.comparisons += pairs_in_block
+            if progress and total:
+                progress(done / total)
+
+        return self._concat(found_first), self._concat(found_second)
+
+    def query(self, vector: np.ndarray) -> np.ndarray:
+        """Rows within the radius of one vector (words,)"""
+        if not self.use_index:
+            candidates = self.rows
+        else:
+            if self._tables is None:
+                self._tables = self.query_tables()
+            found = []
+            query = vector[None, :]
+            for (start, length), keys, order in zip(self.substrings, self._tables['keys'], self._tables['rows']):
+                key = self.substring_keys(query, start, length)[0]
+                lo, hi = np.searchsorted(keys, key, 'left'), np.searchsorted(keys, key, 'right')
+                found.append(order[lo:hi])
+            candidates = np.unique(np.concatenate(found)) if found else np.empty(0, dtype=np.int64)
+
+        keep = self.verify(vector[None, :], np.zeros(len(candidates), dtype=np.int64), candidates)
+        return candidates[keep]
+
+    def query_tables(self, queries: Optional[int] = None) -> Dict[str, np.ndarray]:
+        """Sorted keys of the valid rows for query_many(), to build once and pass to every call
+
+        With the index there is one table per substring ('substrings' holds their
+        (start, length)). Otherwise, below full recall, sampled-bit tables may be
+        cheaper than scanning ('positions' holds each table's bits). 'keys' holds
+        each table's keys in sorted order and 'rows' the row of each key. Empty
+        when the rows are to be scanned. queries plans sampled tables for batches
+        of that many vectors; without it the tables are assumed to be kept, so
+        building them is left out of the estimate.
+        """
+        if self.use_index:
+            layout = {'substrings': np.array(self.substrings, dtype=np.int64).reshape(-1, 2)}
+        elif self.recall < 1.0 and len(self.rows) + (queries or 0) >= SAMPLED_MIN_ROWS:
+            positions = self._plan_sampled(queries or 1, stored=queries is None)
+            if not positions:
+                return {}
+            layout = {'positions': np.array(positions, dtype=np.int64)}
+        else:
+            return {}
+
+        vectors = np.asarray(self.vectors[self.rows])
+        keys = self._table_keys(vectors, layout)
+        rows = np.empty(keys.shape, dtype=np.int64)
+        for table, table_keys in enumerate(keys):
+            order = np.argsort(table_keys, kind='stable')
+            keys[table] = table_keys[order]
+            rows[table] = self.rows[order]
+        return dict(layout, keys=keys, rows=rows)
+
+    def _table_keys(self, vectors: np.ndarray, layout: Dict[str, np.ndarray]) -> np.ndarray:
+        """(tables, vectors) keys of each vector in the tables query_tables() describes"""
+        if 'substrings' in layout:
+            return np.stack([self.substring_keys(vectors, int(start), int(length))
+                             for start, length in layout['substrings'].tolist()])
+        columns = np.ascontiguousarray(vectors.T)
+        return np.stack([self.sampled_keys(columns, positions) for positions in layout['positions']])
+
+    def query_many(self, queries: np.ndarray,
+                   tables: Optional[Dict[str, np.ndarray]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """(query, row) pairs within the radius for a (m, words) block of vectors
+
+        Each query costs one binary search per table plus its verified candidates.
+        tables, as returned by query_tables() for these rows and settings (arrays
+        may be memory maps), saves building them; by default the substring tables
+        are built once and kept, and sampled-bit tables are planned for these
+        queries. Without tables the queries are scanned against all rows in
+        blocks. vectors may be a read-only memory map.
+        """
+        queries = np.ascontiguousarray(queries, dtype=np.uint64)
+        if not len(queries) or not len(self.rows):
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty
+        if tables is None:
+            if self.use_index:
+                if self._tables is None:
+                    self._tables = self.query_tables()
+                tables = self._tables
+            else:
+                tables = self.query_tables(len(queries))
+        if not tables:
+            return self._scan_queries(queries)
+
+        query_keys = self._table_keys(queries, tables)
+        if 'positions' in tables:
+            return self._sampled_queries(queries, tables, query_keys)
+        codes = []
+        for table, keys in enumerate(query_keys):
+            code = self._lookup(tables['keys'][table], tables['rows'][table], keys)
+            if len(code):
+                codes.append(code)
+        if not codes:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty
+
+        candidates = np.unique(np.concatenate(codes))
+        found_query, found_row = [], []
+        for offset in range(0, len(candidates), VERIFY_CHUNK):
+            chunk = candidates[offset:offset + VERIFY_CHUNK]
+            query, row = chunk // len(self.vectors), chunk % len(self.vectors)
+            keep = self.verify(queries, query, row)
+            found_query.append(query[keep])
+            found_row.append(row[keep])
+        return self._concat(found_query), self._concat(found_row)
+
+    def _lookup(self, keys: np.ndarray, order: np.ndarray, query_keys: np.ndarray) -> np.ndarray:
+        """query * len(vectors) + row for every row whose sorted key equals a query's key"""
+        lo = np.searchsorted(keys, query_keys, 'left')
+        counts = np.searchsorted(keys, query_keys, 'right') - lo
+        total = int(counts.sum())
+        # Expand each query's [lo, hi) range of the sorted table
+        query = np.repeat(np.arange(len(query_keys), dtype=np.int64), counts)
+        position = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+        return query * len(self.vectors) + np.asarray(order[position], dtype=np.int64)
+
+    def _sampled_queries(self, queries: np.ndarray, tables: Dict[str, np.ndarray],
+                         query_keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Candidates from each sampled-bit table, verified table by table as in _sampled_pairs"""
+        found = np.empty(0, dtype=np.int64)
+        for table, keys in enumerate(query_keys):
+            codes = np.unique(self._lookup(tables['keys'][table], tables['rows'][table], keys))
+            if len(found):
+                codes = codes[found[np.minimum(np.searchsorted(found, codes), len(found) - 1)] != codes]
+            keep = np.zeros(len(codes), dtype=bool)
+            for offset in range(0, len(codes), VERIFY_CHUNK):
+                chunk = codes[offset:offset + VERIFY_CHUNK]
+                keep[offset:offset + len(chunk)] = self.verify(queries, chunk // len(self.vectors),
+                                                               chunk % len(self.vectors))
+            found = np.union1d(found, codes[keep])
+        return found // len(self.vectors), found % len(self.vectors)
+
+    def _scan_queries(self, queries: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Blocked scan of queries against every valid row"""
+        found_query, found_row = [], []
+        for b in range(0, len(self.rows), BRUTE_FORCE_BLOCK_COLS):
+            rows = self.rows[b:b + BRUTE_FORCE_BLOCK_COLS]
+            other = np.asarray(self.vectors[rows])
+            for a in range(0, len(queries), BRUTE_FORCE_BLOCK_ROWS):
+                block = queries[a:a + BRUTE_FORCE_BLOCK_ROWS]
+                i, j = self._block_pairs(block, other)
+                found_query.append(i + a)
+                found_row.append(rows[j])
+                self.comparisons += len(block) * len(other)
+        return self._concat(found_query), self._concat(found_row)
+
+    @staticmethod
+    def _concat(parts: List[np.ndarray]) -> np.ndarray:
+        return np.concatenate(parts).astype(np.int64) if parts else np.empty(0, dtype=np.int64)
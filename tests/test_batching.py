@@ -0,0 +1,108 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("PIL")
+
+import hash_kernel
+import image_processor
+from image_processor import ImageData, ImageProcessor, ImageSynchronizer
+
+
+MB = 2 ** 20
+
+
+class Recorder:
+    """Stands in for ImageData.compute, recording how many images hash at once"""
+
+    def __init__(self, costs):
+        self.costs = costs
+        self.lock = threading.Lock()
+        self.active = {}
+        self.peak_images = 0
+        self.peak_bytes = 0
+        self.alone = {}
+
+    def compute(self, img, cache=None, key=None, digest=True, reduced_decode=None, metrics=None):
+        name = img.file_path.name
+        with self.lock:
+            self.active[name] = self.costs(name)
+            self.peak_images = max(self.peak_images, len(self.active))
+            self.peak_bytes = max(self.peak_bytes, sum(self.active.values()))
+        time.sleep(0.01)
+        with self.lock:
+            self.alone[name] = len(self.active) == 1
+            del self.active[name]
+        img.image_hashes = {}
+        img.processed = True
+
+
+def run(tmp_path, monkeypatch, count, costs, batch_size=100, memory_mb=1024, workers=8, check=None):
+    for i in range(count):
+        (tmp_path / f"{i}.jpg").write_bytes(b"x")
+    recorder = Recorder(costs)
+    monkeypatch.setitem(image_processor.PERFORMANCE, 'BATCH_SIZE', batch_size)
+    monkeypatch.setitem(image_processor.PERFORMANCE, 'MAX_MEMORY_MB', memory_mb)
+    monkeypatch.setattr(ImageProcessor, 'check_image',
+                        staticmethod(check or (lambda path, size: ('hash', costs(path.name), ""))))
+    monkeypatch.setattr(ImageData, 'compute', lambda img, *args: recorder.compute(img, *args))
+    synchronizer = ImageSynchronizer(max_workers=workers, executor='thread')
+    images = synchronizer.collect_images(tmp_path)
+    assert synchronizer.process_images_parallel(images) == count
+    assert all(img.processed for img in images)
+    return recorder
+
+
+def test_memory_budget_limits_concurrency(tmp_path, monkeypatch):
+    recorder = run(tmp_path, monkeypatch, 40, lambda name: 40 * MB, memory_mb=100)
+    assert recorder.peak_bytes <= 100 * MB
+    assert recorder.peak_images == 2
+
+
+def test_image_over_the_budget_runs_alone(tmp_path, monkeypatch):
+    costs = lambda name: 500 * MB if name == "7.jpg" else 10 * MB
+    recorder = run(tmp_path, monkeypatch, 30, costs, memory_mb=100)
+    assert recorder.alone["7.jpg"]
+    assert recorder.peak_bytes <= 500 * MB
+
+
+def test_batch_size_limits_images_in_flight(tmp_path, monkeypatch):
+    # Never fewer than two images per worker
+    recorder = run(tmp_path, monkeypatch, 40, lambda name: 0, batch_size=3, workers=2)
+    assert recorder.peak_images <= 4
+    recorder = run(tmp_path, monkeypatch, 40, lambda name: 0, batch_size=100, workers=16)
+    assert recorder.peak_images > 4
+
+
+def test_headers_are_read_ahead_off_the_submitting_thread(tmp_path, monkeypatch):
+    lock = threading.Lock()
+    reading, peak, threads = [0], [0], set()
+
+    def slow_check(path, size):
+        with lock:
+            reading[0] += 1
+            peak[0] = max(peak[0], reading[0])
+            threads.add(threading.current_thread().name)
+        time.sleep(0.02)
+        with lock:
+            reading[0] -= 1
+        return 'hash', 40 * MB, ""
+    monkeypatch.setitem(image_processor.PERFORMANCE, 'HEADER_WORKERS', 4)
+    recorder = run(tmp_path, monkeypatch, 40, lambda name: 40 * MB, memory_mb=100, check=slow_check)
+    assert threads and all(name.startswith("header") for name in threads)
+    assert peak[0] > 1
+    # Memory is still charged before each image is hashed
+    assert recorder.peak_bytes <= 100 * MB and recorder.peak_images == 2
+
+
+def test_peak_estimate_follows_the_decoder():
+    # An RGB image: decoded pixels, luminance plane and the wavelet buffer
+    assert hash_kernel.estimate_peak_bytes((4000, 3000), 'RGB', 'PNG', 16) == 4000 * 3000 * 4 + 2048 ** 2
+    # RGBA goes through RGB first
+    assert hash_kernel.estimate_peak_bytes((100, 100), 'RGBA', 'PNG', 16) == 100 * 100 * (4 + 3 + 1) + 64 ** 2
+    # A draft JPEG decodes straight to luminance at an eighth of the size
+    assert hash_kernel.decoded_size((4000, 3000), 'JPEG', 16, True) == (500, 375)
+    assert hash_kernel.estimate_peak_bytes((4000, 3000), 'RGB', 'JPEG', 16, True) == 500 * 375 + 256 ** 2
+    assert (hash_kernel.estimate_peak_bytes((4000, 3000), 'RGB', 'JPEG', 16, False)
+            == hash_kernel.estimate_peak_bytes((4000, 3000), 'RGB', 'PNG', 16))
@@ -0,0 +1,61 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+pytest.importorskip("PIL")
+
+from catalog import HAS_DIGEST, HAS_HASHES, PROCESSED, ImageCatalog
+from image_processor import ImageData
+
+
+HASHES = {'ahash': '0f' * 32, 'phash': 'f0' * 32, 'dhash': 'a5' * 32, 'whash': '3c' * 32}
+
+
+def test_views_read_and_write_their_row():
+    catalog = ImageCatalog(16, capacity=2)
+    first = ImageData(Path("/photos/a/one.jpg"), catalog)
+    second = ImageData(Path("/photos/b/two.jpg"), catalog)
+    assert (first.row, second.row) == (0, 1)
+    assert first.file_path == Path("/photos/a/one.jpg") and second.file_path == Path("/photos/b/two.jpg")
+    assert first.digest == b"" and first.image_hashes == {} and not first.processed
+
+    first.digest = bytes(range(16))
+    first.image_hashes = HASHES
+    first.processed = True
+    assert catalog.digests[0].tobytes() == bytes(range(16))
+    assert catalog.hashes['phash'][0, 0] == np.uint64(0xf0f0f0f0f0f0f0f0)
+    assert catalog.flags[0] == PROCESSED | HAS_DIGEST | HAS_HASHES
+    assert second.digest == b"" and second.image_hashes == {} and catalog.flags[1] == 0
+
+    # Another view of the same row sees the same record
+    again = ImageData(catalog=catalog, row=0)
+    assert again == first and hash(again) == hash(first) and again != second
+    assert again.file_hash == bytes(range(16)).hex()
+    assert again.image_hashes == HASHES and again.processed
+
+    # Failed hashing and unknown digests are stored as empty values
+    again.image_hashes = {}
+    again.file_hash = ""
+    assert first.image_hashes == {} and first.digest == b""
+    assert catalog.flags[0] == PROCESSED
+
+
+def test_rows_survive_growth(tmp_path):
+    catalog = ImageCatalog(16, capacity=1)
+    files = [tmp_path / f"dir{i % 3}" / f"{i}.jpg" for i in range(20)]
+    views = []
+    for i, path in enumerate(files):
+        path.parent.mkdir(exist_ok=True)
+        path.write_bytes(b"x" * i)
+        views.append(ImageData(catalog=catalog, row=catalog.add(path, os.stat(path))))
+        views[-1].digest = bytes([i]) * 16
+    views[5].image_hashes = HASHES
+
+    assert len(catalog) == 20 and catalog.capacity >= 20
+    assert [view.file_path for view in views] == files
+    assert [view.digest for view in views] == [bytes([i]) * 16 for i in range(20)]
+    assert views[5].image_hashes == HASHES and views[6].image_hashes == {}
+    assert catalog.stat_key(7)[2:] == (7, os.stat(files[7]).st_mtime_ns)
+    assert views[7].cache_key() == catalog.stat_key(7)
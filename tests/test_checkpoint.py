@@ -0,0 +1,129 @@
+import os
+
+import numpy as np
+import pytest
+
+from checkpoint import MAGIC, RunCheckpoint, comparison_key
+from similarity_index import HammingIndex
+
+
+KEY = (1, 2, 3, 4)
+DIGEST = bytes(range(16))
+COMPARISON = b"c" * 16
+
+
+def fill(path):
+    checkpoint = RunCheckpoint(path)
+    checkpoint.add_hashed("/photos/a.jpg", KEY, 3, DIGEST, b"hashes")
+    checkpoint.add_hashed("/photos/b.jpg", (5, 6, 7, 8), 1, bytes(16), b"", "too large")
+    checkpoint.add_compared(COMPARISON, 0, np.array([1, 2]), np.array([5, 9]))
+    checkpoint.add_compared(COMPARISON, 4, np.empty(0, np.int64), np.empty(0, np.int64))
+    checkpoint.close()
+
+
+def test_records_round_trip(tmp_path):
+    path = tmp_path / "run.ckpt"
+    fill(path)
+    checkpoint = RunCheckpoint(path, resume=True)
+    assert checkpoint.hashed["/photos/a.jpg"] == (KEY, 3, DIGEST, b"hashes", "")
+    assert checkpoint.hashed["/photos/b.jpg"] == ((5, 6, 7, 8), 1, bytes(16), b"", "too large")
+    assert sorted(checkpoint.compared[COMPARISON]) == [0, 4]
+    first, second = checkpoint.compared[COMPARISON][0]
+    assert first.tolist() == [1, 2] and second.tolist() == [5, 9]
+    assert len(checkpoint.compared[COMPARISON][4][0]) == 0
+    checkpoint.close()
+
+
+def test_later_record_wins(tmp_path):
+    path = tmp_path / "run.ckpt"
+    fill(path)
+    checkpoint = RunCheckpoint(path, resume=True)
+    checkpoint.add_hashed("/photos/a.jpg", KEY, 7, DIGEST, b"newer")
+    checkpoint.close()
+    assert RunCheckpoint(path, resume=True).hashed["/photos/a.jpg"][1:4] == (7, DIGEST, b"newer")
+
+
+@pytest.mark.parametrize("cut", [1, 3, 5, 20])
+def test_partial_record_is_dropped(tmp_path, cut):
+    path = tmp_path / "run.ckpt"
+    fill(path)
+    whole = os.path.getsize(path)
+    checkpoint = RunCheckpoint(path, resume=True)
+    checkpoint.add_hashed("/photos/c.jpg", KEY, 1, DIGEST, b"x" * 40)
+    checkpoint.close()
+    # A crash while the last record was written: only part of it reached the disk
+    os.truncate(path, os.path.getsize(path) - cut)
+
+    checkpoint = RunCheckpoint(path, resume=True)
+    assert "/photos/c.jpg" not in checkpoint.hashed
+    assert len(checkpoint.hashed) == 2
+    assert os.path.getsize(path) == whole
+    # Records appended after the replay start at a record boundary
+    checkpoint.add_hashed("/photos/d.jpg", KEY, 1, DIGEST, b"d")
+    checkpoint.close()
+    checkpoint = RunCheckpoint(path, resume=True)
+    assert set(checkpoint.hashed) == {"/photos/a.jpg", "/photos/b.jpg", "/photos/d.jpg"}
+    checkpoint.close()
+
+
+def test_truncated_to_the_magic_is_empty(tmp_path):
+    path = tmp_path / "run.ckpt"
+    fill(path)
+    os.truncate(path, len(MAGIC) + 2)
+    checkpoint = RunCheckpoint(path, resume=True)
+    assert checkpoint.hashed == {} and checkpoint.compared == {}
+    checkpoint.close()
+    assert os.path.getsize(path) == len(MAGIC)
+
+
+def test_without_resume_starts_over_and_discard_deletes(tmp_path):
+    path = tmp_path / "run.ckpt"
+    fill(path)
+    checkpoint = RunCheckpoint(path)
+    assert checkpoint.hashed == {}
+    checkpoint.discard()
+    assert not path.exists()
+
+
+def test_other_files_are_refused(tmp_path):
+    path = tmp_path / "run.ckpt"
+    path.write_bytes(b"something else")
+    with pytest.raises(ValueError):
+        RunCheckpoint(path, resume=True)
+
+
+def test_comparison_key_covers_inputs_and_settings():
+    vectors = np.arange(8, dtype=np.uint64).reshape(4, 2)
+    valid = np.ones(4, dtype=bool)
+    key = comparison_key(vectors, valid, 10, "a")
+    assert key == comparison_key(vectors.copy(), valid.copy(), 10, "a")
+    assert key != comparison_key(vectors, valid, 11, "a")
+    assert key != comparison_key(vectors, valid, 10, "b")
+    assert key != comparison_key(vectors[::-1], valid, 10, "a")
+    invalid = valid.copy()
+    invalid[0] = False
+    assert key != comparison_key(vectors, invalid, 10, "a")
+
+
+def test_comparison_resumes_from_checkpointed_units(tmp_path):
+    rng = np.random.default_rng(0)
+    vectors = rng.integers(0, 2 ** 64, (300, 4), dtype=np.uint64)
+    vectors[150:] = vectors[:150] ^ np.uint64(1)  # one bit apart
+    path = tmp_path / "run.ckpt"
+    key = comparison_key(vectors, np.ones(300, bool), 60)
+
+    checkpoint = RunCheckpoint(path)
+    index = HammingIndex(vectors, 60)
+    assert index.mode == 'scan'  # units are blocks of rows
+    expected = index.pairs(
+        on_unit=lambda unit, first, second: checkpoint.add_compared(key, unit, first, second))
+    checkpoint.close()
+    os.truncate(path, os.path.getsize(path) - 3)  # the last unit was cut off
+
+    done = RunCheckpoint(path, resume=True).compared[key]
+    assert 0 < len(done) < 5
+    first, second = HammingIndex(vectors, 60).pairs(done_units=done.keys())
+    first = np.concatenate([first] + [pair[0] for pair in done.values()])
+    second = np.concatenate([second] + [pair[1] for pair in done.values()])
+    assert sorted(zip(first.tolist(), second.tolist())) == list(zip(*map(np.ndarray.tolist, expected)))
+    assert len(expected[0]) == 150
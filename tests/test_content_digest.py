@@ -0,0 +1,80 @@
+import hashlib
+
+import pytest
+
+import content_digest
+from content_digest import DIGEST_SIZE, READ_BUFFER_SIZE
+
+
+SIZES = [0, 1, READ_BUFFER_SIZE - 1, READ_BUFFER_SIZE, 2 * READ_BUFFER_SIZE + 17]
+
+
+def payload(size: int) -> bytes:
+    return bytes(i * 7 % 251 for i in range(size))
+
+
+@pytest.mark.parametrize("algorithm", content_digest.available_algorithms())
+@pytest.mark.parametrize("reader", content_digest.READERS)
+@pytest.mark.parametrize("size", SIZES)
+def test_readers_agree(tmp_path, algorithm, reader, size):
+    path = tmp_path / "file.bin"
+    data = payload(size)
+    path.write_bytes(data)
+    hasher = content_digest.new_hasher(algorithm)
+    hasher.update(data)
+    counts = {}
+    digest = content_digest.digest_file(path, algorithm, reader, counts)
+    assert digest == hasher.digest()
+    assert len(digest) == DIGEST_SIZE
+    assert counts == {'bytes_read': size}
+
+
+def test_counting_file_counts_every_read(tmp_path):
+    path = tmp_path / "file.bin"
+    path.write_bytes(payload(1000))
+    with content_digest.CountingFile(path) as f:
+        f.read(10)
+        f.readinto(bytearray(100))
+        f.seek(900)
+        f.read()
+        assert f.bytes_read == 210
+
+
+def test_blake2b_and_md5_match_hashlib(tmp_path):
+    path = tmp_path / "file.bin"
+    data = payload(3 * READ_BUFFER_SIZE // 2)
+    path.write_bytes(data)
+    assert content_digest.digest_file(path, 'blake2b') == hashlib.blake2b(data, digest_size=16).digest()
+    assert content_digest.digest_file(path, 'md5') == hashlib.md5(data).digest()
+
+
+def test_resolve_algorithm(monkeypatch):
+    assert content_digest.resolve_algorithm('md5') == 'md5'
+    monkeypatch.setattr(content_digest, 'xxhash', None)
+    assert content_digest.resolve_algorithm('auto') == 'blake2b'
+    assert content_digest.resolve_algorithm('xxh3') == 'blake2b'
+    assert 'xxh3' not in content_digest.available_algorithms()
+    with pytest.raises(ValueError):
+        content_digest.resolve_algorithm('sha1')
+
+
+@pytest.mark.parametrize("size", [0, 10, 200, 201, 1000])
+def test_head_tail(tmp_path, size):
+    block = 100
+    path = tmp_path / "file.bin"
+    data = payload(size)
+    path.write_bytes(data)
+    expected = hashlib.blake2b(digest_size=16)
+    expected.update(data[:block])
+    expected.update(data[-block:] if size > 2 * block else data[block:2 * block])
+    assert content_digest.digest_head_tail(path, size, block) == expected.digest()
+
+
+def test_head_tail_ignores_the_middle(tmp_path):
+    block = 64
+    a, b = tmp_path / "a.bin", tmp_path / "b.bin"
+    a.write_bytes(b"h" * block + b"x" * 500 + b"t" * block)
+    b.write_bytes(b"h" * block + b"y" * 500 + b"t" * block)
+    size = 2 * block + 500
+    assert content_digest.digest_head_tail(a, size, block) == content_digest.digest_head_tail(b, size, block)
+    assert content_digest.digest_file(a) != content_digest.digest_file(b)
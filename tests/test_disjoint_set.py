@@ -0,0 +1,64 @@
+import numpy as np
+
+from similarity_index import DisjointSet
+
+
+def test_singletons_are_not_groups():
+    components = DisjointSet(4)
+    assert components.groups() == []
+    assert [m.tolist() for m in components.groups(min_size=1)] == [[0], [1], [2], [3]]
+
+
+def test_later_pair_links_two_groups():
+    components = DisjointSet(6)
+    components.union_pairs(np.array([0, 4]), np.array([1, 5]))
+    assert [m.tolist() for m in components.groups()] == [[0, 1], [4, 5]]
+    components.union(5, 1)
+    assert [m.tolist() for m in components.groups()] == [[0, 1, 4, 5]]
+    assert components.find(0) == components.find(4)
+
+
+def test_groups_are_ordered_by_lowest_member():
+    components = DisjointSet(7)
+    components.union_pairs(np.array([6, 2, 1]), np.array([3, 5, 6]))
+    assert [m.tolist() for m in components.groups()] == [[1, 3, 6], [2, 5]]
+
+
+def test_union_of_same_set_keeps_root():
+    components = DisjointSet(3)
+    root = components.union(0, 1)
+    assert components.union(1, 0) == root
+    assert components.find(1) == root
+
+
+def test_find_compresses_paths():
+    n = 10_000
+    components = DisjointSet(n)
+    components.union_pairs(np.arange(n - 1), np.arange(1, n))
+    assert max(components.rank) <= int(np.log2(n))
+    root = components.find(0)
+    assert all(components.find(x) == root for x in range(n))
+    assert all(parent == root for parent in components.parent)
+    assert len(components.groups()) == 1
+
+
+def test_matches_connected_components():
+    rng = np.random.default_rng(3)
+    n = 500
+    first, second = rng.integers(0, n, (2, 300))
+    components = DisjointSet(n)
+    components.union_pairs(first, second)
+
+    # Reference: repeatedly spread the lowest label along the edges
+    labels = np.arange(n)
+    while True:
+        low = np.minimum(labels[first], labels[second])
+        spread = labels.copy()
+        np.minimum.at(spread, first, low)
+        np.minimum.at(spread, second, low)
+        if np.array_equal(spread, labels):
+            break
+        labels = spread
+    expected = [np.flatnonzero(labels == label).tolist() for label in np.unique(labels)]
+    expected = sorted((m for m in expected if len(m) >= 2), key=lambda m: m[0])
+    assert [m.tolist() for m in components.groups()] == expected
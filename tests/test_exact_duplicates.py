@@ -0,0 +1,88 @@
+import os
+
+import pytest
+
+pytest.importorskip("PIL")
+
+from hash_cache import HashCache
+from image_processor import ImageProcessor, ImageSynchronizer
+
+
+BLOCK = ImageProcessor.PARTIAL_HASH_BYTES
+
+
+def write(path, data: bytes):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return path
+
+
+def large(middle: bytes, head: bytes = b"h", tail: bytes = b"t") -> bytes:
+    """A file bigger than two partial-hash blocks, varying only where asked"""
+    return head * BLOCK + middle * BLOCK + tail * BLOCK
+
+
+def detect(folder, **kwargs):
+    synchronizer = ImageSynchronizer(max_workers=2, **kwargs)
+    images = synchronizer.collect_images(folder)
+    stats = synchronizer.detect_exact_duplicates(images)
+    return {img.file_path.name: img.digest for img in images}, stats
+
+
+def test_unique_sizes_are_never_read(tmp_path):
+    write(tmp_path / "a.jpg", b"x" * 10)
+    write(tmp_path / "b.jpg", b"x" * 11)
+    write(tmp_path / "sub" / "c.png", large(b"m"))
+    digests, stats = detect(tmp_path)
+    assert stats == {"size_collisions": 0, "partial_hashed": 0, "full_hashed": 0, "bytes_read": 0}
+    assert not any(digests.values())
+
+
+def test_small_collisions_are_hashed_in_full(tmp_path):
+    write(tmp_path / "a.jpg", b"same")
+    write(tmp_path / "b.jpg", b"same")
+    write(tmp_path / "c.jpg", b"diff")
+    digests, stats = detect(tmp_path)
+    assert stats["size_collisions"] == 3
+    assert stats["partial_hashed"] == 0
+    assert stats["full_hashed"] == 3
+    assert digests["a.jpg"] == digests["b.jpg"] != digests["c.jpg"]
+
+
+def test_head_and_tail_screen_large_files(tmp_path):
+    write(tmp_path / "a.jpg", large(b"m"))
+    write(tmp_path / "b.jpg", large(b"m", head=b"H"))
+    write(tmp_path / "c.jpg", large(b"m", tail=b"T"))
+    digests, stats = detect(tmp_path)
+    assert stats["partial_hashed"] == 3
+    assert stats["full_hashed"] == 0
+    assert stats["bytes_read"] == 3 * 2 * BLOCK
+
+
+def test_same_head_and_tail_are_hashed_in_full(tmp_path):
+    write(tmp_path / "a.jpg", large(b"m"))
+    write(tmp_path / "b.jpg", large(b"m"))
+    write(tmp_path / "c.jpg", large(b"M"))
+    digests, stats = detect(tmp_path)
+    assert stats["partial_hashed"] == 3
+    assert stats["full_hashed"] == 3
+    assert stats["bytes_read"] == 3 * 2 * BLOCK + 3 * 3 * BLOCK
+    assert digests["a.jpg"] == digests["b.jpg"] != digests["c.jpg"]
+
+
+def test_cached_digest_is_compared_in_full(tmp_path):
+    folder = tmp_path / "images"
+    write(folder / "a.jpg", large(b"m"))
+    cache = HashCache(tmp_path / "cache.sqlite3", ImageProcessor.hash_version())
+    first, _ = detect(folder, hash_cache=cache)
+    assert not first["a.jpg"]  # a unique size is not read
+
+    # Seed the cache with a's digest, then add a copy: only the copy is read
+    st = os.stat(folder / "a.jpg")
+    cache.put((st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns),
+              ImageProcessor.get_file_digest(folder / "a.jpg"))
+    write(folder / "b.jpg", large(b"m"))
+    digests, stats = detect(folder, hash_cache=cache)
+    cache.close()
+    assert stats["full_hashed"] == 1
+    assert digests["a.jpg"] == digests["b.jpg"]
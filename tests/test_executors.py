@@ -0,0 +1,57 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+Image = pytest.importorskip("PIL.Image")
+
+import image_processor
+from image_processor import ImageData, ImageProcessor, ImageSynchronizer, hash_files_packed
+from hash_cache import HashCache
+
+
+def write_images(folder):
+    rng = np.random.default_rng(0)
+    folder.mkdir()
+    for i in range(6):
+        pixels = rng.integers(0, 256, (48 + 8 * i, 64, 3), dtype=np.uint8)
+        Image.fromarray(pixels, "RGB").save(folder / f"noise{i}.png")
+    x = np.linspace(0, 255, 1600)[None, :]
+    y = np.linspace(0, 255, 1200)[:, None]
+    gradient = np.stack([x + 0 * y, y + 0 * x, (x + y) / 2], axis=-1).astype(np.uint8)
+    Image.fromarray(gradient, "RGB").save(folder / "large.jpg", quality=85)
+    (folder / "broken.jpg").write_bytes(b"not an image")
+
+
+def hash_with(executor, folder):
+    synchronizer = ImageSynchronizer(max_workers=2, executor=executor)
+    images = synchronizer.collect_images(folder)
+    assert synchronizer.process_images_parallel(images) == len(images)
+    return {img.file_path.name: (img.digest, img.image_hashes) for img in images}
+
+
+def test_process_and_thread_executors_give_the_same_results(tmp_path, monkeypatch):
+    write_images(tmp_path / "images")
+    # Only the large JPEG decodes at reduced scale, through the oversized-image path
+    monkeypatch.setitem(image_processor.IMAGE_PROCESSING, 'REDUCED_DECODE', False)
+    monkeypatch.setitem(image_processor.IMAGE_PROCESSING, 'MAX_IMAGE_MEGAPIXELS', 1)
+    monkeypatch.setitem(image_processor.IMAGE_PROCESSING, 'OVERSIZED_IMAGES', 'reduce')
+    large = tmp_path / "images" / "large.jpg"
+    assert ImageProcessor.check_image(large, large.stat().st_size)[0] == 'reduce'
+    threads = hash_with('thread', tmp_path / "images")
+    processes = hash_with('process', tmp_path / "images")
+    assert threads == processes
+    assert len(threads) == 8 and threads["broken.jpg"][1] == {}
+    assert all(digest for digest, _ in threads.values())
+    assert all(hashes for name, (_, hashes) in threads.items() if name != "broken.jpg")
+
+
+def test_packed_results_match_hashing_in_place(tmp_path):
+    write_images(tmp_path / "images")
+    paths = sorted(tmp_path.joinpath("images").iterdir())
+    for (path, digest, packed, timings, bytes_read), source in zip(hash_files_packed([str(p) for p in paths], True),
+                                                                   paths):
+        img = ImageData(source)
+        img.compute()
+        assert path == str(source)
+        assert digest == img.digest
+        assert HashCache.unpack_hashes(packed) == img.image_hashes
+        assert bytes_read >= source.stat().st_size
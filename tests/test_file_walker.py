@@ -0,0 +1,84 @@
+import os
+import threading
+
+import pytest
+
+import file_walker
+from file_walker import walk_files
+
+
+SUFFIXES = {'.jpg', '.png'}
+
+
+def touch(path, data: bytes = b"x"):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return path
+
+
+def walked(root, **kwargs):
+    return {os.path.relpath(path, root): st for path, st in walk_files(root, SUFFIXES, **kwargs)}
+
+
+def test_finds_matching_files_at_every_depth(tmp_path):
+    touch(tmp_path / "a.jpg")
+    touch(tmp_path / "B.PNG")
+    touch(tmp_path / "notes.txt")
+    touch(tmp_path / "one" / "c.png", b"12345")
+    touch(tmp_path / "one" / "two" / "three" / "d.jpg")
+    (tmp_path / "empty").mkdir()
+    (tmp_path / "folder.jpg").mkdir()  # a directory with an image suffix is walked, not yielded
+    touch(tmp_path / "folder.jpg" / "e.jpg")
+
+    found = walked(tmp_path, max_workers=3)
+    expected = {"a.jpg", "B.PNG", os.path.join("one", "c.png"), os.path.join("one", "two", "three", "d.jpg"),
+                os.path.join("folder.jpg", "e.jpg")}
+    assert set(found) == expected
+    assert found[os.path.join("one", "c.png")].st_size == 5
+    assert all(st.st_ino for st in found.values())
+
+
+def test_missing_root_yields_nothing(tmp_path):
+    assert list(walk_files(tmp_path / "missing", SUFFIXES)) == []
+    touch(tmp_path / "file.jpg")
+    assert list(walk_files(tmp_path / "file.jpg", SUFFIXES)) == []
+
+
+def test_large_directory_streams_in_batches(tmp_path, monkeypatch):
+    monkeypatch.setattr(file_walker, 'ENTRY_BATCH_SIZE', 7)
+    for i in range(100):
+        touch(tmp_path / f"{i}.jpg")
+    assert len(walked(tmp_path, max_workers=2)) == 100
+
+
+@pytest.mark.skipif(not hasattr(os, "symlink"), reason="needs symlinks")
+def test_symlinked_files_are_followed_but_not_directories(tmp_path):
+    target = touch(tmp_path / "outside" / "real.jpg")
+    root = tmp_path / "root"
+    root.mkdir()
+    try:
+        os.symlink(target, root / "link.jpg")
+        os.symlink(target.parent, root / "dirlink", target_is_directory=True)
+        os.symlink(tmp_path / "nowhere.jpg", root / "broken.jpg")
+    except OSError:
+        pytest.skip("symlinks not permitted")
+    assert set(walked(root)) == {"link.jpg"}
+
+
+def test_stop_event_stops_listing(tmp_path):
+    for i in range(20):
+        touch(tmp_path / "sub" / f"{i}.jpg")
+    stop = threading.Event()
+    stop.set()
+    assert list(walk_files(tmp_path, SUFFIXES, stop_event=stop)) == []
+
+
+def test_closing_early_does_not_hang(tmp_path, monkeypatch):
+    monkeypatch.setattr(file_walker, 'ENTRY_BATCH_SIZE', 1)
+    monkeypatch.setattr(file_walker, 'RESULT_QUEUE_SIZE', 1)
+    for folder in range(10):
+        for i in range(10):
+            touch(tmp_path / str(folder) / f"{i}.jpg")
+    walker = walk_files(tmp_path, SUFFIXES, max_workers=4)
+    next(walker)
+    walker.close()  # workers blocked on the full queue must notice and stop
@@ -0,0 +1,156 @@
+import os
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("PIL")
+from PIL import Image
+
+import folder_watch
+import placement
+from folder_watch import Debouncer, WatchSession
+from image_processor import ImageProcessor, ImageSynchronizer
+from placement import PlacementEngine
+
+
+def test_files_settle_once_unchanged(tmp_path):
+    path = tmp_path / "a.jpg"
+    path.write_bytes(b"part")
+    debouncer = Debouncer(settle=1.0)
+    debouncer.offer(str(path), now=0.0)
+    assert debouncer.ready(now=0.5) == []
+
+    with open(path, "ab") as f:
+        f.write(b"more")
+    assert debouncer.ready(now=1.0) == []  # changed: waits another settle period
+    assert [entry[0] for entry in debouncer.ready(now=2.0)] == [str(path)]
+    assert len(debouncer) == 0
+
+
+def test_empty_files_settle_after_the_empty_wait(tmp_path):
+    path = tmp_path / "empty.jpg"
+    path.touch()
+    debouncer = Debouncer(settle=1.0, empty_wait=5.0)
+    debouncer.offer(str(path), now=0.0)
+    assert debouncer.ready(now=1.0) == []
+    assert debouncer.ready(now=3.0) == []
+    settled = debouncer.ready(now=5.0)
+    assert [(entry[0], entry[2]) for entry in settled] == [(str(path), 0.0)]
+    assert len(debouncer) == 0
+
+
+def test_deleted_files_are_dropped(tmp_path):
+    path = tmp_path / "a.jpg"
+    path.write_bytes(b"data")
+    debouncer = Debouncer(settle=1.0)
+    debouncer.offer(str(path), now=0.0)
+    path.unlink()
+    assert debouncer.ready(now=2.0) == []
+    assert len(debouncer) == 0
+
+
+def test_single_folder_runs_without_a_pool(tmp_path, monkeypatch):
+    def no_pool(*args, **kwargs):
+        raise AssertionError("a pool was started")
+    monkeypatch.setattr(placement, "ThreadPoolExecutor", no_pool)
+    engine = PlacementEngine()
+    sources = [tmp_path / f"{i}.jpg" for i in range(3)]
+    for source in sources:
+        source.write_bytes(b"data")
+        engine.add(source, tmp_path / "out")
+    reports = []
+    assert engine.run(progress=lambda done, total: reports.append((done, total)), indices=[0, 2]) == {}
+    assert list(engine.placed) == [1, 0, 1]
+    assert reports == [(2, 2)]
+
+
+def image(path, shade):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    Image.new("RGB", (32, 32), (shade, 255 - shade, shade // 2)).save(path)
+
+
+def test_watch_hashes_oversized_images_in_the_lane(tmp_path, monkeypatch):
+    folders = [tmp_path / "in1", tmp_path / "in2"]
+    image(folders[0] / "small.png", 10)
+    image(folders[1] / "big.png", 200)
+    output = tmp_path / "out"
+    output.mkdir()
+
+    check_image = ImageProcessor.check_image
+    monkeypatch.setattr(ImageProcessor, 'check_image', staticmethod(
+        lambda path, size: ('lane', 0, "test") if path.name == "big.png" else check_image(path, size)))
+    threads = {}
+    hash_files_packed = folder_watch.hash_files_packed
+
+    def record(paths, *args):
+        threads[os.path.basename(paths[0])] = threading.current_thread().name
+        return hash_files_packed(paths, *args)
+    monkeypatch.setattr(folder_watch, "hash_files_packed", record)
+    monkeypatch.setitem(folder_watch.PERFORMANCE, 'WATCH_SETTLE_SECONDS', 0.01)
+
+    synchronizer = ImageSynchronizer(max_workers=2, executor='thread')
+    session = WatchSession(synchronizer, folders, output, polling=True, catch_up=True)
+    runner = threading.Thread(target=session.run)
+    runner.start()
+    deadline = time.monotonic() + 20
+    while session.stats["placed"] < 2 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    synchronizer.stop_processing.set()
+    runner.join()
+
+    assert session.stats["placed"] == 2 and session.stats["errors"] == 0
+    assert threads["big.png"].startswith("oversized")
+    assert not threads["small.png"].startswith("oversized")
+    assert [path.name for path in output.glob("*/big.png")] == ["big.png"]
+
+
+def test_flush_before_run(tmp_path):
+    output = tmp_path / "out"
+    output.mkdir()
+    session = WatchSession(ImageSynchronizer(max_workers=1), [tmp_path], output)
+    session.flush()  # nothing to write, and no state missing
+    assert session._dirty is False
+
+
+def wait_for(condition, timeout: float = 20):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+
+def test_unchanged_sources_are_not_placed_again(tmp_path, monkeypatch):
+    folders = [tmp_path / "in1", tmp_path / "in2"]
+    for folder in folders:
+        folder.mkdir()
+    output = tmp_path / "out"
+    output.mkdir()
+    monkeypatch.setitem(folder_watch.PERFORMANCE, 'WATCH_SETTLE_SECONDS', 0.01)
+    watching = threading.Event()
+
+    def status(message):
+        if message.startswith("Watching"):
+            watching.set()
+    synchronizer = ImageSynchronizer(status_callback=status, max_workers=1, executor='thread',
+                                     placement_mode='copy')
+    session = WatchSession(synchronizer, folders, output)
+    runner = threading.Thread(target=session.run)
+    runner.start()
+    try:
+        assert watching.wait(20)
+        image(folders[0] / "slow.png", 10)
+        wait_for(lambda: session.stats["placed"] == 1)
+        open(folders[0] / "slow.png", "ab").close()  # another IN_CLOSE_WRITE, same contents
+        time.sleep(0.5)
+        image(folders[1] / "other.png", 200)
+        wait_for(lambda: session.stats["placed"] == 2)
+        # Changed contents are placed again
+        image(folders[0] / "slow.png", 120)
+        wait_for(lambda: session.stats["placed"] == 3)
+    finally:
+        synchronizer.stop_processing.set()
+        runner.join()
+
+    assert session.stats["placed"] == 3 and session.stats["errors"] == 0
+    placed = sorted(path.name for path in output.rglob("*.png"))
+    assert placed == ["other.png", "slow.png", "slow_1.png"]
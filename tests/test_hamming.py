@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+import hamming
+
+
+def words(shape, seed=0):
+    rng = np.random.default_rng(seed)
+    sample = rng.integers(0, 2 ** 64, shape, dtype=np.uint64)
+    sample.flat[:4] = [0, 2 ** 64 - 1, 1, 2 ** 63]
+    return sample
+
+
+def reference_popcount(values: np.ndarray) -> np.ndarray:
+    return np.array([bin(int(v)).count("1") for v in values.ravel()]).reshape(values.shape)
+
+
+@pytest.mark.parametrize("shape", [(64,), (9, 4), (3, 5, 16)])
+def test_lookup_table_fallback_matches_bitwise_count(shape, monkeypatch):
+    values = words(shape)
+    expected = reference_popcount(values)
+    if hasattr(np, 'bitwise_count'):
+        np.testing.assert_array_equal(hamming.popcount(values), expected)
+        np.testing.assert_array_equal(np.bitwise_count(values), expected)
+    # NumPy < 2.0 has no bitwise_count; non-contiguous views take the same path
+    monkeypatch.delattr(np, 'bitwise_count', raising=False)
+    np.testing.assert_array_equal(hamming.popcount(values), expected)
+    np.testing.assert_array_equal(hamming.popcount(values.T), expected.T)
+
+
+def test_distances_agree_with_each_other():
+    block_a, block_b = words((7, 4), seed=1), words((5, 4), seed=2)
+    matrix = hamming.distances_between(block_a, block_b)
+    assert matrix.shape == (7, 5)
+    for i, query in enumerate(block_a):
+        np.testing.assert_array_equal(hamming.distances_to_many(query, block_b), matrix[i])
+    assert matrix[0, 0] == reference_popcount(block_a[0] ^ block_b[0]).sum()
+
+
+def test_similarity_scores_average_the_hash_types():
+    block = words((3, 4), seed=3)
+    query = {'ahash': block[0], 'phash': ~block[0]}
+    scores = hamming.similarity_scores(query, {'ahash': block, 'phash': block}, 256)
+    assert scores[0] == 0.5  # identical in one type, every bit differs in the other
+    assert np.allclose(scores, 0.5)  # a hash and its complement are 256 bits apart in total from any row
+
+
+def test_hex_to_words_is_msb_first():
+    np.testing.assert_array_equal(hamming.hex_to_words("80" + "00" * 7 + "01"), [2 ** 63, 2 ** 56])
+    assert hamming.hex_to_words("ff" * 32).dtype == np.uint64
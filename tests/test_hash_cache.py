@@ -0,0 +1,71 @@
+import sqlite3
+
+import hash_cache
+from hash_cache import HashCache
+
+
+HASHES = {'ahash': '0f' * 32, 'phash': 'f0' * 32, 'dhash': 'aa' * 32, 'whash': '55' * 32}
+
+
+def test_round_trip_and_digest_fallback(tmp_path):
+    cache = HashCache(tmp_path / "cache.sqlite3", "v1")
+    cache.put((1, 2, 3, 4), b"digest", HASHES)
+    cache.put((1, 5, 6, 7), b"", None)  # nothing known is not stored
+    cache.flush()
+
+    assert cache.get((1, 2, 3, 4)) == (b"digest", HASHES)
+    assert cache.get((1, 5, 6, 7)) is None
+    assert cache.get_by_digest(b"digest") == HASHES
+    assert cache.get_by_digest(b"other") is None
+    cache.close()
+
+
+def test_later_put_keeps_earlier_values(tmp_path):
+    cache = HashCache(tmp_path / "cache.sqlite3", "v1")
+    cache.put((1, 2, 3, 4), b"", HASHES)
+    cache.put((1, 2, 3, 4), b"digest")
+    assert cache.get((1, 2, 3, 4)) == (b"digest", HASHES)
+    cache.close()
+
+
+def test_undecodable_image_is_cached_as_empty(tmp_path):
+    cache = HashCache(tmp_path / "cache.sqlite3", "v1")
+    cache.put((1, 2, 3, 4), b"digest", {})
+    assert cache.get((1, 2, 3, 4)) == (b"digest", {})
+    cache.close()
+
+
+def test_other_version_is_dropped(tmp_path):
+    path = tmp_path / "cache.sqlite3"
+    cache = HashCache(path, "v1")
+    cache.put((1, 2, 3, 4), b"digest", HASHES)
+    cache.close()
+
+    cache = HashCache(path, "v2")
+    assert cache.get((1, 2, 3, 4)) is None
+    assert cache.get_by_digest(b"digest") is None
+    cache.close()
+    with sqlite3.connect(str(path)) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM hashes").fetchone()[0] == 0
+
+
+def test_opens_while_another_run_holds_the_write_lock(tmp_path, monkeypatch):
+    path = tmp_path / "cache.sqlite3"
+    cache = HashCache(path, "v1")
+    cache.put((1, 2, 3, 4), b"digest", HASHES)
+    cache.close()
+
+    connect = sqlite3.connect
+    monkeypatch.setattr(hash_cache.sqlite3, "connect", lambda *args, **kwargs: connect(*args, timeout=0.1, **kwargs))
+    other = connect(str(path), isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    try:
+        cache = HashCache(path, "v2")
+        # The stale entry is left for a later run, but never returned
+        assert cache.get((1, 2, 3, 4)) is None
+    finally:
+        other.execute("ROLLBACK")
+        other.close()
+    cache.put((1, 2, 3, 4), b"new", HASHES)
+    assert cache.get((1, 2, 3, 4)) == (b"new", HASHES)
+    cache.close()
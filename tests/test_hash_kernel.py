@@ -0,0 +1,197 @@
+import io
+import itertools
+
+import pytest
+
+np = pytest.importorskip("numpy")
+Image = pytest.importorskip("PIL.Image")
+imagehash = pytest.importorskip("imagehash")
+pytest.importorskip("pywt")
+pytest.importorskip("scipy")
+
+import hash_kernel
+import image_processor
+from hash_cache import HashCache
+from image_processor import ImageProcessor
+
+
+def encoded(image, image_format="PNG", **params):
+    """The image as a decoder would see it: saved, then lazily reopened"""
+    data = io.BytesIO()
+    image.save(data, image_format, **params)
+    data.seek(0)
+    return Image.open(data)
+
+
+def noise(size, mode="RGB", seed=0):
+    rng = np.random.default_rng(seed)
+    channels = {"L": 1, "RGB": 3, "RGBA": 4}[mode]
+    pixels = rng.integers(0, 256, (size[1], size[0], channels), dtype=np.uint8)
+    return Image.fromarray(pixels.squeeze(axis=2) if channels == 1 else pixels, mode)
+
+
+def gradient(size):
+    x = np.linspace(0, 255, size[0])[None, :]
+    y = np.linspace(0, 255, size[1])[:, None]
+    pixels = np.stack([x + 0 * y, y + 0 * x, (x + y) / 2], axis=-1).astype(np.uint8)
+    return Image.fromarray(pixels, "RGB")
+
+
+def blocks(size, levels):
+    """Large flat blocks, so many wavelet block sums tie with their median"""
+    rng = np.random.default_rng(1)
+    small = rng.choice(levels, (4, 4)).astype(np.uint8)
+    return Image.fromarray(small, "L").resize(size, Image.NEAREST)
+
+
+def with_exif_rotation(image):
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Orientation: rotate 90 CW to display
+    return encoded(image, "JPEG", quality=90, exif=exif.tobytes())
+
+
+IMAGES = {
+    "rgb_odd": lambda: encoded(noise((101, 37))),
+    "rgb_gradient": lambda: encoded(gradient((250, 190))),
+    "l_noise": lambda: encoded(noise((64, 96), "L", seed=2)),
+    "rgba": lambda: encoded(noise((77, 53), "RGBA", seed=3)),
+    "palette": lambda: encoded(gradient((120, 80)).convert("P", palette=Image.ADAPTIVE)),
+    "constant": lambda: encoded(Image.new("RGB", (64, 64), (90, 90, 90))),
+    "tie_blocks": lambda: encoded(blocks((128, 128), [0, 255])),
+    "tiny": lambda: encoded(noise((7, 5), seed=4)),
+    "jpeg": lambda: encoded(gradient((300, 200)), "JPEG", quality=85),
+    "jpeg_exif_rotated": lambda: with_exif_rotation(noise((90, 60), seed=5)),
+}
+
+
+def imagehash_reference(image, hash_size):
+    """imagehash's four hashes as bytes, on the RGB conversion get_image_hashes always made"""
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    functions = {"ahash": imagehash.average_hash, "phash": imagehash.phash,
+                 "dhash": imagehash.dhash, "whash": imagehash.whash}
+    return {hash_type: bytes.fromhex(str(function(image, hash_size=hash_size)))
+            for hash_type, function in functions.items()}
+
+
+@pytest.mark.parametrize("hash_size", [8, 16])
+@pytest.mark.parametrize("name", sorted(IMAGES))
+def test_kernel_matches_imagehash_bit_for_bit(name, hash_size):
+    with IMAGES[name]() as image:
+        kernel = hash_kernel.compute_hashes(image, hash_size, reduced_decode=False)
+    with IMAGES[name]() as image:
+        reference = imagehash_reference(image, hash_size)
+    assert kernel == reference
+
+
+@pytest.mark.parametrize("name", ["constant", "tie_blocks"])
+def test_tied_wavelet_blocks_take_the_pywt_path(name):
+    with IMAGES[name]() as image:
+        gray = hash_kernel.to_luminance(image)
+        pixels = hash_kernel.build_pyramid(gray, 16)["whash"]
+    block = pixels.shape[0] // 16
+    sums = pixels.reshape(16, block, 16, block).sum(axis=(1, 3), dtype=np.int64)
+    assert np.any(sums == np.median(sums))
+
+
+def test_timings_are_reported():
+    timings = {}
+    with IMAGES["jpeg"]() as image:
+        hash_kernel.compute_hashes(image, 16, timings=timings)
+    assert set(timings) == {"decode", "hash"}
+    assert all(value >= 0 for value in timings.values())
+
+
+def test_reduced_decode_leaves_other_formats_and_small_jpegs_alone():
+    for name in ("rgb_gradient", "jpeg"):
+        with IMAGES[name]() as image:
+            reduced = hash_kernel.compute_hashes(image, 16, reduced_decode=True)
+        with IMAGES[name]() as image:
+            full = hash_kernel.compute_hashes(image, 16, reduced_decode=False)
+        assert reduced == full
+
+
+def test_reduced_decode_hashes_the_drafted_image():
+    source = gradient((1600, 1200))
+    target = hash_kernel.draft_size(16)
+    with encoded(source, "JPEG", quality=85) as image:
+        reduced = hash_kernel.compute_hashes(image, 16, reduced_decode=True)
+    with encoded(source, "JPEG", quality=85) as image:
+        image.draft("L", (target, target))
+        assert image.size == hash_kernel.decoded_size((1600, 1200), "JPEG", 16, True)
+        assert image.size != (1600, 1200)
+        assert reduced == imagehash_reference(image.convert("L"), 16)
+
+
+def test_decoded_size_matches_the_decoder():
+    for size in [(1600, 1200), (1024, 1024), (999, 517), (300, 200)]:
+        with encoded(gradient(size), "JPEG") as image:
+            hash_kernel.reduce_decode(image, 16)
+            assert image.size == hash_kernel.decoded_size(size, "JPEG", 16, True)
+
+
+def smooth(size, seed):
+    """A smooth random picture with a clear orientation"""
+    rng = np.random.default_rng(seed)
+    return Image.fromarray(rng.integers(0, 256, (6, 8, 3), dtype=np.uint8)).resize(size, Image.BICUBIC)
+
+
+ORIENTATIONS = [None] + list(Image.Transpose)
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_rotations_and_mirrors_hash_alike_with_detect_transformations(tmp_path, monkeypatch, seed):
+    paths = []
+    for k, transpose in enumerate(ORIENTATIONS):
+        image = smooth((320, 240), seed)
+        paths.append(tmp_path / f"{k}.png")
+        (image if transpose is None else image.transpose(transpose)).save(paths[-1])
+
+    monkeypatch.setitem(image_processor.ALGORITHM_SETTINGS, 'DETECT_TRANSFORMATIONS', True)
+    hashes = [ImageProcessor.get_image_hashes(path) for path in paths]
+    for first, second in itertools.combinations(hashes, 2):
+        distance = sum(bin(int(first[t], 16) ^ int(second[t], 16)).count("1") for t in first)
+        assert distance <= 16  # of 1024 bits: similar far above the default 0.85
+        assert ImageProcessor.are_images_similar(first, second, 0.95)
+
+    # Without the flag no rotated or mirrored copy is similar
+    monkeypatch.setitem(image_processor.ALGORITHM_SETTINGS, 'DETECT_TRANSFORMATIONS', False)
+    plain = [ImageProcessor.get_image_hashes(path) for path in paths]
+    assert not any(ImageProcessor.are_images_similar(plain[0], other, 0.85) for other in plain[1:])
+
+
+def test_detect_transformations_invalidates_cached_hashes(tmp_path, monkeypatch):
+    monkeypatch.setitem(image_processor.ALGORITHM_SETTINGS, 'DETECT_TRANSFORMATIONS', False)
+    plain = ImageProcessor.hash_version()
+    monkeypatch.setitem(image_processor.ALGORITHM_SETTINGS, 'DETECT_TRANSFORMATIONS', True)
+    canonical = ImageProcessor.hash_version()
+    assert canonical != plain
+
+    hashes = {'ahash': '0f' * 32, 'phash': 'f0' * 32, 'dhash': 'aa' * 32, 'whash': '55' * 32}
+    cache = HashCache(tmp_path / "cache.sqlite3", plain)
+    cache.put((1, 2, 3, 4), b"digest", hashes)
+    cache.close()
+    cache = HashCache(tmp_path / "cache.sqlite3", canonical)
+    assert cache.get((1, 2, 3, 4)) is None
+    cache.close()
+
+
+# Largest drift measured on such photos was 24 phash bits and 3 bits of any other type
+REDUCED_DRIFT_BITS = {'ahash': 8, 'phash': 32, 'dhash': 8, 'whash': 8}
+
+
+@pytest.mark.parametrize("size", [(1600, 1200), (2400, 1600)])
+@pytest.mark.parametrize("seed", range(4))
+def test_reduced_decode_drift_stays_within_the_bound(size, seed):
+    pixels = np.asarray(smooth(size, seed), dtype=np.float64)
+    grain = np.random.default_rng(seed).normal(0, 12, pixels.shape)
+    photo = Image.fromarray(np.clip(pixels + grain, 0, 255).astype(np.uint8))
+    hashes = {}
+    for reduced_decode in (False, True):
+        with encoded(photo, "JPEG", quality=90) as image:
+            hashes[reduced_decode] = hash_kernel.compute_hashes(image, 16, reduced_decode=reduced_decode)
+    for hash_type, limit in REDUCED_DRIFT_BITS.items():
+        xor = bytes(a ^ b for a, b in zip(hashes[False][hash_type], hashes[True][hash_type]))
+        assert int(np.unpackbits(np.frombuffer(xor, dtype=np.uint8)).sum()) <= limit
+    full, reduced = ({hash_type: value.hex() for hash_type, value in h.items()} for h in (hashes[False], hashes[True]))
+    assert ImageProcessor.are_images_similar(full, reduced, 0.95)
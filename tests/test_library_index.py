@@ -0,0 +1,225 @@
+import numpy as np
+import pytest
+
+import library_index
+from library_index import LibraryIndex
+from similarity_index import HammingIndex, SimilarityCascade
+
+benchmark = pytest.importorskip("benchmark")
+synthetic_hash_vectors, corpus_image = benchmark.synthetic_hash_vectors, benchmark.corpus_image
+
+import image_processor
+from PIL import ImageEnhance
+
+
+HASH_TYPES = ('ahash', 'phash', 'dhash', 'whash')
+WEIGHTS = {'ahash': 0.25, 'phash': 0.30, 'dhash': 0.25, 'whash': 0.20}
+
+
+def cascade(threshold: float) -> SimilarityCascade:
+    """The default comparison of 16x16 hashes"""
+    return SimilarityCascade(HASH_TYPES, 4, threshold, WEIGHTS, 2, 256)
+
+
+def open_library(directory, threshold: float = 0.95, recall: float = 1.0, version: str = "v1") -> LibraryIndex:
+    return LibraryIndex(directory, version, 16, cascade(threshold), recall)
+
+
+def add(library: LibraryIndex, vectors: np.ndarray, prefix: str, **kwargs):
+    paths = [f"unique_images/{prefix}{i}.jpg" for i in range(len(vectors))]
+    library.add(paths, vectors, np.ones(len(vectors), dtype=bool), **kwargs)
+    return paths
+
+
+def expected_matches(library_vectors: np.ndarray, new: np.ndarray, test: SimilarityCascade):
+    query, row = np.divmod(np.arange(len(new) * len(library_vectors)), len(library_vectors))
+    keep = test.verify(new, library_vectors, query, row)
+    return set(zip(query[keep].tolist(), row[keep].tolist()))
+
+
+def found(pairs):
+    return set(zip(pairs[0].tolist(), pairs[1].tolist()))
+
+
+def test_entries_are_numbered_across_segments_and_kept(tmp_path):
+    vectors = synthetic_hash_vectors(30, 16)
+    library = open_library(tmp_path)
+    paths = add(library, vectors[:10], "a") + add(library, vectors[10:], "b")
+    assert len(library) == 30 and len(library.segments) == 2
+    assert [library.path(entry) for entry in (0, 9, 10, 29)] == [paths[0], paths[9], paths[10], paths[29]]
+
+    again = open_library(tmp_path)
+    assert again.compatible and len(again) == 30
+    assert [again.path(entry) for entry in range(30)] == paths
+    np.testing.assert_array_equal(again.vectors(again.segments[1]["name"]), vectors[10:])
+
+
+def test_other_hash_settings_start_a_new_library(tmp_path):
+    add(open_library(tmp_path), synthetic_hash_vectors(10, 16), "a")
+    other = open_library(tmp_path, version="v2")
+    assert not other.compatible and len(other) == 0
+    add(other, synthetic_hash_vectors(3, 16), "b")
+    reopened = open_library(tmp_path, version="v2")
+    assert reopened.compatible and len(reopened) == 3
+    assert not open_library(tmp_path).compatible
+
+
+def test_relocate_records_moves_of_the_current_path(tmp_path):
+    library = open_library(tmp_path)
+    add(library, synthetic_hash_vectors(4, 16), "a")
+    assert not library.relocate(1, "unique_images/wrong.jpg", "similar_x/a1.jpg")
+    assert not library.relocate(9, "unique_images/a1.jpg", "similar_x/a1.jpg")
+    assert library.relocate(1, "unique_images/a1.jpg", "similar_x/a1.jpg")
+    assert library.path(1) == "similar_x/a1.jpg"
+    library.save()
+    assert open_library(tmp_path).path(1) == "similar_x/a1.jpg"
+    # Moves can be undone through the same call
+    assert library.relocate(1, "similar_x/a1.jpg", "unique_images/a1.jpg")
+    assert library.path(1) == "unique_images/a1.jpg"
+
+
+def test_ingested_remembers_recent_plans(tmp_path, monkeypatch):
+    monkeypatch.setattr(library_index, "RECENT_PLANS", 2)
+    library = open_library(tmp_path)
+    done = np.array([True, False, True, True, False, False, False, False, True])
+    assert not library.ingested("plan-a", len(done)).any()
+    add(library, synthetic_hash_vectors(2, 16), "a", plan_id="plan-a", ingested=done)
+    np.testing.assert_array_equal(open_library(tmp_path).ingested("plan-a", len(done)), done)
+
+    # Plans without new files are still recorded, and the oldest is forgotten
+    library.add([], np.empty((0, 16), dtype=np.uint64), np.empty(0, dtype=bool), "plan-b", done)
+    library.add([], np.empty((0, 16), dtype=np.uint64), np.empty(0, dtype=bool), "plan-c", done)
+    again = open_library(tmp_path)
+    assert list(again.plans) == ["plan-b", "plan-c"]
+    assert not again.ingested("plan-a", len(done)).any()
+
+
+def test_queries_probe_the_tables_written_with_each_segment(tmp_path, monkeypatch):
+    vectors = synthetic_hash_vectors(3000, 16, max_flips=24)
+    library_vectors, new = vectors[:2500], vectors[2500:]
+    library = open_library(tmp_path, 0.95)
+    for start in range(0, 2500, 1000):
+        add(library, library_vectors[start:start + 1000], f"s{start}_")
+    for segment in library.segments:
+        key = LibraryIndex.table_key(library.cascade, 1.0)
+        assert segment["tables"] == [key]
+        assert (tmp_path / f"{segment['name']}.{key}.keys.npy").exists()
+
+    def no_building(self, queries=None):
+        raise AssertionError("tables were rebuilt")
+    monkeypatch.setattr(HammingIndex, "query_tables", no_building)
+    test = cascade(0.95)
+    query, entries = open_library(tmp_path, 0.95).query(new, test)
+    expected = expected_matches(library_vectors, new, cascade(0.95))
+    assert expected and found((query, entries)) == expected
+    # Only candidates sharing a substring were compared
+    assert sum(test.stage_counts().values()) < len(new) * len(library_vectors) // 20
+
+
+def test_other_settings_get_their_tables_on_first_query(tmp_path, monkeypatch):
+    monkeypatch.setattr(library_index, "TABLE_SETTINGS", 2)
+    vectors = synthetic_hash_vectors(1500, 16, max_flips=24)
+    library = open_library(tmp_path, 0.95)
+    add(library, vectors[:1200], "a")
+    name = library.segments[0]["name"]
+
+    for threshold in (0.93, 0.97):
+        query, entries = open_library(tmp_path).query(vectors[1200:], cascade(threshold))
+        assert found((query, entries)) == expected_matches(vectors[:1200], vectors[1200:], cascade(threshold))
+    tables = open_library(tmp_path).segments[0]["tables"]
+    assert tables == [LibraryIndex.table_key(cascade(t), 1.0) for t in (0.93, 0.97)]
+    kept = {path.name.split(".")[1] for path in tmp_path.glob(f"{name}.*.keys.npy")}
+    assert kept == set(tables)
+
+
+def test_unselective_thresholds_scan_without_tables(tmp_path):
+    vectors = synthetic_hash_vectors(1500, 16, max_flips=40)
+    library = open_library(tmp_path, 0.85)
+    add(library, vectors[:1200], "a")
+    assert not list(tmp_path.glob("*.keys.npy"))
+    query, entries = library.query(vectors[1200:], cascade(0.85))
+    assert found((query, entries)) == expected_matches(vectors[:1200], vectors[1200:], cascade(0.85))
+
+
+def test_sampled_tables_are_kept_below_full_recall(tmp_path):
+    vectors = synthetic_hash_vectors(12000, 16, max_flips=32)
+    library = open_library(tmp_path, 0.85, recall=0.999)
+    add(library, vectors[:10000], "a")
+    assert list(tmp_path.glob("*.positions.npy"))
+    test = cascade(0.85)
+    query, entries = library.query(vectors[10000:], test, 0.999)
+    expected = expected_matches(vectors[:10000], vectors[10000:], cascade(0.85))
+    assert found((query, entries)) <= expected
+    assert len(found((query, entries))) >= 0.99 * len(expected)
+    assert sum(test.stage_counts().values()) < 2000 * 10000 // 4
+
+
+def test_compaction_merges_only_the_newest_segments(tmp_path):
+    vectors = synthetic_hash_vectors(180, 16, max_flips=24)
+    library = open_library(tmp_path)
+    paths = add(library, vectors[:100], "big")
+    for k in range(library_index.MAX_SEGMENTS - 1):
+        paths += add(library, vectors[100 + 10 * k:110 + 10 * k], f"small{k}_")
+    assert library.relocate(105, paths[105], "similar_x/moved.jpg")
+    paths[105] = "similar_x/moved.jpg"
+    first = library.segments[0]["name"]
+    merged = [segment["name"] for segment in library.segments[1:]]
+
+    paths += add(library, vectors[170:], "last")
+    assert len(library.segments) == 2
+    assert library.segments[0]["name"] == first and library.segments[1]["size"] == 80
+    assert library.moved == {}
+    assert not [path for name in merged for path in tmp_path.glob(f"{name}.*")]
+
+    again = open_library(tmp_path)
+    assert [again.path(entry) for entry in range(180)] == paths
+    query, entries = again.query(vectors, cascade(0.95))
+    assert found((query, entries)) == expected_matches(vectors, vectors, cascade(0.95))
+
+
+def test_compact_merges_everything(tmp_path):
+    vectors = synthetic_hash_vectors(30, 16)
+    library = open_library(tmp_path)
+    paths = add(library, vectors[:10], "a") + add(library, vectors[10:], "b")
+    library.relocate(3, paths[3], "similar_y/a3.jpg")
+    paths[3] = "similar_y/a3.jpg"
+    library.compact()
+    assert len(library.segments) == 1 and library.moved == {}
+    assert [library.path(entry) for entry in range(30)] == paths
+    np.testing.assert_array_equal(library.vectors(library.segments[0]["name"]), vectors)
+
+
+def near_copy(index: int, path, brightness: float):
+    """A brightened, re-encoded copy of corpus picture index"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    ImageEnhance.Brightness(corpus_image(0, index)).enhance(brightness).save(path, quality=85)
+
+
+def test_later_runs_place_new_images_with_library_files(tmp_path, monkeypatch):
+    monkeypatch.setitem(image_processor.PERFORMANCE, 'ENABLE_HASH_CACHE', False)
+    monkeypatch.setitem(image_processor.PERFORMANCE, 'CHECKPOINT_DIR', str(tmp_path / "checkpoints"))
+    output = tmp_path / "out"
+    near_copy(0, tmp_path / "run1" / "a" / "beach.jpg", 1.0)
+    near_copy(0, tmp_path / "run1" / "b" / "beach_edit.jpg", 1.05)
+    near_copy(1, tmp_path / "run1" / "b" / "forest.jpg", 1.0)
+    first = image_processor.ImageSynchronizer(max_workers=1)
+    stats = first.organize_images(tmp_path / "run1" / "a", tmp_path / "run1" / "b", output)
+    assert stats["errors"] == 0 and stats["similar_groups"] == 1 and stats["unique_images"] == 1
+    group = next(output.glob("similar_*"))
+    assert sorted(path.name for path in group.iterdir()) == ["beach.jpg", "beach_edit.jpg"]
+
+    near_copy(0, tmp_path / "run2" / "a" / "beach_again.jpg", 0.95)
+    near_copy(1, tmp_path / "run2" / "a" / "forest_again.jpg", 1.05)
+    near_copy(2, tmp_path / "run2" / "b" / "desert.jpg", 1.0)
+    second = image_processor.ImageSynchronizer(max_workers=1)
+    stats = second.organize_images(tmp_path / "run2" / "a", tmp_path / "run2" / "b", output)
+    assert stats["errors"] == 0 and stats["library_matches"] == 2
+    # Library files are never hashed again
+    assert second.metrics.snapshot()["counters"]["files_hashed"] == {"hash": 3}
+
+    # Joins the existing group; the unique library file moves into a new group with its match
+    assert sorted(path.name for path in group.iterdir()) == ["beach.jpg", "beach_again.jpg", "beach_edit.jpg"]
+    forest = [path.parent for path in output.glob("similar_*/forest*.jpg")]
+    assert len(forest) == 2 and forest[0] == forest[1] != group
+    assert [path.name for path in (output / "unique_images").iterdir()] == ["desert.jpg"]
+    assert len(second.open_library(output)) == 6
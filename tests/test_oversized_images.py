@@ -0,0 +1,100 @@
+import numpy as np
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+
+import hash_kernel
+import image_processor
+from image_processor import ImageProcessor, ImageSynchronizer
+
+
+MB = 2 ** 20
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    """Set the oversized-image limits and policy"""
+    def set_limits(policy='reduce', file_mb=0, megapixels=0, reduced_decode=False):
+        monkeypatch.setitem(image_processor.IMAGE_PROCESSING, 'OVERSIZED_IMAGES', policy)
+        monkeypatch.setitem(image_processor.IMAGE_PROCESSING, 'MAX_FILE_SIZE_MB', file_mb)
+        monkeypatch.setitem(image_processor.IMAGE_PROCESSING, 'MAX_IMAGE_MEGAPIXELS', megapixels)
+        monkeypatch.setitem(image_processor.IMAGE_PROCESSING, 'REDUCED_DECODE', reduced_decode)
+    return set_limits
+
+
+def save(path, size, image_format):
+    pixels = np.random.default_rng(0).integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+    Image.fromarray(pixels, "RGB").save(path, image_format)
+    return path
+
+
+def check(path, file_size=None):
+    return ImageProcessor.check_image(path, path.stat().st_size if file_size is None else file_size)
+
+
+def estimate(size, image_format, reduced):
+    return hash_kernel.estimate_peak_bytes(size, 'RGB', image_format, ImageProcessor.HASH_SIZE, reduced)
+
+
+def test_images_within_the_limits_are_hashed(tmp_path, limits):
+    limits(file_mb=10, megapixels=1)
+    jpeg = save(tmp_path / "a.jpg", (800, 600), "JPEG")
+    assert check(jpeg) == ('hash', estimate((800, 600), 'JPEG', False), "")
+    limits(file_mb=10, megapixels=1, reduced_decode=True)
+    assert check(jpeg) == ('hash', estimate((800, 600), 'JPEG', True), "")
+
+
+def test_the_policy_decides_oversized_images(tmp_path, limits):
+    jpeg = save(tmp_path / "big.jpg", (1600, 1200), "JPEG")
+    png = save(tmp_path / "big.png", (1600, 1200), "PNG")
+
+    limits('reduce', megapixels=1)
+    action, cost, reason = check(jpeg)
+    assert (action, cost) == ('reduce', estimate((1600, 1200), 'JPEG', True))
+    assert reason == "1600x1200 image is over the 1 megapixel limit"
+    # Only JPEGs decode at reduced scale; other formats go to the lane
+    assert check(png)[:2] == ('lane', estimate((1600, 1200), 'PNG', False))
+
+    limits('lane', megapixels=1)
+    assert check(jpeg)[:2] == ('lane', estimate((1600, 1200), 'JPEG', False))
+    limits('skip', megapixels=1)
+    assert check(jpeg) == ('skip', 0, "1600x1200 image is over the 1 megapixel limit")
+
+
+def test_file_size_is_checked_before_pixels(tmp_path, limits):
+    limits('skip', file_mb=10, megapixels=100)
+    jpeg = save(tmp_path / "a.jpg", (64, 48), "JPEG")
+    assert check(jpeg, 40 * MB) == ('skip', 0, "40 MB file is over the 10 MB limit")
+    assert check(jpeg, 10 * MB)[0] == 'hash'
+
+
+def test_reduced_decode_sizes_count_against_the_pixel_limit(tmp_path, limits):
+    # 1.9 MP in full, an eighth of that in each direction when drafted
+    limits('skip', megapixels=1, reduced_decode=True)
+    assert check(save(tmp_path / "big.jpg", (1600, 1200), "JPEG"))[0] == 'hash'
+    assert check(save(tmp_path / "big.png", (1600, 1200), "PNG"))[0] == 'skip'
+
+
+def test_decompression_bombs_and_unreadable_files(tmp_path, limits, monkeypatch):
+    limits()
+    png = save(tmp_path / "bomb.png", (300, 300), "PNG")
+    monkeypatch.setattr(Image, 'MAX_IMAGE_PIXELS', 300 * 300 // 3)
+    assert check(png) == ('skip', 0, "exceeds Pillow's decompression bomb limit")
+
+    broken = tmp_path / "broken.jpg"
+    broken.write_bytes(b"not an image")
+    assert check(broken) == ('hash', 0, "")  # the decoder reports it
+
+
+def test_skipped_images_are_recorded(tmp_path, limits):
+    limits('skip', megapixels=1)
+    save(tmp_path / "big.png", (1600, 1200), "PNG")
+    save(tmp_path / "small.png", (64, 48), "PNG")
+    synchronizer = ImageSynchronizer(max_workers=1, executor='thread')
+    images = synchronizer.collect_images(tmp_path)
+    assert synchronizer.process_images_parallel(images) == 2
+    assert all(img.processed for img in images)
+    hashes = {img.file_path.name: img.image_hashes for img in images}
+    assert hashes["big.png"] == {} and hashes["small.png"]
+    assert synchronizer.skipped == [(tmp_path / "big.png", "1600x1200 image is over the 1 megapixel limit")]
+    assert synchronizer.metrics.snapshot()["counters"]["files_skipped"] == {"hash": 1}
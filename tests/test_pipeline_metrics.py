@@ -0,0 +1,71 @@
+import hashlib
+
+import pytest
+
+pytest.importorskip("PIL")
+benchmark = pytest.importorskip("benchmark")
+build_corpus = benchmark.build_corpus
+
+import image_processor
+from image_processor import ImageSynchronizer
+
+
+@pytest.fixture(scope="module")
+def corpus(tmp_path_factory):
+    root = tmp_path_factory.mktemp("corpus")
+    manifest = build_corpus(root, 40, 0.2, 0.1, 0)
+    return root, manifest
+
+
+@pytest.mark.parametrize("executor", ImageSynchronizer.EXECUTORS)
+def test_run_counters_match_the_corpus(corpus, tmp_path, monkeypatch, executor):
+    root, manifest = corpus
+    monkeypatch.setitem(image_processor.PERFORMANCE, 'ENABLE_HASH_CACHE', False)
+    monkeypatch.setitem(image_processor.PERFORMANCE, 'CHECKPOINT_DIR', str(tmp_path / "checkpoints"))
+    files = sorted(root.rglob("*.jpg"))
+    by_content = {}
+    for path in files:
+        data = path.read_bytes()
+        by_content.setdefault(hashlib.sha256(data).digest(), len(data))
+
+    synchronizer = ImageSynchronizer(max_workers=2, executor=executor, placement_mode='copy')
+    stats = synchronizer.organize_images(root / "folder1", root / "folder2", tmp_path / "out")
+    assert stats["errors"] == 0 and stats["total_processed"] == len(files) == 40
+
+    snapshot = synchronizer.metrics.snapshot()
+    counters = snapshot["counters"]
+    assert counters["files_scanned"] == {"scan": 40}
+    # Exact duplicates are hashed once; every other file is read once by the decoder
+    assert counters["files_hashed"] == {"hash": len(by_content)}
+    assert len(by_content) == 40 - manifest["exact_duplicates"]
+    assert counters["bytes_read"]["hash"] == sum(by_content.values())
+    assert counters["bytes_read"]["digest"] == synchronizer.exact_stats["bytes_read"] > 0
+    assert counters["files_placed"] == {"place": 40}
+    assert sum(counters["pairs_settled"].values()) == counters["comparisons"]["compare"] > 0
+    assert "errors" not in counters
+
+    histograms = snapshot["histograms"]
+    assert histograms["decode_seconds"]["hash"]["count"] == len(by_content)
+    assert histograms["hash_seconds"]["hash"]["count"] == len(by_content)
+    assert {"digest", "hash", "compare", "place"} <= set(histograms["stage_seconds"])
+
+
+def pipeline_results(hash_version: str, hash_rate: float, cpus: int = 1):
+    settings = {"images": 1000, "seed": 0}
+    stage = lambda rate: {"seconds": 1.0, "images_per_s": rate, "mb_per_s": None, "peak_rss_mb": 100.0}
+    return {"hash_version": hash_version, "machine": {"cpus": cpus, "platform": "test"},
+            "runs": [{"corpus": {"settings": settings}, "stages": {"hash": stage(hash_rate), "place": stage(50.0)}}]}
+
+
+def test_baselines_are_compared_stage_by_stage():
+    baseline = pipeline_results("blake2b;size=16", 100.0)
+    baseline["tolerances"] = {"place": 0.5}
+    assert benchmark.compare_to_baseline(pipeline_results("blake2b;size=16", 85.0), baseline, 0.2, 0.25) == []
+    problems = benchmark.compare_to_baseline(pipeline_results("blake2b;size=16", 70.0, cpus=8), baseline, 0.2, 0.25)
+    assert len(problems) == 1 and "hash" in problems[0]
+
+
+def test_baselines_with_other_hash_settings_are_refused():
+    problems = benchmark.compare_to_baseline(pipeline_results("blake2b;size=16", 100.0),
+                                             pipeline_results("xxh3;size=16", 100.0), 0.2, 0.25)
+    assert len(problems) == 1 and "other hash settings" in problems[0]
@@ -0,0 +1,148 @@
+import errno
+import os
+import threading
+
+import pytest
+
+import placement
+from placement import PlacementEngine
+
+
+def write(path, data: bytes = b"data"):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return path
+
+
+def test_reserve_avoids_existing_and_reserved_names(tmp_path):
+    out = tmp_path / "out"
+    write(out / "a.jpg")
+    write(out / "A_1.JPG")
+    engine = PlacementEngine()
+    assert engine.reserve(out, "a.jpg") == str(out / "a_2.jpg")  # case-insensitive
+    assert engine.reserve(out, "a.jpg") == str(out / "a_3.jpg")
+    assert engine.reserve(out, "b.jpg") == str(out / "b.jpg")
+    assert engine.reserve(out, "B.jpg") == str(out / "B_1.jpg")
+    assert engine.reserve(tmp_path / "missing", "a.jpg") == str(tmp_path / "missing" / "a.jpg")
+
+
+def test_run_moves_into_new_folders(tmp_path):
+    engine = PlacementEngine(max_workers=4)
+    sources = [write(tmp_path / "src" / str(i % 3) / "same.jpg", bytes([i])) for i in range(3)]
+    sources += [write(tmp_path / "src" / f"{i}.jpg", str(i).encode()) for i in range(600)]
+    for i, source in enumerate(sources):
+        engine.add(source, tmp_path / "out" / f"group{i % 2}", os.stat(source).st_dev)
+    reports = []
+    errors = engine.run(progress=lambda done, total: reports.append((done, total)))
+
+    assert errors == {}
+    assert all(engine.placed)
+    assert not any(source.exists() for source in sources)
+    assert len(os.listdir(tmp_path / "out" / "group0")) + len(os.listdir(tmp_path / "out" / "group1")) == 603
+    assert {"same.jpg", "same_1.jpg"} <= set(os.listdir(tmp_path / "out" / "group0"))
+    assert reports[-1] == (len(sources), len(sources))
+    placed = {os.fspath(dst) for _, dst, _, _ in engine.operations}
+    assert len(placed) == len(sources)
+
+
+class Journal:
+    def __init__(self):
+        self.records = []
+
+    def record(self, index, linked):
+        self.records.append((index, linked))
+
+
+def test_move_across_devices_copies_and_deletes(tmp_path, monkeypatch):
+    source = write(tmp_path / "a.jpg", b"payload")
+    os.utime(source, ns=(1_000_000_000, 2_000_000_000))
+
+    def rename(src, dst):
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+    monkeypatch.setattr(placement.os, "rename", rename)
+    engine = PlacementEngine()
+    engine.add(source, tmp_path / "out")  # an unknown device tries the rename first
+    journal = Journal()
+    assert engine.run(journal=journal) == {}
+    placed = tmp_path / "out" / "a.jpg"
+    assert placed.read_bytes() == b"payload"
+    assert os.stat(placed).st_mtime_ns == 2_000_000_000
+    assert not source.exists()
+    assert journal.records == [(0, False)]
+
+
+def test_other_rename_errors_are_reported(tmp_path, monkeypatch):
+    source = write(tmp_path / "a.jpg")
+
+    def rename(src, dst):
+        raise PermissionError(errno.EACCES, "Permission denied")
+    monkeypatch.setattr(placement.os, "rename", rename)
+    engine = PlacementEngine()
+    engine.add(source, tmp_path / "out", os.stat(tmp_path).st_dev)
+    errors = engine.run()
+    assert isinstance(errors[0], PermissionError)
+    assert not engine.placed[0]
+    assert source.exists()
+
+
+def test_existing_destination_is_never_replaced(tmp_path):
+    # Something appeared under the reserved name after the folder was listed
+    source = write(tmp_path / "a.jpg", b"new")
+    engine = PlacementEngine(mode='copy')
+    engine.add(source, tmp_path / "out")
+    write(tmp_path / "out" / "a.jpg", b"old")
+    errors = engine.run()
+    assert isinstance(errors[0], FileExistsError)
+    assert (tmp_path / "out" / "a.jpg").read_bytes() == b"old"
+    assert source.read_bytes() == b"new"
+
+
+def test_copy_data_refuses_an_existing_file(tmp_path):
+    source = write(tmp_path / "a.jpg", b"new")
+    destination = write(tmp_path / "b.jpg", b"old")
+    with pytest.raises(FileExistsError):
+        placement.copy_file_data(str(source), str(destination))
+    assert destination.read_bytes() == b"old"
+
+
+def test_unusable_folder_fails_only_its_operations(tmp_path):
+    write(tmp_path / "blocker")  # a file where a folder should go
+    good, bad = write(tmp_path / "a.jpg"), write(tmp_path / "b.jpg")
+    engine = PlacementEngine()
+    engine.add(good, tmp_path / "out")
+    engine.add(bad, tmp_path / "blocker" / "sub")
+    errors = engine.run()
+    assert list(errors) == [1]
+    assert engine.placed[0] and not engine.placed[1]
+    assert bad.exists()
+
+
+def test_links_and_relocations(tmp_path):
+    first, copy = write(tmp_path / "a.jpg", b"same"), write(tmp_path / "b.jpg", b"same")
+    moved = write(tmp_path / "out" / "old" / "c.jpg")
+    engine = PlacementEngine(mode='copy')
+    target = engine.add(first, tmp_path / "out" / "dups")
+    engine.add(copy, tmp_path / "out" / "dups", link_to=target)
+    engine.add(moved, tmp_path / "out" / "new", relocate=True)
+    journal = Journal()
+    assert engine.run(journal=journal) == {}
+    assert os.path.samefile(tmp_path / "out" / "dups" / "a.jpg", tmp_path / "out" / "dups" / "b.jpg")
+    assert first.exists() and copy.exists()  # copy mode keeps sources
+    assert not moved.exists() and (tmp_path / "out" / "new" / "c.jpg").exists()
+    assert sorted(journal.records) == [(0, False), (1, True), (2, False)]
+
+
+def test_placed_operations_are_skipped_and_stop_is_honoured(tmp_path):
+    sources = [write(tmp_path / f"{i}.jpg") for i in range(3)]
+    stop = threading.Event()
+    engine = PlacementEngine(stop_event=stop)
+    for source in sources:
+        engine.add(source, tmp_path / "out")
+    assert engine.run(indices=[1]) == {}
+    assert list(engine.placed) == [0, 1, 0]
+    stop.set()
+    assert engine.run() == {}
+    assert list(engine.placed) == [0, 1, 0]
+    stop.clear()
+    engine.run()
+    assert list(engine.placed) == [1, 1, 1]
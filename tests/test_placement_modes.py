@@ -0,0 +1,113 @@
+import errno
+import os
+import stat
+
+import pytest
+
+import placement
+from placement import PlacementEngine
+
+
+def write(path, data: bytes = b"data"):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    os.utime(path, ns=(1_000_000_000, 2_000_000_000))
+    return path
+
+
+def place(tmp_path, mode):
+    source = write(tmp_path / "src" / "a.jpg", b"payload")
+    engine = PlacementEngine(mode=mode)
+    engine.add(source, tmp_path / "out")
+    assert engine.run() == {}
+    return engine, source, tmp_path / "out" / "a.jpg"
+
+
+def raise_errno(code):
+    def fail(*args, **kwargs):
+        raise OSError(code, os.strerror(code))
+    return fail
+
+
+def test_copy_keeps_contents_and_timestamps(tmp_path):
+    _, source, placed = place(tmp_path, 'copy')
+    assert placed.read_bytes() == b"payload"
+    assert os.stat(placed).st_mtime_ns == 2_000_000_000
+    assert not os.path.samefile(source, placed)
+
+
+@pytest.mark.parametrize("broken", [("copy_file_range",), ("copy_file_range", "sendfile")])
+def test_copy_falls_back_when_kernel_copy_is_unsupported(tmp_path, monkeypatch, broken):
+    for name in broken:
+        if hasattr(os, name):
+            monkeypatch.setattr(placement.os, name, raise_errno(errno.EXDEV))
+    data = os.urandom(3 * 2 ** 20 + 5)
+    source = tmp_path / "a.bin"
+    source.write_bytes(data)
+    placement.copy_file(str(source), str(tmp_path / "b.bin"))
+    assert (tmp_path / "b.bin").read_bytes() == data
+
+
+def test_hardlink_shares_the_inode(tmp_path):
+    _, source, placed = place(tmp_path, 'hardlink')
+    assert os.path.samefile(source, placed)
+
+
+@pytest.mark.parametrize("code", [errno.EXDEV, errno.EPERM, errno.EMLINK])
+def test_hardlink_copies_where_links_are_impossible(tmp_path, monkeypatch, code):
+    monkeypatch.setattr(placement.os, "link", raise_errno(code))
+    _, source, placed = place(tmp_path, 'hardlink')
+    assert placed.read_bytes() == b"payload"
+    assert not os.path.samefile(source, placed)
+
+
+def test_hardlink_reports_other_errors(tmp_path, monkeypatch):
+    monkeypatch.setattr(placement.os, "link", raise_errno(errno.EIO))
+    source = write(tmp_path / "a.jpg")
+    engine = PlacementEngine(mode='hardlink')
+    engine.add(source, tmp_path / "out")
+    assert engine.run()[0].errno == errno.EIO
+    assert not (tmp_path / "out" / "a.jpg").exists()
+
+
+@pytest.mark.skipif(placement.fcntl is None, reason="needs fcntl")
+@pytest.mark.parametrize("code", [errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL])
+def test_reflink_copies_where_cloning_is_unsupported(tmp_path, monkeypatch, code):
+    monkeypatch.setattr(placement.fcntl, "ioctl", raise_errno(code))
+    _, source, placed = place(tmp_path, 'reflink')
+    assert placed.read_bytes() == b"payload"
+    assert os.stat(placed).st_mtime_ns == 2_000_000_000
+
+
+def test_reflink_on_this_filesystem(tmp_path):
+    # A real clone where supported (btrfs, XFS), a copy elsewhere
+    _, source, placed = place(tmp_path, 'reflink')
+    assert placed.read_bytes() == b"payload"
+    assert os.stat(placed).st_mtime_ns == 2_000_000_000
+
+
+@pytest.mark.skipif(not hasattr(os, "symlink"), reason="needs symlinks")
+def test_symlink_points_at_the_absolute_source(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    source = write(tmp_path / "src" / "a.jpg")
+    engine = PlacementEngine(mode='symlink')
+    engine.add(os.path.relpath(source), "out")
+    assert engine.run() == {}
+    placed = tmp_path / "out" / "a.jpg"
+    assert stat.S_ISLNK(os.lstat(placed).st_mode)
+    assert os.readlink(placed) == str(source)
+
+
+@pytest.mark.parametrize("mode", ['copy', 'hardlink', 'reflink', 'symlink'])
+def test_undo_removes_the_placed_file_and_keeps_the_source(tmp_path, mode):
+    engine, source, placed = place(tmp_path, mode)
+    assert engine.recover(0) is True
+    engine.undo(0)
+    assert not os.path.lexists(placed)
+    assert source.read_bytes() == b"payload"
+    assert engine.recover(0) is None
+
+
+def test_unknown_mode_is_rejected():
+    with pytest.raises(ValueError):
+        PlacementEngine(mode='teleport')
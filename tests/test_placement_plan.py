@@ -0,0 +1,156 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+import placement_plan
+from placement import PlacementEngine
+from placement_plan import OperationJournal, PlacementPlan, apply_plan, rollback_plan
+
+
+def write(path, data: bytes = b"data"):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return path
+
+
+def make_plan(tmp_path, count=6, mode='move'):
+    sources = [write(tmp_path / "src" / f"{i}.jpg", str(i).encode()) for i in range(count)]
+    engine = PlacementEngine(mode=mode)
+    for i, source in enumerate(sources):
+        engine.add(source, tmp_path / "out" / f"group{i % 2}")
+    return PlacementPlan.from_engine(engine, tmp_path / "out", [i % 2 == 1 for i in range(count)]), sources
+
+
+def journal_lines(path):
+    with open(path, "rb") as f:
+        return f.read().decode("ascii").split("\n")
+
+
+def test_save_and_load_round_trip(tmp_path):
+    plan, _ = make_plan(tmp_path)
+    plan.relocations = {2}
+    plan.similar_groups = 3
+    plan.hash_version = "v"
+    plan.vectors = np.arange(len(plan) * 2, dtype=np.uint64).reshape(len(plan), 2) << np.uint64(40)
+    plan.valid = np.arange(len(plan)) % 3 != 0
+    plan.library_entries = {2: 7}
+    plan.save(tmp_path / "plan.json.gz")
+
+    loaded = PlacementPlan.load(tmp_path / "plan.json.gz")
+    assert loaded.operations == plan.operations
+    assert loaded.unique == plan.unique
+    assert loaded.relocations == {2}
+    assert loaded.similar_groups == 3
+    np.testing.assert_array_equal(loaded.vectors, plan.vectors)
+    np.testing.assert_array_equal(loaded.valid, plan.valid)
+    assert loaded.library_entries == {2: 7}
+    assert loaded.identity() == plan.identity()
+
+
+def test_apply_resumes_after_a_torn_record(tmp_path):
+    plan, sources = make_plan(tmp_path)
+    journal_path = tmp_path / "plan.journal"
+    engine, errors = apply_plan(plan, journal_path)
+    assert errors == {} and all(engine.placed)
+
+    # A crash: the last record was cut off and the one before it never written.
+    # Its file was moved all the same.
+    lines = journal_lines(journal_path)
+    assert len(lines) == len(plan) + 2  # header, records, trailing newline
+    torn = "\n".join(lines[:-3]) + "\n" + lines[-2][:1]
+    journal_path.write_bytes(torn.encode("ascii"))
+    state, torn_length = placement_plan.read_journal(journal_path, plan.identity())
+    assert len(state) == len(plan) - 2 and torn_length == 1
+
+    engine, errors = apply_plan(plan, journal_path)
+    assert errors == {} and all(engine.placed)
+    lines = journal_lines(journal_path)
+    assert lines[-1] == ""
+    assert all(line[:1] in "+=" and line[1:].isdigit() for line in lines[1:-1])
+    assert len(placement_plan.read_journal(journal_path, plan.identity())[0]) == len(plan)
+    assert not any(source.exists() for source in sources)
+
+
+def test_apply_reports_conflicts_instead_of_overwriting(tmp_path):
+    plan, sources = make_plan(tmp_path, count=2)
+    destination = write(Path(plan.operations[1][1]), b"someone else's file")
+    engine, errors = apply_plan(plan, tmp_path / "plan.journal")
+    assert list(errors) == [1]
+    assert isinstance(errors[1], FileExistsError)
+    assert destination.read_bytes() == b"someone else's file"
+    assert sources[1].exists()
+    assert list(engine.placed) == [1, 0]
+
+
+def test_rollback_after_a_torn_record(tmp_path):
+    plan, sources = make_plan(tmp_path)
+    journal_path = tmp_path / "plan.journal"
+    apply_plan(plan, journal_path)
+    lines = journal_lines(journal_path)
+    journal_path.write_bytes(("\n".join(lines[:-2]) + "\n+").encode("ascii"))
+    lost = int(lines[-2][1:])  # placement runs in parallel, so any operation may finish last
+
+    undone, errors = rollback_plan(plan, journal_path)
+    assert undone == len(plan) - 1 and errors == {}
+    # The operation whose record was lost stays in place; everything else is back
+    assert [source.exists() for source in sources] == [i != lost for i in range(len(plan))]
+    assert placement_plan.read_journal(journal_path, plan.identity())[0] == {}
+    assert os.listdir(tmp_path / "out") == ["group" + str(lost % 2)]
+
+
+def test_journal_of_another_plan_is_refused(tmp_path):
+    plan, _ = make_plan(tmp_path)
+    other, _ = make_plan(tmp_path / "other")
+    OperationJournal(tmp_path / "plan.journal", other.identity()).close()
+    with pytest.raises(ValueError):
+        apply_plan(plan, tmp_path / "plan.journal")
+
+
+def test_unfinished_operations(tmp_path):
+    plan, _ = make_plan(tmp_path)
+    plan_path, journal_path = tmp_path / "plan.json.gz", tmp_path / "plan.json.gz.journal"
+    plan.save(plan_path)
+
+    journal = OperationJournal(journal_path, plan.identity())
+    journal.close()
+    assert placement_plan.unfinished_operations(plan_path, journal_path) == 0  # never applied
+
+    journal = OperationJournal(journal_path, plan.identity())
+    journal.record(0)
+    journal.record(3)
+    journal.close()
+    assert placement_plan.unfinished_operations(plan_path, journal_path) == len(plan) - 2
+
+    journal = OperationJournal(journal_path, plan.identity())
+    journal.record_undone(3)
+    journal.record_undone(0)
+    journal.close()
+    assert placement_plan.unfinished_operations(plan_path, journal_path) == 0  # rolled back
+
+    apply_plan(plan, journal_path)
+    assert placement_plan.unfinished_operations(plan_path, journal_path) == 0  # finished
+
+
+def test_organize_refuses_to_discard_an_unfinished_journal(tmp_path):
+    image_processor = pytest.importorskip("image_processor")
+    output = tmp_path / "out"
+    state = output / image_processor.ImageSynchronizer.STATE_FOLDER
+    plan, _ = make_plan(tmp_path)
+    plan_path = state / "plan.json.gz"
+    state.mkdir(parents=True)
+    plan.save(plan_path)
+    journal = OperationJournal(placement_plan.journal_path_for(plan_path), plan.identity())
+    journal.record(0)
+    journal.close()
+    before = journal_lines(placement_plan.journal_path_for(plan_path))
+
+    folder = tmp_path / "in"
+    write(folder / "a.jpg")
+    synchronizer = image_processor.ImageSynchronizer(max_workers=1)
+    stats = synchronizer.organize_images(folder, folder, output)
+    assert stats["error"] == 1
+    assert "cli.py apply" in stats["message"] and "--rollback" in stats["message"]
+    assert journal_lines(placement_plan.journal_path_for(plan_path)) == before
+    assert (folder / "a.jpg").exists()
@@ -0,0 +1,132 @@
+import numpy as np
+import pytest
+
+import hamming
+from similarity_index import SimilarityCascade
+
+
+HASH_TYPES = ('ahash', 'phash', 'dhash', 'whash')
+WEIGHTS = {'ahash': 0.25, 'phash': 0.30, 'dhash': 0.25, 'whash': 0.20}
+
+
+def flipped_pairs(count: int, max_flips: int = 80, seed: int = 0):
+    """(left, right) 16x16 hash vectors differing in 0..max_flips random bits of each type"""
+    rng = np.random.default_rng(seed)
+    left = rng.integers(0, 2 ** 64, (count, 16), dtype=np.uint64)
+    right = left.copy()
+    for row in range(count):
+        for hash_index in range(4):
+            flips = rng.integers(0, max_flips + 1)
+            for bit in rng.choice(256, flips, replace=False) + 256 * hash_index:
+                right[row, bit // 64] ^= np.uint64(1) << np.uint64(63 - bit % 64)
+    return left, right
+
+
+def reference(test: SimilarityCascade, left: np.ndarray, right: np.ndarray) -> np.ndarray:
+    """The cascade's rule, every type compared for every pair"""
+    distances = hamming.popcount(left ^ right).reshape(len(left), len(test.hash_types), -1).sum(axis=-1)
+    weighted = distances @ np.array(test.weights)
+    matches = (distances <= test.type_radius).sum(axis=1)
+    return (weighted <= test.budget) & (matches >= test.min_matches)
+
+
+@pytest.mark.parametrize("threshold", [0.8, 0.85, 0.9, 0.95])
+@pytest.mark.parametrize("min_matches", [0, 1, 2, 4])
+def test_verify_matches_the_reference(threshold, min_matches):
+    left, right = flipped_pairs(400)
+    test = SimilarityCascade(HASH_TYPES, 4, threshold, WEIGHTS, min_matches, 256)
+    rows = np.arange(len(left))
+    expected = reference(test, left, right)
+    assert 0 < expected.sum() < len(left)
+    np.testing.assert_array_equal(test.verify(left, right, rows, rows), expected)
+    # Every pair is settled by exactly one type
+    assert sum(test.stage_counts().values()) == len(left)
+    assert test.accepted == expected.sum()
+
+
+@pytest.mark.parametrize("threshold", [0.85, 0.95])
+def test_verify_block_matches_verify(threshold):
+    left, right = flipped_pairs(60, seed=1)
+    test = SimilarityCascade(HASH_TYPES, 4, threshold, WEIGHTS, 2, 256)
+    first, second = np.divmod(np.arange(len(left) * len(right)), len(right))
+    expected = test.verify(left, right, first, second).reshape(len(left), len(right))
+
+    mask = (first + second).reshape(len(left), len(right)) % 3 != 0
+    block = SimilarityCascade(HASH_TYPES, 4, threshold, WEIGHTS, 2, 256)
+    i, j = block.verify_block(left, right, mask)
+    assert set(zip(i.tolist(), j.tolist())) == set(zip(*np.nonzero(expected & mask)))
+    assert sum(block.stage_counts().values()) == mask.sum()
+
+
+def test_heaviest_type_goes_first_and_settles_dissimilar_pairs():
+    rng = np.random.default_rng(2)
+    left = rng.integers(0, 2 ** 64, (500, 16), dtype=np.uint64)
+    right = rng.integers(0, 2 ** 64, (500, 16), dtype=np.uint64)
+    test = SimilarityCascade(HASH_TYPES, 4, 0.95, WEIGHTS, 2, 256)
+    assert test.hash_types[test.order[0]] == 'phash'
+    rows = np.arange(500)
+    assert not test.verify(left, right, rows, rows).any()
+    # Random pairs are about 128 bits apart per type: 0.3 * 128 is far over a 12.8-bit budget
+    assert list(test.stage_counts()) == ['phash', 'ahash', 'dhash', 'whash']
+    assert test.stage_counts()['phash'] == 500
+
+
+def test_settle_waits_until_the_rest_cannot_change_the_outcome():
+    test = SimilarityCascade(HASH_TYPES, 4, 0.85, WEIGHTS, 0, 256)
+    partial = np.array([0.0, test.budget + 1])
+    rejected, accepted = test._settle(0, partial, np.zeros(2, dtype=np.int32))
+    assert rejected.tolist() == [False, True]
+    assert accepted is None  # the remaining types could still spend the budget
+    rejected, accepted = test._settle(len(HASH_TYPES) - 1, partial, np.zeros(2, dtype=np.int32))
+    assert rejected.tolist() == [False, True] and accepted.tolist() == [True, False]
+
+
+def test_settle_rejects_once_min_matches_is_out_of_reach():
+    test = SimilarityCascade(HASH_TYPES, 4, 0.85, WEIGHTS, 4, 256)
+    rejected, _ = test._settle(1, np.zeros(2), np.array([2, 1], dtype=np.int32))
+    assert rejected.tolist() == [False, True]
+
+
+@pytest.mark.parametrize("threshold", [0.85, 0.92, 0.95, 0.98])
+@pytest.mark.parametrize("min_matches", [0, 2])
+def test_similar_pairs_share_a_substring_and_are_within_the_candidate_radius(threshold, min_matches):
+    left, right = flipped_pairs(600, max_flips=int((1 - threshold) * 256 * 2), seed=3)
+    test = SimilarityCascade(HASH_TYPES, 4, threshold, WEIGHTS, min_matches, 256)
+    similar = reference(test, left, right)
+    assert similar.any()
+    distance = hamming.popcount(left ^ right).sum(axis=1)
+    assert (distance[similar] <= test.candidate_radius).all()
+
+    if not test.substrings:
+        return
+    shared = np.zeros(len(left), dtype=bool)
+    for start, length in test.substrings:
+        bits = np.arange(start, start + length)
+        words, shifts = bits // 64, (63 - bits % 64).astype(np.uint64)
+        differ = ((left[:, words] ^ right[:, words]) >> shifts) & np.uint64(1)
+        shared |= ~differ.any(axis=1)
+    assert shared[similar].all()
+
+
+def test_tighter_thresholds_use_fewer_substrings():
+    counts = [len(SimilarityCascade(HASH_TYPES, 4, threshold, WEIGHTS, 2, 256).substrings)
+              for threshold in (0.85, 0.9, 0.95, 0.99)]
+    assert counts == sorted(counts, reverse=True)
+    assert counts[-1] < counts[0]
+
+
+def test_weights_are_normalized():
+    test = SimilarityCascade(HASH_TYPES, 4, 0.9, {'ahash': 2, 'phash': 2, 'dhash': 0, 'whash': 0}, 1, 256)
+    assert test.weights == [0.5, 0.5, 0.0, 0.0]
+    assert test.type_radii['dhash'] == 256
+    equal = SimilarityCascade(HASH_TYPES, 4, 0.9, {t: 0 for t in HASH_TYPES}, 1, 256)
+    assert equal.weights == [0.25] * 4
+    assert SimilarityCascade(HASH_TYPES, 4, 0.9, None, 9, 256).min_matches == 4
+
+
+def test_key_tracks_threshold_weights_and_min_matches():
+    key = SimilarityCascade(HASH_TYPES, 4, 0.9, WEIGHTS, 2, 256).key()
+    assert key == SimilarityCascade(HASH_TYPES, 4, 0.9, WEIGHTS, 2, 256).key()
+    assert key != SimilarityCascade(HASH_TYPES, 4, 0.91, WEIGHTS, 2, 256).key()
+    assert key != SimilarityCascade(HASH_TYPES, 4, 0.9, None, 2, 256).key()
+    assert key != SimilarityCascade(HASH_TYPES, 4, 0.9, WEIGHTS, 1, 256).key()
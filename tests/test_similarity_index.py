@@ -0,0 +1,147 @@
+import numpy as np
+import pytest
+
+import hamming
+from similarity_index import HammingIndex, SimilarityCascade, radius_for_threshold
+
+synthetic_hash_vectors = pytest.importorskip("benchmark").synthetic_hash_vectors
+
+
+HASH_TYPES = ('ahash', 'phash', 'dhash', 'whash')
+WEIGHTS = {'ahash': 0.25, 'phash': 0.30, 'dhash': 0.25, 'whash': 0.20}
+
+
+def cascade(threshold: float) -> SimilarityCascade:
+    """The default comparison of 16x16 hashes"""
+    return SimilarityCascade(HASH_TYPES, 4, threshold, WEIGHTS, 2, 256)
+
+
+def brute_force(vectors: np.ndarray, radius: int = None, test: SimilarityCascade = None):
+    """Every pair (i < j), compared directly"""
+    first, second = np.triu_indices(len(vectors), 1)
+    if test is not None:
+        keep = test.verify(vectors, vectors, first, second)
+    else:
+        keep = hamming.popcount(vectors[first] ^ vectors[second]).sum(axis=-1) <= radius
+    return first[keep], second[keep]
+
+
+def assert_same_pairs(found, expected):
+    assert len(expected[0])
+    np.testing.assert_array_equal(found[0], expected[0])
+    np.testing.assert_array_equal(found[1], expected[1])
+
+
+def test_substring_index_matches_brute_force():
+    vectors = synthetic_hash_vectors(3000, 4, max_flips=24)
+    radius = radius_for_threshold(0.95, 256)
+    index = HammingIndex(vectors, radius)
+    assert index.mode == 'substrings'
+    assert_same_pairs(index.pairs(), brute_force(vectors, radius))
+
+
+def test_scan_matches_brute_force():
+    vectors = synthetic_hash_vectors(1500, 4, max_flips=40)
+    radius = radius_for_threshold(0.85, 256)
+    index = HammingIndex(vectors, radius)
+    assert index.mode == 'scan'
+    assert_same_pairs(index.pairs(), brute_force(vectors, radius))
+
+
+@pytest.mark.parametrize("threshold", [0.85, 0.95])
+def test_cascade_index_matches_brute_force(threshold):
+    vectors = synthetic_hash_vectors(2000, 16, max_flips=64)
+    index = HammingIndex(vectors, 0, cascade=cascade(threshold))
+    assert index.mode == ('substrings' if threshold == 0.95 else 'scan')
+    assert_same_pairs(index.pairs(), brute_force(vectors, test=cascade(threshold)))
+
+
+def test_valid_rows_only():
+    vectors = synthetic_hash_vectors(2000, 4)
+    valid = np.arange(len(vectors)) % 3 != 0
+    radius = radius_for_threshold(0.95, 256)
+    first, second = HammingIndex(vectors, radius, valid=valid).pairs()
+    expected = brute_force(vectors, radius)
+    both = valid[expected[0]] & valid[expected[1]]
+    assert_same_pairs((first, second), (expected[0][both], expected[1][both]))
+
+
+def near_pairs(rows: int, pairs: int, flips: int, seed: int = 1) -> np.ndarray:
+    """Random 16x16 hash vectors whose last rows are copies of the first with flips bits of every type changed"""
+    rng = np.random.default_rng(seed)
+    vectors = rng.integers(0, 2 ** 64, (rows, 16), dtype=np.uint64)
+    for copy in range(pairs):
+        vectors[rows - 1 - copy] = vectors[copy]
+        for hash_index in range(4):
+            for bit in rng.choice(256, flips, replace=False) + 256 * hash_index:
+                vectors[rows - 1 - copy, bit // 64] ^= np.uint64(1) << np.uint64(63 - bit % 64)
+    return vectors
+
+
+def test_sampled_tables_find_pairs_at_the_threshold():
+    # 36 of 256 bits of every hash apart: similar at 0.85, and near the radius
+    vectors = near_pairs(6000, 300, 36)
+    exact = HammingIndex(vectors, 0, cascade=cascade(0.85)).pairs()
+    index = HammingIndex(vectors, 0, cascade=cascade(0.85), recall=0.999)
+    assert index.mode == 'sampled'
+    first, second = index.pairs()
+
+    expected = set(zip(exact[0].tolist(), exact[1].tolist()))
+    found = set(zip(first.tolist(), second.tolist()))
+    assert len(expected) >= 300
+    assert found <= expected
+    assert len(found) >= 0.99 * len(expected)
+    assert index.comparisons < len(vectors) * (len(vectors) - 1) // 20
+
+
+def test_sampled_tables_resume_from_finished_units():
+    vectors = near_pairs(5000, 100, 20)
+    index = HammingIndex(vectors, 0, cascade=cascade(0.85), recall=0.999)
+    units = {}
+    first, second = index.pairs(on_unit=lambda unit, a, b: units.__setitem__(unit, (a, b)))
+    assert len(units) == len(index.sampled)
+
+    done = set(list(units)[:len(units) // 2])
+    again = HammingIndex(vectors, 0, cascade=cascade(0.85), recall=0.999)
+    rest = again.pairs(done_units=done)
+    merged = {(a, b) for unit in done for a, b in zip(*map(np.ndarray.tolist, units[unit]))}
+    merged |= set(zip(rest[0].tolist(), rest[1].tolist()))
+    assert merged == set(zip(first.tolist(), second.tolist()))
+
+
+def test_full_recall_never_samples():
+    vectors = near_pairs(5000, 10, 20)
+    assert HammingIndex(vectors, 0, cascade=cascade(0.85), recall=1.0).mode == 'scan'
+    assert HammingIndex(vectors[:100], 0, cascade=cascade(0.85), recall=0.999).mode == 'scan'
+
+
+def test_query_many_matches_brute_force():
+    vectors = synthetic_hash_vectors(3000, 16, max_flips=32)
+    library, new = vectors[:2500], vectors[2500:]
+    for threshold in (0.85, 0.95):
+        test = cascade(threshold)
+        found = HammingIndex(library, 0, cascade=test).query_many(new)
+        found = set(zip(found[0].tolist(), found[1].tolist()))
+        query, row = np.divmod(np.arange(len(new) * len(library)), len(library))
+        keep = cascade(threshold).verify(new, library, query, row)
+        assert found == set(zip(query[keep].tolist(), row[keep].tolist()))
+
+
+def test_query_many_samples_large_libraries():
+    vectors = synthetic_hash_vectors(12000, 16, max_flips=32)
+    library, new = vectors[:10000], vectors[10000:]
+    test = cascade(0.85)
+    query, row = np.divmod(np.arange(len(new) * len(library)), len(library))
+    keep = test.verify(new, library, query, row)
+    expected = set(zip(query[keep].tolist(), row[keep].tolist()))
+    assert expected
+
+    index = HammingIndex(library, 0, cascade=test, recall=0.999)
+    found = index.query_many(new)
+    found = set(zip(found[0].tolist(), found[1].tolist()))
+    assert found <= expected
+    assert len(found) >= 0.99 * len(expected)
+    assert index.comparisons < len(new) * len(library) // 4
+    # Full recall scans every pair
+    exact = HammingIndex(library, 0, cascade=cascade(0.85)).query_many(new)
+    assert set(zip(exact[0].tolist(), exact[1].tolist())) == expected
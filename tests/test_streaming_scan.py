@@ -0,0 +1,71 @@
+import re
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("PIL")
+
+from image_processor import ImageData, ImageProcessor, ImageSynchronizer
+
+
+def make_folders(tmp_path, counts):
+    folders = []
+    for name, count in zip("ab", counts):
+        folder = tmp_path / name
+        for i in range(count):
+            path = folder / f"sub{i % 3}" / f"{name}{i}.jpg"
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(b"x")
+        folders.append(folder)
+    return folders
+
+
+def test_both_folders_stream_into_hashing_with_running_counts(tmp_path, monkeypatch):
+    folders = make_folders(tmp_path, (30, 20))
+    # Each walk waits for the other to start, so they must run at once
+    started = threading.Barrier(2, timeout=10)
+    iter_images = ImageSynchronizer.iter_images
+
+    def walk_together(self, folder):
+        started.wait()
+        yield from iter_images(self, folder)
+    monkeypatch.setattr(ImageSynchronizer, 'iter_images', walk_together)
+    monkeypatch.setattr(ImageProcessor, 'check_image', staticmethod(lambda path, size: ('hash', 0, "")))
+
+    def compute(img, *args):
+        img.image_hashes = {}
+        img.processed = True
+    monkeypatch.setattr(ImageData, 'compute', compute)
+
+    reports = []
+    synchronizer = ImageSynchronizer(progress_callback=lambda value, message: reports.append(message),
+                                     max_workers=2, executor='thread')
+    found = [[], []]
+    hashed = synchronizer.process_images_parallel(synchronizer.scan_folders(folders, found),
+                                                  discovered=lambda: len(found[0]) + len(found[1]))
+    assert hashed == 50
+    assert sorted(img.file_path.name for img in found[0]) == sorted(f"a{i}.jpg" for i in range(30))
+    assert sorted(img.file_path.name for img in found[1]) == sorted(f"b{i}.jpg" for i in range(20))
+    assert all(img.processed for img in found[0] + found[1])
+
+    counts = [tuple(map(int, re.match(r"Discovered (\d+), hashed (\d+), pending (\d+)", m).groups()))
+              for m in reports]
+    assert counts[-1] == (50, 50, 0)
+    assert all(discovered == done + pending for discovered, done, pending in counts)
+    assert [done for _, done, _ in counts] == sorted(done for _, done, _ in counts)
+
+
+def test_the_walk_waits_for_hashing_and_stops_with_it(tmp_path, monkeypatch):
+    folders = make_folders(tmp_path, (60, 60))
+    monkeypatch.setattr(ImageSynchronizer, 'SCAN_QUEUE_SIZE', 4)
+    synchronizer = ImageSynchronizer(max_workers=1)
+    found = [[], []]
+    scan = synchronizer.scan_folders(folders, found)
+    next(scan)
+    time.sleep(0.3)
+    # The queue, plus one record held by each blocked walker
+    assert len(found[0]) + len(found[1]) <= 4 + 1 + 2
+
+    scan.close()  # joins the walkers
+    assert len(found[0]) + len(found[1]) < 120
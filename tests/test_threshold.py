@@ -0,0 +1,127 @@
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+pytest.importorskip("PIL")
+
+import cli
+import image_processor
+from catalog import HAS_HASHES, HASH_TYPES
+from image_processor import ImageData, ImageProcessor, ImageSynchronizer
+from similarity_index import radius_for_threshold
+
+
+def test_radius_for_threshold():
+    assert radius_for_threshold(0.85, 256) == 38
+    assert radius_for_threshold(0.9, 256) == 25
+    assert radius_for_threshold(1.0, 256) == 0
+    assert radius_for_threshold(0.0, 256) == 256
+    assert radius_for_threshold(-1.0, 256) == 256
+    assert radius_for_threshold(0.75, 1024) == 256  # no rounding down at exact values
+
+
+def test_tighter_thresholds_shrink_every_limit():
+    cascades = [ImageProcessor.similarity_cascade(t) for t in (0.8, 0.85, 0.9, 0.95, 1.0)]
+    for looser, tighter in zip(cascades, cascades[1:]):
+        assert tighter.type_radius < looser.type_radius
+        assert tighter.candidate_radius < looser.candidate_radius
+        assert all(tighter.type_radii[t] <= looser.type_radii[t] for t in HASH_TYPES)
+    assert cascades[-1].candidate_radius == 0
+
+
+def test_threshold_defaults_to_config_and_is_validated(monkeypatch):
+    monkeypatch.setitem(image_processor.IMAGE_PROCESSING, 'DEFAULT_SIMILARITY_THRESHOLD', 0.9)
+    assert ImageSynchronizer(max_workers=1).threshold == 0.9
+    assert ImageSynchronizer(max_workers=1, threshold=0.95).threshold == 0.95
+    assert ImageSynchronizer(max_workers=1, threshold=0.0).threshold == 0.0
+    for threshold in (-0.1, 1.5):
+        with pytest.raises(ValueError):
+            ImageSynchronizer(max_workers=1, threshold=threshold)
+
+
+def near_images(synchronizer, flips: int):
+    """Two images whose hashes differ in flips bits of every type"""
+    catalog = synchronizer.catalog
+    rng = np.random.default_rng(0)
+    images = [ImageData(catalog=catalog, row=catalog.add(Path(f"/photos/{name}.jpg"))) for name in "ab"]
+    for hash_type in HASH_TYPES:
+        words = rng.integers(0, 2 ** 64, catalog.hash_words, dtype=np.uint64)
+        other = words.copy()
+        for bit in rng.choice(catalog.hash_words * 64, flips, replace=False):
+            other[bit // 64] ^= np.uint64(1) << np.uint64(63 - bit % 64)
+        catalog.hashes[hash_type][images[0].row] = words
+        catalog.hashes[hash_type][images[1].row] = other
+    for img in images:
+        catalog.set_flag(img.row, HAS_HASHES)
+    return images
+
+
+@pytest.mark.parametrize("threshold, similar", [(0.85, True), (0.9, True), (0.95, False)])
+def test_grouping_uses_the_synchronizer_threshold(threshold, similar):
+    # 20 of 256 bits apart: about 92% similar
+    synchronizer = ImageSynchronizer(max_workers=1, threshold=threshold)
+    images = near_images(synchronizer, 20)
+    first, second = synchronizer.similar_pairs(images)
+    assert (list(zip(first.tolist(), second.tolist())) == [(0, 1)]) is similar
+    assert bool(synchronizer.find_similar_groups(images[:1], images[1:])) is similar
+
+
+def test_an_explicit_threshold_overrides_the_synchronizer():
+    synchronizer = ImageSynchronizer(max_workers=1, threshold=0.95)
+    images = near_images(synchronizer, 20)
+    assert len(synchronizer.similar_pairs(images)[0]) == 0
+    assert len(synchronizer.similar_pairs(images, threshold=0.9)[0]) == 1
+
+
+def test_library_matching_uses_the_synchronizer_threshold(tmp_path, monkeypatch):
+    seen = []
+    similarity_cascade = ImageProcessor.similarity_cascade
+
+    def record(threshold, *args):
+        seen.append(threshold)
+        return similarity_cascade(threshold, *args)
+    monkeypatch.setattr(ImageProcessor, 'similarity_cascade', staticmethod(record))
+    synchronizer = ImageSynchronizer(max_workers=1, threshold=0.91)
+    images = near_images(synchronizer, 20)
+    library = synchronizer.open_library(tmp_path)
+    vectors, valid = synchronizer.hash_vectors(np.array([images[0].row]))
+    library.add(["unique_images/a.jpg"], vectors, valid)
+    (tmp_path / "unique_images").mkdir()
+    (tmp_path / "unique_images" / "a.jpg").write_bytes(b"")
+    assert seen == [0.91]  # the library's tables
+    seen.clear()
+
+    assert synchronizer.match_library(library, images[1:], tmp_path) == {images[1].row: [0]}
+    assert synchronizer.match_library(library, images[1:], tmp_path, threshold=0.95) == {}
+    assert seen == [0.91, 0.95]
+
+
+def sync_args(tmp_path, threshold):
+    for name in ("a", "b"):
+        (tmp_path / name).mkdir(exist_ok=True)
+    return argparse.Namespace(folder1=str(tmp_path / "a"), folder2=str(tmp_path / "b"),
+                              output=str(tmp_path / "out"), threshold=threshold, workers=1,
+                              executor=None, exact_only=False, mode=None, link_duplicates=None,
+                              resume=False, metrics=None, verbose=False)
+
+
+def test_cli_passes_the_threshold_through(tmp_path):
+    synchronizer, _, _, _ = cli.create_synchronizer(sync_args(tmp_path, 0.9))
+    assert synchronizer.threshold == 0.9
+
+
+@pytest.mark.parametrize("threshold", [-0.5, 1.01])
+def test_cli_rejects_thresholds_outside_zero_to_one(tmp_path, threshold):
+    with pytest.raises(SystemExit):
+        cli.create_synchronizer(sync_args(tmp_path, threshold))
+
+
+def test_watch_session_follows_the_synchronizer(tmp_path):
+    folder_watch = pytest.importorskip("folder_watch")
+    synchronizer = ImageSynchronizer(max_workers=1, threshold=0.92)
+    session = folder_watch.WatchSession(synchronizer, [tmp_path], tmp_path / "out")
+    assert session.threshold == 0.92 and session.cascade.threshold == 0.92
+    session = folder_watch.WatchSession(synchronizer, [tmp_path], tmp_path / "out", threshold=0.97)
+    assert session.cascade.threshold == 0.97